@@ -2,5 +2,64 @@
 
 __VERSION__ = "0.1"
 
-from .co_util import net_source, iter_source, net_sink, NullSink, file_source
-from .processors import hex_print, midi_in_stream, midi_in_ftdi, midi_in_snddev, midi_out_ftdi, midi_out_snddev, process_smf_track, drop_off, harmonize, chain
+# Submodules are imported when one of their names is first used, so a
+# short-lived process only pays for the parts of the package it touches:
+# `from midiproc import chain` loads processors and what it needs, not
+# multiprocessing, hashlib, sockets and the rest. midiproc.render is the
+# submodule; its render() function is midiproc.render.render.
+
+import sys
+
+_EXPORTS = {}
+for _module, _names in (
+        ('co_util', 'net_source iter_source net_sink NullSink file_source'),
+        ('processors', 'hex_print midi_in_stream midi_in_ftdi '
+                       'midi_in_snddev midi_out_ftdi midi_out_snddev '
+                       'process_smf_track drop_off harmonize chain'),
+        ('batch', 'MessageBatch'),
+        ('stream', 'StreamParser SysexBuffer midi_in_chunks'),
+        ('smf', 'MidiFile read_smf SMFReader TrackParser'),
+        ('scheduler', 'Scheduler play_smf smf_source'),
+        ('parallel', 'Executor'),
+        ('net', 'FramedSink Deframer framed_net_source framed_net_sink'),
+        ('metrics', 'Metrics'),
+        ('device', 'DeviceReader bulk_reader pipe_device pty_device '
+                   'open_device register_backend'),
+        ('output', 'OutputSink RunningStatus DIN_BAUD'),
+        ('mapped', 'MappedFile mapped_source'),
+        ('capture', 'CaptureSink CaptureReader capture_sink replay_source'),
+        ('ring', 'RingBuffer RingSink decoupled'),
+        ('realtime', 'RealtimeDemux ClockTracker split_realtime'),
+        ('graph', 'Graph GraphError'),
+        ('lut', 'Transform transform transposition quantize chord split'),
+        ('notes', 'NoteState NoteTracker NoteGuard note_offs all_notes_off'),
+        ('cache', 'SMFCache'),
+        ('render', 'render_file write_smf encode_smf')):
+    for _name in _names.split():
+        _EXPORTS[_name] = _module
+del _module, _names, _name
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    "import the submodule providing a public name on first use (PEP 562)"
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError('module %r has no attribute %r' % (__name__,
+                                                                name))
+    value = getattr(__import__(__name__ + '.' + module, None, None, [name]),
+                    name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
+
+
+if sys.version_info < (3, 7):
+    # no module __getattr__: import everything now
+    for _name in __all__:
+        __getattr__(_name)
+    del _name
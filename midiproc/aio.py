@@ -0,0 +1,239 @@
+"""
+asyncio runtime for midiproc pipelines (Python 3.5+)
+
+The sources in co_util and processors each block in their own loop, so a
+process can only serve one of them. The sources here are asyncio
+coroutines reading from non-blocking file descriptors and sockets, so
+any number of pipelines can share one event loop. Everything after the
+source is an ordinary @coroutine stage, called synchronously from the
+loop's callbacks exactly as it would be from a blocking source.
+
+    >>> import functools
+    >>> from midiproc import aio, midi_in_chunks, hex_print
+    >>> aio.run(
+    ...     [functools.partial(aio.net_source, ('localhost', 4455)),
+    ...      midi_in_chunks, hex_print],
+    ...     [functools.partial(aio.net_source, ('localhost', 4456)),
+    ...      midi_in_chunks, hex_print])   # doctest: +SKIP
+"""
+
+import asyncio
+import os
+import socket
+
+from .device import open_device
+from .net import FrameError, LengthFramer
+
+# the loop running the calling coroutine (get_event_loop returns the
+# same thing from inside one on Python < 3.7)
+_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+def _bytewise(target):
+    # for stages such as midi_in_stream which expect one byte per send()
+    class _Bytewise(object):
+        def send(self, data):
+            for i in range(len(data)):
+                target.send(data[i:i + 1])
+
+        def close(self):
+            target.close()
+    return _Bytewise()
+
+
+async def fd_source(source, target, chunk_size=4096, per_byte=False):
+    """
+    read from a file descriptor (or an object with fileno()) whenever
+    the event loop reports it readable, sending each chunk to target.
+    Returns at EOF. With per_byte, data is sent one byte at a time. The
+    descriptor is non-blocking while it is read, and set back as it was
+    on return.
+    """
+    fd = source if isinstance(source, int) else source.fileno()
+    if per_byte:
+        target = _bytewise(target)
+    blocking = os.get_blocking(fd)
+    os.set_blocking(fd, False)
+    loop = _running_loop()
+    done = loop.create_future()
+
+    def readable():
+        try:
+            data = os.read(fd, chunk_size)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            if not done.done():
+                done.set_exception(exc)
+            return
+        if not data:
+            if not done.done():
+                done.set_result(None)
+            return
+        target.send(data)
+
+    loop.add_reader(fd, readable)
+    try:
+        await done
+    finally:
+        loop.remove_reader(fd)
+        if blocking:
+            try:
+                os.set_blocking(fd, True)
+            except OSError:
+                # closed by the pipeline
+                pass
+
+
+async def poll_source(device, target, interval=0.001, chunk_size=4096,
+                      stop=None):
+    """
+    for devices without a pollable descriptor (e.g. pylibftdi), whose
+    read() returns immediately: poll every `interval` seconds, until
+    stop() returns true or the task is cancelled. The device is left
+    open for the caller (see midi_in_ftdi).
+    """
+    while stop is None or not stop():
+        data = device.read(chunk_size)
+        if data:
+            target.send(data)
+            # a busy device mustn't starve the other pipelines
+            await asyncio.sleep(0)
+        else:
+            await asyncio.sleep(interval)
+
+
+class _DatagramSource(asyncio.DatagramProtocol):
+    def __init__(self, target, done):
+        self.target = target
+        self.done = done
+
+    def datagram_received(self, data, addr):
+        self.target.send(data)
+
+    def error_received(self, exc):
+        if not self.done.done():
+            self.done.set_exception(exc)
+
+    def connection_lost(self, exc):
+        if not self.done.done():
+            self.done.set_result(None)
+
+
+class _StreamSource(asyncio.Protocol):
+    # one TCP client, sending length-prefixed messages
+    def __init__(self, target, clients):
+        self.framer = LengthFramer(target)
+        self.clients = clients
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.clients.add(transport)
+
+    def data_received(self, data):
+        try:
+            self.framer.send(data)
+        except FrameError:
+            # a bad length: drop this client, keep serving the others
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        self.clients.discard(self.transport)
+
+
+async def net_source(addr, target, proto='udp'):
+    """
+    receive messages on addr, sending each one to target: one per
+    datagram for UDP, or length-prefixed (as net.send_framed writes)
+    from any number of clients for TCP. Runs until cancelled, or for
+    UDP until the endpoint is lost.
+    """
+    loop = _running_loop()
+    done = loop.create_future()
+    if proto == 'tcp':
+        clients = set()
+        server = await loop.create_server(
+            lambda: _StreamSource(target, clients), addr[0], addr[1],
+            family=socket.AF_INET, reuse_address=True)
+        try:
+            await done
+        finally:
+            server.close()
+            for transport in list(clients):
+                transport.close()
+        return
+    if proto != 'udp':
+        raise ValueError('unknown protocol %r' % proto)
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: _DatagramSource(target, done), local_addr=addr,
+        family=socket.AF_INET)
+    try:
+        await done
+    finally:
+        transport.close()
+
+
+async def file_source(path, target, chunk_size=65536, per_byte=False):
+    """
+    send the contents of a file in chunks, yielding to the event loop
+    between chunks. Regular files are always readable, so they can't be
+    waited on like a device; the target is closed at EOF.
+    """
+    if per_byte:
+        target = _bytewise(target)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            target.send(data)
+            await asyncio.sleep(0)
+    target.close()
+
+
+async def midi_in_snddev(target, dev_name=None, per_byte=False):
+    with open_device('snddev', dev_name) as dev:
+        await fd_source(dev, target, per_byte=per_byte)
+
+
+async def midi_in_ftdi(target, stop=None):
+    dev = open_device('ftdi')
+    try:
+        await poll_source(dev, target, stop=stop)
+    finally:
+        dev.close()
+
+
+def chain(iterable):
+    """
+    as processors.chain, but the first entry must be one of the async
+    sources above; returns the source coroutine for the event loop to run.
+    """
+    iterable = list(iterable)
+    result = None
+    for fn in reversed(iterable[1:]):
+        result = fn(result) if result is not None else fn()
+    return iterable[0](result)
+
+
+def start(pipeline):
+    "schedule a pipeline on the running event loop, returning its task"
+    return asyncio.ensure_future(chain(pipeline))
+
+
+def run(*pipelines):
+    """
+    run any number of pipelines on one new event loop until they have
+    all finished (or the loop is interrupted).
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_gather(pipelines))
+    finally:
+        loop.close()
+
+
+async def _gather(pipelines):
+    # gathered inside the new loop; outside it, gather() would take up
+    # whatever loop get_event_loop() returns
+    return await asyncio.gather(*[chain(p) for p in pipelines])
@@ -0,0 +1,262 @@
+"""
+array-backed batches of channel messages
+
+A MessageBatch holds N channel messages as four parallel arrays (status,
+data1, data2, timestamp) so a whole run of messages moves through a chain
+as a single object, rather than one freshly built string per message.
+
+Batch-aware stages test for a MessageBatch with isinstance() and handle
+the whole batch in one go; anything else they receive is treated as a
+single message as before, so batches and plain messages can share the
+same chain.
+"""
+
+from array import array
+from itertools import compress
+
+RECORD_SIZE = 3
+
+# array.tostring() was renamed tobytes() in Python 3
+_tobytes = getattr(array, 'tobytes', None) or array.tostring
+
+
+def _byte_array(values):
+    # going via bytearray is much quicker than array('B', iterator)
+    return array('B', bytearray(values))
+
+
+def is_two_byte(status):
+    "program change and channel pressure carry only one data byte"
+    return 0xC0 <= status <= 0xDF
+
+
+class MessageView(object):
+    """
+    A lightweight view onto a single message in a MessageBatch. Holds
+    only a reference to the batch and an index; fields are read from
+    (and written to) the batch arrays.
+    """
+
+    __slots__ = ('batch', 'index')
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    def _get_status(self):
+        return self.batch.status[self.index]
+
+    def _set_status(self, value):
+        self.batch.status[self.index] = value
+    status = property(_get_status, _set_status)
+
+    def _get_data1(self):
+        return self.batch.data1[self.index]
+
+    def _set_data1(self, value):
+        self.batch.data1[self.index] = value
+    data1 = property(_get_data1, _set_data1)
+
+    def _get_data2(self):
+        return self.batch.data2[self.index]
+
+    def _set_data2(self, value):
+        self.batch.data2[self.index] = value
+    data2 = property(_get_data2, _set_data2)
+
+    def _get_timestamp(self):
+        return self.batch.timestamp[self.index]
+
+    def _set_timestamp(self, value):
+        self.batch.timestamp[self.index] = value
+    timestamp = property(_get_timestamp, _set_timestamp)
+
+    @property
+    def channel(self):
+        return self.status & 0x0F
+
+    @property
+    def command(self):
+        return self.status & 0xF0
+
+    def to_bytes(self):
+        "the message as it would appear on the wire"
+        batch, i = self.batch, self.index
+        status = batch.status[i]
+        if is_two_byte(status):
+            return bytes(bytearray((status, batch.data1[i])))
+        return bytes(bytearray((status, batch.data1[i], batch.data2[i])))
+    __bytes__ = to_bytes
+
+    def __len__(self):
+        return 2 if is_two_byte(self.batch.status[self.index]) else 3
+
+    def __repr__(self):
+        return '<MessageView %s @ %r>' % (
+            ' '.join('%02X' % c for c in bytearray(self.to_bytes())),
+            self.timestamp)
+
+
+class MessageBatch(object):
+    """
+    N channel messages in parallel fixed-width arrays.
+
+    >>> b = MessageBatch.from_messages([b'\\x90\\x3c\\x64', b'\\xc0\\x05'])
+    >>> len(b), b[1].status, b[1].data1
+    (2, 192, 5)
+    >>> b.to_bytes() == b'\\x90\\x3c\\x64\\xc0\\x05'
+    True
+    """
+
+    __slots__ = ('status', 'data1', 'data2', 'timestamp')
+
+    def __init__(self, status=None, data1=None, data2=None, timestamp=None):
+        self.status = array('B') if status is None else status
+        self.data1 = array('B') if data1 is None else data1
+        self.data2 = array('B') if data2 is None else data2
+        if timestamp is None:
+            timestamp = array('d', [0.0]) * len(self.status)
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_packed(cls, packed, timestamp=0.0):
+        """
+        build a batch from a buffer of packed (status, data1, data2)
+        records, as produced by StreamParser. Every message gets the
+        same timestamp.
+        """
+        if not isinstance(packed, (bytes, bytearray)):
+            packed = bytes(packed)
+        # one strided copy per column, straight into its array
+        return cls(array('B', packed[0::RECORD_SIZE]),
+                   array('B', packed[1::RECORD_SIZE]),
+                   array('B', packed[2::RECORD_SIZE]),
+                   array('d', [timestamp]) * (len(packed) // RECORD_SIZE))
+
+    @classmethod
+    def from_messages(cls, messages, timestamp=0.0):
+        "build a batch from an iterable of two- or three-byte messages"
+        batch = cls()
+        for msg in messages:
+            msg = bytearray(msg)
+            batch.append(msg[0], msg[1], msg[2] if len(msg) > 2 else 0,
+                         timestamp)
+        return batch
+
+    def append(self, status, data1, data2=0, timestamp=0.0):
+        self.status.append(status)
+        self.data1.append(data1)
+        self.data2.append(data2)
+        self.timestamp.append(timestamp)
+
+    def extend(self, other):
+        "append all the messages of another batch"
+        self.status.extend(other.status)
+        self.data1.extend(other.data1)
+        self.data2.extend(other.data2)
+        self.timestamp.extend(other.timestamp)
+
+    def select(self, indices):
+        "a new batch holding the messages at the given indices, in order"
+        indices = list(indices)
+        return MessageBatch(
+            _byte_array(map(self.status.__getitem__, indices)),
+            _byte_array(map(self.data1.__getitem__, indices)),
+            _byte_array(map(self.data2.__getitem__, indices)),
+            array('d', map(self.timestamp.__getitem__, indices)))
+
+    def slice(self, start, stop):
+        "a new batch holding messages start..stop-1"
+        return MessageBatch(self.status[start:stop], self.data1[start:stop],
+                            self.data2[start:stop],
+                            self.timestamp[start:stop])
+
+    def compress(self, mask):
+        "a new batch holding the messages whose mask entry is true"
+        if isinstance(mask, bytearray) and mask.count(0) * 8 < len(mask):
+            return self._drop_few(mask)
+        if not isinstance(mask, (bytearray, list)):
+            mask = list(mask)
+        return MessageBatch(_byte_array(compress(self.status, mask)),
+                            _byte_array(compress(self.data1, mask)),
+                            _byte_array(compress(self.data2, mask)),
+                            array('d', compress(self.timestamp, mask)))
+
+    def _drop_few(self, mask):
+        # copy the runs between the (few) zeros of a bytearray mask as
+        # slices, rather than testing every message
+        runs = []
+        find = mask.find
+        start = 0
+        n = len(mask)
+        while start < n:
+            stop = find(b'\x00', start)
+            if stop < 0:
+                stop = n
+            if stop > start:
+                runs.append((start, stop))
+            start = stop + 1
+        columns = []
+        for col in (self.status, self.data1, self.data2, self.timestamp):
+            out = array(col.typecode)
+            extend = out.extend
+            for start, stop in runs:
+                extend(col[start:stop])
+            columns.append(out)
+        return MessageBatch(*columns)
+
+    def __reduce__(self):
+        return (MessageBatch, (self.status, self.data1, self.data2,
+                               self.timestamp))
+
+    def __len__(self):
+        return len(self.status)
+
+    def __bool__(self):
+        return len(self.status) > 0
+    __nonzero__ = __bool__
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.status)
+        if not 0 <= index < len(self.status):
+            raise IndexError('MessageBatch index out of range')
+        return MessageView(self, index)
+
+    def __iter__(self):
+        for i in range(len(self.status)):
+            yield MessageView(self, i)
+
+    def packed(self):
+        "the batch as a bytearray of fixed-width 3-byte records"
+        out = bytearray(len(self.status) * RECORD_SIZE)
+        out[0::RECORD_SIZE] = _tobytes(self.status)
+        out[1::RECORD_SIZE] = _tobytes(self.data1)
+        out[2::RECORD_SIZE] = _tobytes(self.data2)
+        return out
+
+    def to_bytes(self):
+        """
+        the batch as a raw MIDI byte stream: every message carries its
+        status byte and two-byte messages lose their padding.
+        """
+        out = self.packed()
+        status = self.status
+        if any(is_two_byte(s) for s in status):
+            out = bytearray().join(
+                out[i:i + 2] if is_two_byte(status[n]) else out[i:i + 3]
+                for n, i in enumerate(range(0, len(out), RECORD_SIZE)))
+        return bytes(out)
+
+    def iter_bytes(self):
+        "yield each message as a separate bytes object"
+        for i in range(len(self.status)):
+            yield MessageView(self, i).to_bytes()
+
+    def __repr__(self):
+        return '<MessageBatch of %d>' % len(self.status)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,958 @@
+"""
+benchmark harness
+
+Reproducible throughput benchmarks over synthetic data (dense notes,
+heavy running status, sysex dumps, clock floods, multi-track SMFs) for
+the sources, parsers, filters and sinks of the package, using in-memory,
+temporary file and loopback stand-ins for devices.
+
+    python -m midiproc.bench                      # run everything
+    python -m midiproc.bench -k parse -k smf      # only matching groups
+    python -m midiproc.bench --save base.json     # record a baseline
+    python -m midiproc.bench --compare base.json  # flag regressions
+
+With --compare, any benchmark whose rate falls by more than --threshold
+(default 20%) against the saved run is reported, and the exit status
+is non-zero.
+"""
+
+import json
+import multiprocessing
+import optparse
+import os
+import platform
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from .co_util import NullSink, broadcast, iter_source, file_source, \
+    file_sink, net_source, net_sink
+from .processors import midi_in_stream, drop_off, harmonize, \
+    process_smf_track
+from .stream import StreamParser, midi_in_chunks
+from .smf import MidiFile, SMFReader, read_smf
+from .cache import SMFCache
+from .render import render, encode_smf
+from .parallel import Executor
+from .device import DeviceReader, pipe_device
+from .mapped import MappedFile, mapped_source
+from .capture import CaptureSink, CaptureReader
+from .ring import RingBuffer, decoupled, BLOCK
+from .realtime import RealtimeDemux, ClockTracker
+from .output import OutputSink
+from .graph import Graph
+from .lut import Transform, transposition, split, chord
+from .notes import NoteTracker, NoteGuard
+from .processors import midi_writer
+from .net import FramedSink, Deframer, recv_frames, clock, sockets
+from . import vector
+
+# name -> (seconds, count, unit) for everything report()ed in this run
+RESULTS = {}
+
+
+def note_stream(count, seed=0):
+    """
+    synthetic raw MIDI stream of `count` note on/off messages, using
+    running status for roughly half of them and with occasional realtime
+    clock bytes interleaved.
+    """
+    rnd = random.Random(seed)
+    out = bytearray()
+    rstat = 0
+    for i in range(count):
+        status = rnd.choice((0x80, 0x90)) | rnd.randrange(16)
+        if status != rstat or rnd.random() < 0.5:
+            out.append(status)
+            rstat = status
+        out.append(rnd.randrange(128))
+        out.append(rnd.randrange(128))
+        if i % 24 == 0:
+            out.append(0xF8)
+    return bytes(out)
+
+
+def _vlq(value):
+    out = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        out.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(out)
+
+
+def running_status_stream(count, seed=0):
+    "`count` note messages on one channel, all after a single status byte"
+    rnd = random.Random(seed)
+    out = bytearray((0x90,))
+    for i in range(count):
+        out.append(rnd.randrange(128))
+        out.append(rnd.randrange(128) if i % 2 else 0)
+    return bytes(out)
+
+
+def sysex_stream(dumps=4, size=256 * 1024, seed=0):
+    "`dumps` sysex messages of `size` data bytes, with a note between each"
+    rnd = random.Random(seed)
+    out = bytearray()
+    for _ in range(dumps):
+        out += b'\xf0\x43\x00'
+        out += bytearray(rnd.randrange(128) for _ in range(size))
+        out += b'\xf7\x90\x3c\x64'
+    return bytes(out)
+
+
+def clock_flood(count, seed=0):
+    """
+    `count` realtime bytes (mostly clock, some active sensing) with a
+    note message every 24 clocks
+    """
+    rnd = random.Random(seed)
+    out = bytearray()
+    for i in range(count):
+        out.append(0xFE if rnd.random() < 0.05 else 0xF8)
+        if i % 24 == 0:
+            out += bytearray((0x90, rnd.randrange(128), 0x40))
+    return bytes(out)
+
+
+def smf_file(tracks=8, events=10000, seed=0, division=480, fmt=1,
+             max_delta=None):
+    """
+    synthetic Standard MIDI File. Format 1: a tempo track followed by
+    `tracks` note tracks of `events` messages each, mostly in running
+    status. Format 0: a single track of `events` messages starting with
+    a tempo event. Deltas are random below max_delta (default half a
+    beat); max_delta=0 gives a file with every event at tick 0.
+    """
+    rnd = random.Random(seed)
+    if max_delta is None:
+        max_delta = division // 2
+    chunks = []
+    tempo = bytearray()
+    for i in range(16 if fmt else 1):
+        tempo += _vlq(division * 4 if i else 0)
+        tempo += b'\xff\x51\x03' + struct.pack('>I', rnd.randrange(
+            300000, 700000))[1:]
+    if fmt:
+        tempo += b'\x00\xff\x2f\x00'
+        chunks.append(bytes(tempo))
+    for t in range(tracks if fmt else 1):
+        body = bytearray() if fmt else tempo
+        body += b'\x00\xff\x03\x05track'
+        body += _vlq(0) + bytearray((0x90 | (t & 15),))
+        for i in range(events):
+            if i:
+                body += _vlq(rnd.randrange(max_delta) if max_delta else 0)
+            body.append(rnd.randrange(128))
+            body.append(rnd.randrange(128) if i % 2 else 0)
+        body += b'\x00\xff\x2f\x00'
+        chunks.append(bytes(body))
+    return b'MThd' + struct.pack('>IHHH', 6, fmt, len(chunks), division) + \
+        b''.join(b'MTrk' + struct.pack('>I', len(c)) + c for c in chunks)
+
+
+class collect(object):
+    "sink appending everything sent to it onto a list"
+
+    def __init__(self, out):
+        self.send = out.append
+
+    def close(self):
+        pass
+
+
+class counter(object):
+    "sink counting the messages sent to it"
+
+    def __init__(self):
+        self.count = 0
+
+    def send(self, rx):
+        self.count += len(rx) if hasattr(rx, 'timestamp') else 1
+
+    def close(self):
+        pass
+
+
+def timeit(fn, repeat=3):
+    "best wall-clock time of `repeat` calls to fn()"
+    best = None
+    for _ in range(repeat):
+        start = clock()
+        fn()
+        elapsed = clock() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def report(name, seconds, count, unit='bytes'):
+    seconds = max(seconds, 1e-9)
+    RESULTS[name] = (seconds, count, unit)
+    print('%-40s %9.3f ms  %12.0f %s/s' % (name, seconds * 1e3,
+                                            count / seconds, unit))
+
+
+def _datasets():
+    return (('notes', note_stream(100000)),
+            ('running status', running_status_stream(100000)),
+            ('sysex', sysex_stream()),
+            ('clock flood', clock_flood(200000)))
+
+
+def import_times(code):
+    """
+    run code in a fresh interpreter under -X importtime (Python 3.7+),
+    returning (seconds, modules): the cumulative time of the imports the
+    code itself caused, and [(self seconds, name)] for each module those
+    imports loaded.
+    """
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in (root, env.get('PYTHONPATH')) if p)
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', code],
+                            env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    _, err = proc.communicate()
+    if proc.returncode:
+        raise RuntimeError(err.decode('utf-8', 'replace'))
+    total = 0
+    modules = []
+    started = False
+    for line in err.decode('ascii', 'replace').splitlines():
+        fields = line.split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        own = int(fields[0].split(':')[1])
+        name = fields[2].rstrip()
+        top = len(name) - len(name.lstrip()) <= 1
+        name = name.strip()
+        # lines before the first of ours are interpreter startup
+        started = started or name.split('.')[0] == 'midiproc'
+        if not started:
+            continue
+        modules.append((own / 1e6, name))
+        if top:
+            total += int(fields[1])
+    return total / 1e6, modules
+
+
+def bench_startup(repeat=5):
+    "import time of the package in a fresh interpreter, via -X importtime"
+    if sys.version_info < (3, 7):
+        print('startup: needs python -X importtime (3.7+)')
+        return
+    cases = (('startup: import midiproc', 'import midiproc'),
+             ('startup: a processors chain',
+              'from midiproc import chain, midi_in_chunks, drop_off, '
+              'hex_print'),
+             ('startup: read_smf', 'from midiproc import read_smf'),
+             ('startup: everything', 'from midiproc import *'))
+    for name, code in cases:
+        runs = [import_times(code) for _ in range(repeat)]
+        seconds, modules = min(runs)
+        report(name, seconds, 1, 'imports')
+        heaviest = sorted(modules, reverse=True)[:3]
+        print('    %d modules; heaviest %s' % (len(modules), ', '.join(
+            '%s %.1f ms' % (m, t * 1e3) for t, m in heaviest)))
+
+
+def bench_parse():
+    "per-byte midi_in_stream against the chunked StreamParser"
+    for label, data in _datasets():
+        single = [data[i:i + 1] for i in range(len(data))]
+
+        def per_byte():
+            p = midi_in_stream(NullSink(), NullSink(), counter())
+            send = p.send
+            for b in single:
+                send(b)
+
+        def chunked(batch):
+            def run():
+                p = StreamParser(NullSink(), NullSink(), counter(),
+                                 batch=batch)
+                for i in range(0, len(data), 4096):
+                    p.feed(data[i:i + 4096])
+            return run
+
+        report('midi_in_stream [%s]' % label, timeit(per_byte), len(data))
+        report('StreamParser msg [%s]' % label, timeit(chunked(False)),
+               len(data))
+        report('StreamParser batch [%s]' % label, timeit(chunked(True)),
+               len(data))
+
+
+def bench_realtime():
+    "realtime bytes split out ahead of parsing, into a clock tracker"
+    for label, data in (('clock flood', clock_flood(200000)),
+                        ('sysex', sysex_stream())):
+        chunks = [data[i:i + 4096] for i in range(0, len(data), 4096)]
+
+        def plain():
+            p = StreamParser(NullSink(), counter(), NullSink())
+            for c in chunks:
+                p.feed(c)
+
+        def demuxed():
+            d = RealtimeDemux(ClockTracker(),
+                              StreamParser(NullSink(), None, NullSink()))
+            for c in chunks:
+                d.feed(c, 0.0)
+
+        report('StreamParser with realtime [%s]' % label, timeit(plain),
+               len(data))
+        report('RealtimeDemux + ClockTracker [%s]' % label,
+               timeit(demuxed), len(data))
+
+
+def bench_filters(count=100000):
+    "drop_off -> harmonize, one message per send() against MessageBatch"
+    data = note_stream(count)
+    messages = []
+    StreamParser(collect(messages)).feed(data)
+    batch = StreamParser(batch=True).parse(data)
+
+    def per_message():
+        p = drop_off(harmonize(NullSink()))
+        send = p.send
+        for m in messages:
+            send(m)
+
+    def batched():
+        drop_off(harmonize(NullSink())).send(batch)
+
+    report('drop_off|harmonize (per message)', timeit(per_message),
+           len(messages), 'msgs')
+    report('drop_off|harmonize (batch)', timeit(batched), len(messages),
+           'msgs')
+
+
+def bench_graph(inputs=16, outputs=32, count=4000):
+    """
+    drop_off|harmonize fused and not, alone and between 16 sources
+    merged and 32 sinks fanned out to
+    """
+    messages = []
+    StreamParser(collect(messages)).feed(note_stream(inputs * count))
+
+    def run_chain(fuse_stages):
+        g = Graph()
+        g.source('in', lambda target: iter_source(messages, target))
+        g.stage('notes', drop_off)
+        g.stage('harmony', harmonize)
+        g.sink('out', lambda: collect([]))
+        g.connect('in', 'notes', 'harmony', 'out')
+        g.run(fuse_stages)
+
+    report('drop_off|harmonize (stage per node)',
+           timeit(lambda: run_chain(False)), len(messages), 'msgs')
+    report('drop_off|harmonize (fused)', timeit(lambda: run_chain(True)),
+           len(messages), 'msgs')
+
+    streams = [[] for _ in range(inputs)]
+    for i, out in enumerate(streams):
+        StreamParser(collect(out)).feed(note_stream(count, seed=i))
+    total = sum(len(s) for s in streams)
+
+    def build():
+        g = Graph()
+        g.stage('notes', drop_off)
+        g.stage('harmony', harmonize)
+        g.connect('notes', 'harmony')
+        for i, msgs in enumerate(streams):
+            g.source('in%d' % i, lambda target, msgs=msgs: iter_source(
+                msgs, target))
+            g.connect('in%d' % i, 'notes')
+        for i in range(outputs):
+            g.sink('out%d' % i, lambda: collect([]))
+            g.connect('harmony', 'out%d' % i)
+        return g
+
+    def run_sources(fuse_stages):
+        g = build()
+        targets = g.build(fuse_stages)
+        # sources in turn on this thread, to time the graph not threading
+        for name, target in sorted(targets.items()):
+            g.nodes[name].fn(target)
+
+    report('graph %d->%d (stage per node)' % (inputs, outputs),
+           timeit(lambda: run_sources(False)), total, 'msgs')
+    report('graph %d->%d (fused)' % (inputs, outputs),
+           timeit(lambda: run_sources(True)), total, 'msgs')
+
+
+def bench_lut(count=100000):
+    "lookup-table transforms, per message and over a MessageBatch"
+    data = note_stream(count)
+    messages = []
+    StreamParser(collect(messages)).feed(data)
+    batch = StreamParser(batch=True).parse(data)
+    velocity = [min(127, int(v * 1.5)) for v in range(128)]
+    maps = (('transpose+velocity', dict(notes=transposition(7),
+                                        velocity=velocity)),
+            ('split', dict(notes=split(60, 1, 2))),
+            ('chord', dict(notes=chord())))
+    for name, kwargs in maps:
+        t = Transform(**kwargs)
+        message = t.message
+
+        def per_message():
+            for m in messages:
+                message(m)
+        report('lut %s (per message)' % name, timeit(per_message),
+               len(messages), 'msgs')
+        report('lut %s (batch)' % name, timeit(lambda: t.batch(batch)),
+               len(batch), 'msgs')
+
+
+def bench_notes(count=100000):
+    "note state tracking, and harmonize kept balanced by NoteGuard"
+    data = note_stream(count)
+    messages = []
+    StreamParser(collect(messages)).feed(data)
+    batch = StreamParser(batch=True).parse(data)
+
+    def run(stage, items):
+        def fn():
+            send = stage().send
+            for m in items:
+                send(m)
+        return fn
+
+    report('NoteTracker (per message)',
+           timeit(run(lambda: NoteTracker(NullSink()), messages)),
+           len(messages), 'msgs')
+    report('NoteTracker (batch)',
+           timeit(run(lambda: NoteTracker(NullSink()), [batch])),
+           len(batch), 'msgs')
+    report('NoteGuard harmonize (per message)',
+           timeit(run(lambda: NoteGuard(NullSink(), harmonize), messages)),
+           len(messages), 'msgs')
+
+
+def bench_vector(count=1000000):
+    "pure Python batch stages against their NumPy versions"
+    if vector.numpy is None:
+        print('NumPy not installed - skipping vector benchmarks')
+        return
+    batch = StreamParser(batch=True).parse(note_stream(count))
+    n = len(batch)
+
+    def run(stage):
+        return lambda: stage.send(batch)
+
+    report('drop_off|harmonize (batch, large)',
+           timeit(run(drop_off(harmonize(NullSink())))), n, 'msgs')
+    report('vector drop_off|harmonize',
+           timeit(run(vector.drop_off(vector.harmonize(NullSink())))),
+           n, 'msgs')
+    report('vector transpose',
+           timeit(run(vector.transpose(NullSink(), 7))), n, 'msgs')
+    report('vector remap_channels',
+           timeit(run(vector.remap_channels(NullSink(), {0: 1}))), n, 'msgs')
+    report('vector scale_velocity',
+           timeit(run(vector.scale_velocity(NullSink(), curve=0.7))),
+           n, 'msgs')
+    report('vector key_split',
+           timeit(run(vector.key_split(NullSink(), NullSink()))), n, 'msgs')
+
+
+def bench_smf(tracks=16, events=20000):
+    "whole-file SMF parse, and the per-byte process_smf_track"
+    data = smf_file(tracks, events)
+    report('MidiFile parse (%d tracks)' % (tracks + 1),
+           timeit(lambda: MidiFile(data).seconds), tracks * events, 'events')
+    # every delta is zero so process_smf_track's sleeps are sleep(0)
+    data = smf_file(1, events, fmt=0, max_delta=0)
+    single = [data[i:i + 1] for i in range(len(data))]
+
+    def per_byte():
+        p = process_smf_track(NullSink())
+        send = p.send
+        for b in single:
+            send(b)
+    report('process_smf_track (format 0)', timeit(per_byte), events,
+           'events')
+    report('MidiFile parse (format 0)',
+           timeit(lambda: MidiFile(data).seconds), events, 'events')
+
+
+def bench_smf_reader(tracks=16, events=20000, pieces=100):
+    "one track of a file, and a growing file followed with poll()"
+    data = smf_file(tracks, events)
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'big.mid')
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        def one_track():
+            with SMFReader(path) as r:
+                r.track(tracks // 2)
+        report('SMFReader.track (1 of %d)' % (tracks + 1),
+               timeit(one_track), events, 'events')
+
+        data = smf_file(1, events * 4, fmt=0)
+        step = len(data) // pieces + 1
+
+        def follow():
+            with open(path, 'wb') as f:
+                f.write(data[:14])
+            with SMFReader(path) as r:
+                with open(path, 'ab') as f:
+                    for pos in range(14, len(data), step):
+                        f.write(data[pos:pos + step])
+                        f.flush()
+                        r.poll()
+        report('SMFReader.poll (%d appends)' % pieces, timeit(follow),
+               events * 4, 'events')
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_cache(files=32, tracks=4, events=5000):
+    "loading a corpus of SMFs: parsed each time, then through SMFCache"
+    tmp = tempfile.mkdtemp()
+    try:
+        paths = []
+        for i in range(files):
+            paths.append(os.path.join(tmp, '%d.mid' % i))
+            with open(paths[-1], 'wb') as f:
+                f.write(smf_file(tracks, events, seed=i))
+        directory = os.path.join(tmp, 'cache')
+        total = files * tracks * events
+
+        def load_all(cache=None):
+            for p in paths:
+                read_smf(p, cache=cache).seconds
+
+        report('read_smf (no cache)', timeit(load_all, 1), total, 'events')
+        with SMFCache(directory) as cache:
+            report('SMFCache cold', timeit(lambda: load_all(cache), 1),
+                   total, 'events')
+            report('SMFCache in memory', timeit(lambda: load_all(cache)),
+                   total, 'events')
+
+        def from_disk():
+            with SMFCache(directory) as cache:
+                load_all(cache)
+        report('SMFCache from disk (new process)', timeit(from_disk), total,
+               'events')
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_render(tracks=16, events=20000):
+    "offline render through drop_off|harmonize, and SMF encoding"
+    # about ten minutes of music in one track
+    smf = MidiFile(smf_file(1, 5000, fmt=0))
+    stages = [drop_off, harmonize]
+    report('render (%.0f s of music)' % smf.duration(),
+           timeit(lambda: render(smf, stages)), len(smf.events), 'events')
+    report('render + encode_smf',
+           timeit(lambda: encode_smf(render(smf, stages), smf.division)),
+           len(smf.events), 'events')
+    smf = MidiFile(smf_file(tracks, events))
+    report('encode_smf (%d tracks)' % (tracks + 1),
+           timeit(lambda: encode_smf(smf.events, smf.division)),
+           len(smf.events), 'events')
+
+
+def bench_broadcast(count=100000, targets=8):
+    "broadcast of single messages and of one batch to several sinks"
+    data = note_stream(count)
+    messages = []
+    StreamParser(collect(messages)).feed(data)
+    batch = StreamParser(batch=True).parse(data)
+
+    def per_message():
+        send = broadcast([counter() for _ in range(targets)]).send
+        for m in messages:
+            send(m)
+
+    report('broadcast x%d (per message)' % targets, timeit(per_message),
+           len(messages), 'msgs')
+    report('broadcast x%d (batch)' % targets, timeit(
+        lambda: broadcast([counter() for _ in range(targets)]).send(batch)),
+        len(messages), 'msgs')
+
+
+def bench_files(count=100000):
+    "file_source and file_sink through a temporary file"
+    data = note_stream(count)
+    messages = []
+    StreamParser(collect(messages)).feed(data)
+    batch = StreamParser(batch=True).parse(data)
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'capture.mid')
+
+        def write_messages():
+            sink = file_sink(path)
+            for m in messages:
+                sink.send(m)
+            sink.close()
+
+        report('file_sink (per message)', timeit(write_messages),
+               len(messages), 'msgs')
+        report('file_sink (batch)', timeit(
+            lambda: file_sink(path).send(batch)), len(batch), 'msgs')
+        report('file_source -> midi_in_stream', timeit(
+            lambda: file_source(path, midi_in_stream(NullSink()))),
+            os.path.getsize(path))
+        size = os.path.getsize(path)
+        report('mapped_source -> midi_in_chunks', timeit(
+            lambda: mapped_source(path, midi_in_chunks(NullSink()))), size)
+        report('mapped_source (batch)', timeit(
+            lambda: mapped_source(path, NullSink(), batch=True)), size)
+
+        def seek():
+            with MappedFile(path) as f:
+                for i in range(0, f.events, f.events // 100):
+                    f.seek_event(i)
+        report('MappedFile index + 100 seeks', timeit(seek), size)
+
+        def seek_start():
+            with MappedFile(path) as f:
+                f.seek_event(2000)
+        report('MappedFile first seek (event 2000)', timeit(seek_start), 1,
+               'seeks')
+
+        cap = os.path.join(tmp, 'session.cap')
+
+        def record():
+            sink = CaptureSink(cap)
+            for m in messages:
+                sink.send(m)
+            sink.close()
+        report('CaptureSink (per message)', timeit(record), len(messages),
+               'msgs')
+
+        def replay_all():
+            with CaptureReader(cap) as r:
+                for _ in r.records():
+                    pass
+        report('CaptureReader.records', timeit(replay_all), len(messages),
+               'msgs')
+
+        def seeks():
+            with CaptureReader(cap) as r:
+                step = r.duration / 1000
+                for i in range(1000):
+                    next(r.records(i * step), None)
+        report('CaptureReader 1000 seeks', timeit(seeks), 1000, 'seeks')
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_parallel(files=16, tracks=4, events=10000):
+    "SMF parse + drop_off|harmonize sharded by file over a process pool"
+    tmp = tempfile.mkdtemp()
+    try:
+        paths = []
+        for i in range(files):
+            paths.append(os.path.join(tmp, '%d.mid' % i))
+            with open(paths[-1], 'wb') as f:
+                f.write(smf_file(tracks, events, seed=i))
+        stages = [drop_off, harmonize]
+        cores = multiprocessing.cpu_count()
+        base = None
+        for processes in sorted(set((1, 2, cores))):
+            with Executor(processes) as ex:
+                ex.map_files(stages, paths[:processes])  # warm up the pool
+                elapsed = timeit(lambda: ex.map_files(stages, paths), 1)
+            base = base or elapsed
+            report('Executor.map_files (%d procs, x%.2f)' % (
+                processes, base / elapsed), elapsed,
+                files * tracks * events, 'events')
+    finally:
+        shutil.rmtree(tmp)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def bench_device(count=50000):
+    "read(1) per byte against bulk reads, from a pipe standing in for a port"
+    data = note_stream(count)
+
+    def run(read):
+        dev, write = pipe_device()
+        writer = threading.Thread(target=write, args=(data,))
+        writer.start()
+        start = clock()
+        n = read(dev)
+        elapsed = clock() - start
+        writer.join()
+        dev.close()
+        assert n == len(data)
+        return elapsed
+
+    def per_byte(dev):
+        f = os.fdopen(os.dup(dev), 'rb', 0)
+        n = 0
+        while n < len(data):
+            if f.read(1):
+                n += 1
+        f.close()
+        return n
+
+    def bulk(dev):
+        reader = DeviceReader(dev)
+        while reader.bytes < len(data):
+            reader.read_chunk()
+        return reader.bytes
+
+    report('device read(1)', run(per_byte), len(data))
+    report('DeviceReader', run(bulk), len(data))
+
+
+def bench_ring(count=100000):
+    "messages and chunks through a RingBuffer between two threads"
+    data = note_stream(count)
+    messages = []
+    StreamParser(collect(messages)).feed(data)
+    chunks = [data[i:i + 256] for i in range(0, len(data), 256)]
+
+    def run(items, coalesce):
+        def go():
+            decoupled(lambda sink: iter_source(items, sink), counter(),
+                      coalesce=coalesce, policy=BLOCK)
+        return go
+
+    report('ring (per message)', timeit(run(messages, False)),
+           len(messages), 'msgs')
+    report('ring (coalesced chunks)', timeit(run(chunks, True)), len(data))
+    # a fresh ring for each run, allocated outside the timing
+    rings = [RingBuffer(slots=len(messages)) for _ in range(3)]
+
+    def put_only():
+        put = rings.pop().put
+        for m in messages:
+            put(m)
+    report('RingBuffer.put', timeit(put_only, len(rings)), len(messages),
+           'msgs')
+
+
+def bench_output(count=100000):
+    """
+    midi_writer against OutputSink, writing to the null device (where a
+    write costs next to nothing) and to a raw pty, drained by a thread,
+    which costs about what a serial port does
+    """
+    data = note_stream(count)
+    messages = []
+    StreamParser(collect(messages)).feed(data)
+    batches = [StreamParser(batch=True).parse(data[i:i + 300])
+               for i in range(0, len(data), 300)]
+
+    def run(make, items):
+        def go():
+            with open(os.devnull, 'wb', 0) as dev:
+                sink = make(dev)
+                send = sink.send
+                for m in items:
+                    send(m)
+                sink.close()
+        return go
+
+    def run_pty(make):
+        import tty
+        master, slave = os.openpty()
+        tty.setraw(slave)
+
+        def drain():
+            try:
+                while os.read(slave, 65536):
+                    pass
+            except OSError:
+                pass
+        reader = threading.Thread(target=drain)
+        reader.daemon = True
+        reader.start()
+        dev = os.fdopen(master, 'wb', 0)
+        start = clock()
+        sink = make(dev)
+        send = sink.send
+        for m in messages:
+            send(m)
+        sink.close()
+        elapsed = clock() - start
+        if not dev.closed:
+            dev.close()
+        os.close(slave)
+        return elapsed
+
+    def unbuffered(dev):
+        return OutputSink(dev, tick=0)
+
+    report('midi_writer (per message)', timeit(run(midi_writer, messages)),
+           len(messages), 'msgs')
+    report('OutputSink (per message, 1 ms tick)',
+           timeit(run(OutputSink, messages)), len(messages), 'msgs')
+    report('OutputSink (per message, unbuffered)',
+           timeit(run(unbuffered, messages)), len(messages), 'msgs')
+    report('OutputSink (batch)', timeit(run(OutputSink, batches)),
+           len(messages), 'msgs')
+    report('midi_writer to a pty', run_pty(midi_writer), len(messages),
+           'msgs')
+    report('OutputSink to a pty (1 ms tick)', run_pty(OutputSink),
+           len(messages), 'msgs')
+
+
+def _udp_receiver():
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.bind(('127.0.0.1', 0))
+    rx.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    return rx
+
+
+def bench_net(count=50000):
+    "unframed net_sink -> net_source, one datagram per message"
+    rx = _udp_receiver()
+    addr = rx.getsockname()
+    sockets.adopt(rx, addr)
+    received = counter()
+    last = [0.0]
+
+    class Stop(Exception):
+        pass
+
+    class Until(object):
+        def send(self, data):
+            received.send(data)
+            last[0] = clock()
+            if data == b'\xff':
+                raise Stop()
+
+    def serve():
+        try:
+            net_source(addr, Until())
+        except Stop:
+            pass
+    receiver = threading.Thread(target=serve)
+    receiver.start()
+    sink = net_sink(addr)
+    msg = b'\x90\x3c\x64'
+    start = clock()
+    for i in range(count):
+        sink.send(msg)
+        if i % 64 == 63:
+            time.sleep(0)
+    sink.send(b'\xff')
+    receiver.join(5)
+    sockets.close(addr)
+    report('net_sink -> net_source (UDP)', last[0] - start,
+           received.count - 1, 'msgs')
+
+
+def bench_net_framed(count=200000, max_size=1400, flush_interval=0.001):
+    "framed UDP over loopback: messages/s and latency percentiles"
+    rx = _udp_receiver()
+    latencies = []
+    last = [0.0]
+
+    class Latency(object):
+        def send(self, batch):
+            now = last[0] = clock()
+            latencies.extend(now - t for t in batch.timestamp)
+
+    deframer = Deframer(Latency())
+    receiver = threading.Thread(target=recv_frames,
+                                args=(rx, deframer, 65536, 0.5))
+    receiver.start()
+    sink = FramedSink(rx.getsockname(), max_size, flush_interval)
+    msg = b'\x90\x3c\x64'
+    start = clock()
+    for i in range(count):
+        sink.send(msg)
+        if i % 64 == 63:
+            # pace the sender a little so the loopback queue keeps up
+            time.sleep(0)
+    sink.close()
+    receiver.join()
+    rx.close()
+    report('framed UDP loopback', max(last[0] - start, 1e-9),
+           deframer.stats.messages, 'msgs')
+    print('    %s; latency p50 %.0f us, p99 %.0f us, max %.0f us' % (
+        deframer.stats, percentile(latencies, 50) * 1e6,
+        percentile(latencies, 99) * 1e6, percentile(latencies, 100) * 1e6))
+
+
+BENCHMARKS = [bench_startup, bench_parse, bench_realtime, bench_filters,
+              bench_graph, bench_lut, bench_notes, bench_vector, bench_smf,
+              bench_smf_reader, bench_cache, bench_render, bench_broadcast,
+              bench_files, bench_device, bench_ring, bench_output,
+              bench_net, bench_net_framed,
+              bench_parallel]
+
+
+def save(path):
+    with open(path, 'w') as f:
+        json.dump({'python': platform.python_version(),
+                   'results': dict((name, list(r))
+                                   for name, r in RESULTS.items())},
+                  f, indent=1, sort_keys=True)
+
+
+def compare(path, threshold):
+    """
+    print the change in rate of each benchmark against a saved run,
+    returning the names of any which regressed by more than threshold.
+    """
+    with open(path) as f:
+        baseline = json.load(f)['results']
+    regressions = []
+    print('\n%-40s %10s' % ('compared with ' + path, 'change'))
+    for name in sorted(RESULTS):
+        if name not in baseline:
+            continue
+        seconds, count, _ = RESULTS[name]
+        old_seconds, old_count, _ = baseline[name]
+        ratio = (count / seconds) / (old_count / old_seconds)
+        flag = ''
+        if ratio < 1.0 - threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-40s %+9.1f%%%s' % (name, (ratio - 1.0) * 100, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-k', dest='only', action='append', default=[],
+                      help='run only benchmark groups whose name contains '
+                           'this (may be repeated)')
+    parser.add_option('--save', help='write results to this JSON file')
+    parser.add_option('--compare', help='compare with a saved JSON file')
+    parser.add_option('--threshold', type='float', default=0.2,
+                      help='fractional slowdown counted as a regression')
+    opts, _ = parser.parse_args(argv)
+    for bench in BENCHMARKS:
+        name = bench.__name__[len('bench_'):]
+        if opts.only and not any(k in name for k in opts.only):
+            continue
+        bench()
+    if opts.save:
+        save(opts.save)
+    if opts.compare:
+        if compare(opts.compare, opts.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
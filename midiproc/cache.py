@@ -0,0 +1,349 @@
+"""
+cache of parsed Standard MIDI Files
+
+SMFCache keeps parsed files in a directory as compact binary event
+tables, each named after a hash of the file's contents and the parser
+version, so a file is parsed once however often (and under whatever
+name) it is loaded, and a parser change starts afresh. A cached table
+is loaded by mapping it and copying each column straight into an array
+of the parser's own type, so nothing is parsed, and the MidiFile it
+makes is no different from a freshly parsed one; the mapping is closed
+once it is read.
+
+The hash of each path is remembered along with the file's mtime and
+size, so an unchanged file isn't even read again; a file whose mtime
+or size has changed is hashed again (and parsed again if its contents
+really did change). Entries are dropped least recently used first when
+the directory grows past `budget` bytes, and the loaded files kept in
+memory past `memory_budget`.
+
+    >>> cache = SMFCache('/var/cache/midiproc')          # doctest: +SKIP
+    >>> smf = read_smf('song.mid', cache=cache)          # doctest: +SKIP
+    >>> cache.close()                                    # doctest: +SKIP
+
+Entry layout (native byte order; a cache isn't meant to be shared
+between machines):
+
+    header    magic 'MPEV', entry version, parser version, format,
+              track count, division, event count, tempo change count,
+              payload bytes
+    columns   seconds (f64), tick, offset, length (unsigned long, as
+              in EventTable), track (u16), status, data1, data2 (u8),
+              then (tick, tempo) u32 pairs,
+              then the meta / sysex payloads; each padded to 8 bytes
+"""
+
+from __future__ import with_statement
+
+from array import array
+from collections import OrderedDict
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+from .smf import MidiFile, EventTable, TempoMap, PARSER_VERSION
+
+MAGIC = b'MPEV'
+VERSION = 2
+HEADER = struct.Struct('=4sHHHHHxxIIQ')
+INDEX_NAME = 'index.json'
+SUFFIX = '.mpev'
+# column order in an entry: (name, typecode), the typecodes the parser
+# uses, so that loading a column is a plain copy
+COLUMNS = (('tick', 'L'), ('offset', 'L'), ('length', 'L'),
+           ('track', 'H'), ('status', 'B'), ('data1', 'B'), ('data2', 'B'))
+# array.tostring() was renamed tobytes() in Python 3
+_tobytes = getattr(array, 'tobytes', None) or array.tostring
+if hasattr(array, 'frombytes'):
+    _frombytes = array.frombytes
+else:
+    _frombytes = lambda col, view: col.fromstring(view.tobytes())
+
+
+class CacheError(ValueError):
+    "a damaged or foreign cache entry"
+
+
+def _pad(n):
+    return -n % 8
+
+
+def _column(view, typecode):
+    # a copy of a stored column
+    col = array(typecode)
+    _frombytes(col, view)
+    return col
+
+
+def content_key(data):
+    "the cache key of a file's contents"
+    h = hashlib.sha1(data)
+    return '%s-%d' % (h.hexdigest(), PARSER_VERSION)
+
+
+def write_entry(f, smf):
+    "write a parsed MidiFile to an open file in the entry format"
+    ev = smf.events
+    n = len(ev)
+    # keep only the payloads, not the whole file
+    payload = bytearray()
+    offsets = array('L')
+    data = memoryview(smf.data)
+    for i in range(n):
+        length = ev.length[i]
+        if length:
+            offsets.append(len(payload))
+            payload += data[ev.offset[i]:ev.offset[i] + length]
+        else:
+            offsets.append(0)
+    if len(payload) > 0xFFFFFFFF:
+        raise CacheError('payloads too big to cache')
+    tempo = array('I')
+    tm = smf.tempo_map
+    for tick, value in zip(tm.ticks, tm.tempos):
+        tempo.append(tick)
+        tempo.append(value)
+    f.write(HEADER.pack(MAGIC, VERSION, PARSER_VERSION, smf.format,
+                        smf.ntracks, smf.division, n, len(tempo) // 2,
+                        len(payload)))
+    columns = [array('d', smf.seconds)]
+    for name, typecode in COLUMNS:
+        if name == 'offset':
+            columns.append(offsets)
+        else:
+            columns.append(array(typecode, getattr(ev, name)))
+    columns.append(tempo)
+    for col in columns:
+        raw = _tobytes(col)
+        f.write(raw)
+        f.write(b'\0' * _pad(len(raw)))
+    f.write(bytes(payload))
+
+
+def read_entry(data):
+    """
+    a MidiFile from the bytes (or mapping) of an entry; everything is
+    copied out of data, which can be closed afterwards
+    """
+    if len(data) < HEADER.size:
+        raise CacheError('cache entry too short')
+    magic, version, parser, fmt, ntracks, division, n, ntempo, npayload = \
+        HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION or parser != PARSER_VERSION:
+        raise CacheError('not a current cache entry')
+    view = memoryview(data)
+    pos = HEADER.size
+
+    def take(typecode, count):
+        size = array(typecode).itemsize * count
+        if pos + size > len(data):
+            raise CacheError('cache entry truncated')
+        return _column(view[pos:pos + size], typecode), size + _pad(size)
+
+    try:
+        seconds, size = take('d', n)
+        pos += size
+        events = EventTable()
+        for name, typecode in COLUMNS:
+            col, size = take(typecode, n)
+            pos += size
+            setattr(events, name, col)
+        tempo, size = take('I', ntempo * 2)
+        pos += size
+        if pos + npayload > len(data):
+            raise CacheError('cache entry truncated')
+        events.data = view[pos:pos + npayload].tobytes()
+    finally:
+        # so that a mapping can be closed
+        if hasattr(view, 'release'):
+            view.release()
+    tempo_map = TempoMap(division, zip(tempo[0::2], tempo[1::2]))
+    return MidiFile.from_parsed(events.data, fmt, ntracks, division,
+                                events, tempo_map, seconds)
+
+
+class SMFCache(object):
+    """
+    Parsed SMFs on disk (in `directory`, created if need be) and in
+    memory. load(path) returns a MidiFile. Counters: `hits` (found in
+    memory or on disk), `misses` (parsed) and `hashed` (files read to
+    find their key).
+
+    close() (or leaving a with block) saves the index of paths and
+    entries; without it, the next run hashes the files again.
+    """
+
+    def __init__(self, directory, budget=1 << 30, memory_budget=64 << 20):
+        self.directory = directory
+        self.budget = budget
+        self.memory_budget = memory_budget
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.hits = self.misses = self.hashed = 0
+        self._memory = OrderedDict()  # key -> (MidiFile, size)
+        self._memory_size = 0
+        self._paths = {}  # path -> [mtime_ns, size, key]
+        self._entries = {}  # key -> [size, last used]
+        self._clock = 0
+        self._load_index()
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.directory, INDEX_NAME)) as f:
+                index = json.load(f)
+            if index.get('version') == VERSION:
+                self._paths = index['paths']
+                self._entries = index['entries']
+                self._clock = index['clock']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        # entries written by other processes, or left by a lost index
+        for name in os.listdir(self.directory):
+            key = name[:-len(SUFFIX)]
+            if name.endswith(SUFFIX) and key not in self._entries:
+                size = os.path.getsize(os.path.join(self.directory, name))
+                self._entries[key] = [size, 0]
+        for key in list(self._entries):
+            if not os.path.exists(self._entry_path(key)):
+                del self._entries[key]
+
+    def save(self):
+        "write the index of paths and entries"
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'version': VERSION, 'paths': self._paths,
+                       'entries': self._entries, 'clock': self._clock}, f)
+        os.rename(tmp, os.path.join(self.directory, INDEX_NAME))
+
+    def close(self):
+        self.save()
+        self._memory.clear()
+        self._memory_size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def size(self):
+        "bytes of entries on disk"
+        return sum(e[0] for e in self._entries.values())
+
+    def key(self, path):
+        """
+        the cache key of the file at path, hashing it only if it is new
+        or its mtime or size have changed
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        mtime = getattr(st, 'st_mtime_ns', None) or int(st.st_mtime * 1e9)
+        known = self._paths.get(path)
+        if known is not None and known[0] == mtime and known[1] == st.st_size:
+            return known[2], None
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.hashed += 1
+        key = content_key(data)
+        self._paths[path] = [mtime, st.st_size, key]
+        return key, data
+
+    def load(self, path):
+        "the parsed MidiFile of path, from the cache if possible"
+        key, data = self.key(path)
+        self._clock += 1
+        held = self._memory.pop(key, None)
+        if held is not None:
+            # back in at the most recently used end
+            self._memory[key] = held
+            if key in self._entries:
+                self._entries[key][1] = self._clock
+            self.hits += 1
+            return held[0]
+        smf = None
+        if key in self._entries:
+            try:
+                smf, size = self._map(key)
+                self.hits += 1
+            except (IOError, OSError, CacheError):
+                self._drop(key)
+        if smf is None:
+            if data is None:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            smf = MidiFile(data)
+            size = self._store(key, smf)
+            self.misses += 1
+            # from now on, share the compact form
+            smf, size = self._map(key)
+        self._entries[key][1] = self._clock
+        self._remember(key, smf, size)
+        self._evict()
+        return smf
+
+    def _map(self, key):
+        with open(self._entry_path(key), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                raise CacheError('empty cache entry')
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return read_entry(m), size
+        finally:
+            m.close()
+
+    def _store(self, key, smf):
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            write_entry(f, smf)
+            size = f.tell()
+        # a rename is atomic, so no one maps a half-written entry
+        os.rename(tmp, self._entry_path(key))
+        self._entries[key] = [size, self._clock]
+        return size
+
+    def _remember(self, key, smf, size):
+        self._memory[key] = (smf, size)
+        self._memory_size += size
+        while self._memory_size > self.memory_budget and len(self._memory) > 1:
+            _, (_, old) = self._memory.popitem(last=False)
+            self._memory_size -= old
+
+    def _drop(self, key):
+        self._entries.pop(key, None)
+        held = self._memory.pop(key, None)
+        if held is not None:
+            self._memory_size -= held[1]
+        try:
+            os.remove(self._entry_path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        # least recently used first, never the one just loaded
+        total = self.size
+        if total <= self.budget:
+            return
+        for key in sorted(self._entries, key=lambda k: self._entries[k][1]):
+            if total <= self.budget or self._entries[key][1] == self._clock:
+                break
+            total -= self._entries[key][0]
+            self._drop(key)
+
+    def clear(self):
+        "remove every entry"
+        for key in list(self._entries):
+            self._drop(key)
+        self._paths.clear()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,368 @@
+"""
+timestamped capture and replay
+
+file_sink writes raw bytes, so a recording loses its timing and can
+only be searched from the start. The capture format here keeps an
+arrival time for every message:
+
+    file header:  magic 'MPCAP', version, block size, start time (f64
+                  seconds since the epoch), padded to one block
+    blocks:       base time (f64 seconds from the start), record count,
+                  bytes of records, then records of time offset from
+                  base (u32 microseconds), length (u8, or 255 and a u32)
+                  and message bytes; padded to a whole number of blocks
+    footer:       (time, offset) of every index_every'th block, then
+                  index offset, entry count, end time and magic 'MPIX'
+
+CaptureSink appends messages to a block in memory and writes each block
+as it fills, so recording costs one write per block. CaptureReader maps
+the file and finds the block holding any time by bisecting the index,
+so seeking is O(log n) however long the session. If the footer is
+missing (a recording that didn't close cleanly) the index is rebuilt by
+stepping over block headers.
+
+    >>> chain([midi_in_snddev, midi_in_chunks,
+    ...        lambda: CaptureSink('session.cap')])        # doctest: +SKIP
+    >>> replay_source('session.cap', midi_out_snddev(),
+    ...               start=3600.0)                        # doctest: +SKIP
+"""
+
+from __future__ import with_statement
+
+from array import array
+from bisect import bisect_left
+import mmap
+import os
+import struct
+import time
+
+from .batch import MessageBatch, is_two_byte
+from .scheduler import Scheduler, PlaybackStats, clock
+
+MAGIC = b'MPCAP'
+INDEX_MAGIC = b'MPIX'
+VERSION = 1
+FILE_HEADER = struct.Struct('!5sBId')
+BLOCK_HEADER = struct.Struct('!dHI')
+RECORD = struct.Struct('!IB')
+LONG_LENGTH = struct.Struct('!I')
+INDEX_ENTRY = struct.Struct('!dQ')
+TRAILER = struct.Struct('!QId4s')
+MAX_OFFSET = 0xFFFFFFFF * 1e-6  # the longest a block can span, seconds
+MAX_COUNT = 0xFFFF
+
+
+class CaptureError(ValueError):
+    "not a capture file, or a damaged one"
+
+
+def _padded(size, block_size):
+    return -(-size // block_size) * block_size
+
+
+class CaptureSink(object):
+    """
+    Sink recording every message it is sent, with its arrival time, to
+    a capture file. A MessageBatch is recorded as its messages, all with
+    the time the batch arrived. Times are non-decreasing seconds since
+    the sink was created; close() writes the index.
+    """
+
+    def __init__(self, path, block_size=4096, index_every=8):
+        if block_size < BLOCK_HEADER.size + RECORD.size + 3:
+            raise ValueError('block size %d too small' % block_size)
+        self.path = path
+        self.block_size = block_size
+        self.index_every = index_every
+        self.start_time = time.time()
+        self.messages = 0
+        self.blocks = 0
+        self._f = open(path, 'wb')
+        self._f.write(FILE_HEADER.pack(MAGIC, VERSION, block_size,
+                                       self.start_time).ljust(block_size,
+                                                              b'\0'))
+        self._offset = block_size
+        self._index = []
+        self._start = clock()
+        self._last = 0.0
+        self._buf = bytearray()
+        self._base = 0.0
+        self._count = 0
+
+    def _add(self, t, msg):
+        n = len(msg)
+        size = RECORD.size + n + (LONG_LENGTH.size if n >= 255 else 0)
+        if self._count and (
+                BLOCK_HEADER.size + len(self._buf) + size > self.block_size or
+                self._count == MAX_COUNT or t - self._base >= MAX_OFFSET):
+            self._write_block()
+        if not self._count:
+            self._base = t
+        buf = self._buf
+        us = int((t - self._base) * 1e6)
+        if n < 255:
+            buf += RECORD.pack(us, n)
+        else:
+            buf += RECORD.pack(us, 255)
+            buf += LONG_LENGTH.pack(n)
+        buf += msg
+        self._count += 1
+
+    def send(self, rx):
+        t = clock() - self._start
+        if t < self._last:
+            t = self._last
+        self._last = t
+        if isinstance(rx, MessageBatch):
+            add = self._add
+            for msg in rx.iter_bytes():
+                add(t, msg)
+            self.messages += len(rx)
+        else:
+            self._add(t, rx)
+            self.messages += 1
+
+    def _write_block(self):
+        if not self._count:
+            return
+        size = BLOCK_HEADER.size + len(self._buf)
+        if self.blocks % self.index_every == 0:
+            self._index.append((self._base, self._offset))
+        block = BLOCK_HEADER.pack(self._base, self._count, len(self._buf)) + \
+            bytes(self._buf)
+        padded = _padded(size, self.block_size)
+        self._f.write(block + b'\0' * (padded - size))
+        self._offset += padded
+        self.blocks += 1
+        del self._buf[:]
+        self._count = 0
+
+    def flush(self):
+        "write out the current block, even if it is not yet full"
+        self._write_block()
+        self._f.flush()
+
+    def close(self):
+        if self._f is None:
+            return
+        self._write_block()
+        f = self._f
+        for entry in self._index:
+            f.write(INDEX_ENTRY.pack(*entry))
+        f.write(TRAILER.pack(self._offset, len(self._index), self._last,
+                             INDEX_MAGIC))
+        f.close()
+        self._f = None
+
+
+class CaptureReader(object):
+    """
+    Read a capture file through a memory map.
+
+    records() yields (time, message) pairs, each message a memoryview
+    into the mapping; batches() yields the channel messages of each
+    block as a MessageBatch, with other messages (realtime, sysex)
+    left out. Both can start from any time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < FILE_HEADER.size:
+                raise CaptureError('%s: too short for a capture' % path)
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self.data = self._mmap
+        magic, version, self.block_size, self.start_time = \
+            FILE_HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise CaptureError('%s: not a capture file' % path)
+        self.complete = self._read_index()
+        if not self.complete:
+            self._rebuild_index()
+
+    def _read_index(self):
+        data = self.data
+        if len(data) < self.block_size + TRAILER.size:
+            return False
+        end = len(data) - TRAILER.size
+        offset, count, self.end_time, magic = TRAILER.unpack_from(data, end)
+        if magic != INDEX_MAGIC or \
+                offset + count * INDEX_ENTRY.size != end:
+            return False
+        self._blocks_end = offset
+        self.index_times = array('d')
+        self.index_offsets = array('L')
+        for i in range(count):
+            t, off = INDEX_ENTRY.unpack_from(data,
+                                             offset + i * INDEX_ENTRY.size)
+            self.index_times.append(t)
+            self.index_offsets.append(off)
+        return True
+
+    def _rebuild_index(self):
+        # no footer: index every block that is whole
+        self.index_times = array('d')
+        self.index_offsets = array('L')
+        self._blocks_end = len(self.data)
+        self.end_time = 0.0
+        end = self.block_size
+        for offset, base, count, used in self._blocks(self.block_size):
+            self.index_times.append(base)
+            self.index_offsets.append(offset)
+            end = offset + _padded(BLOCK_HEADER.size + used, self.block_size)
+            for t, _ in self._block_records(offset, base, count):
+                self.end_time = t
+        self._blocks_end = end
+
+    def close(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # records are still in use; the mapping goes with them
+                pass
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def duration(self):
+        return self.end_time
+
+    def _blocks(self, offset):
+        data = self.data
+        end = self._blocks_end
+        block_size = self.block_size
+        while offset + BLOCK_HEADER.size <= end:
+            base, count, used = BLOCK_HEADER.unpack_from(data, offset)
+            if not count or offset + BLOCK_HEADER.size + used > end:
+                return
+            yield offset, base, count, used
+            offset += _padded(BLOCK_HEADER.size + used, block_size)
+
+    def _block_records(self, offset, base, count):
+        data = self.data
+        view = memoryview(data)
+        pos = offset + BLOCK_HEADER.size
+        unpack = RECORD.unpack_from
+        for _ in range(count):
+            us, n = unpack(data, pos)
+            pos += RECORD.size
+            if n == 255:
+                (n,) = LONG_LENGTH.unpack_from(data, pos)
+                pos += LONG_LENGTH.size
+            yield base + us * 1e-6, view[pos:pos + n]
+            pos += n
+
+    def seek(self, start):
+        "offset of the block holding the first message at or after start"
+        if not self.index_offsets:
+            return self.block_size
+        # the last indexed block starting before start: one starting at
+        # start may follow messages stamped start at the end of the last
+        i = max(bisect_left(self.index_times, start) - 1, 0)
+        # step over the (at most index_every) block headers up to start
+        offset = self.index_offsets[i]
+        for block, base, _, _ in self._blocks(offset):
+            if base >= start:
+                break
+            offset = block
+        return offset
+
+    def records(self, start=0.0, end=None):
+        "(time, message) for each message from start until before end"
+        for offset, base, count, _ in self._blocks(self.seek(start)):
+            if end is not None and base >= end:
+                return
+            for t, msg in self._block_records(offset, base, count):
+                if t < start:
+                    continue
+                if end is not None and t >= end:
+                    return
+                yield t, msg
+
+    def batches(self, start=0.0, end=None):
+        "the channel messages from start until before end, by block"
+        for offset, base, count, _ in self._blocks(self.seek(start)):
+            if end is not None and base >= end:
+                return
+            out = MessageBatch()
+            append = out.append
+            for t, msg in self._block_records(offset, base, count):
+                if t < start or (end is not None and t >= end):
+                    continue
+                n = len(msg)
+                status = bytearray(msg[:1])[0] if n else 0
+                if 0x80 <= status < 0xF0 and \
+                        n == (2 if is_two_byte(status) else 3):
+                    msg = bytearray(msg)
+                    append(status, msg[1], msg[2] if n == 3 else 0, t)
+            if out:
+                yield out
+
+
+def replay_source(path, target, start=0.0, end=None, speed=1.0, batch=False,
+                  spin=0.002, lead=0.01):
+    """
+    play a capture to target with its original timing (scaled by speed),
+    from time `start` in the recording. Messages recorded together are
+    sent together: as a MessageBatch of their channel messages with
+    batch set (any others following as bytes), or one by one as bytes.
+    The target is closed at the end; returns PlaybackStats.
+    """
+    sched = Scheduler(target, spin=spin)
+    stats = PlaybackStats(sched.late_threshold)
+    send = target.send
+    speed = float(speed)
+    with CaptureReader(path) as reader:
+        t0 = clock() + lead
+        group = []
+        group_t = None
+        for t, msg in reader.records(start, end):
+            if group and t != group_t:
+                _replay_group(sched, stats, send, group,
+                              t0 + (group_t - start) / speed, batch)
+                group = []
+            group_t = t
+            group.append(bytes(msg))
+        if group:
+            _replay_group(sched, stats, send, group,
+                          t0 + (group_t - start) / speed, batch)
+    target.close()
+    return stats
+
+
+def _replay_group(sched, stats, send, group, deadline, batch):
+    sched.wait_until(deadline)
+    stats.record(clock() - deadline, len(group))
+    if not batch:
+        for msg in group:
+            send(msg)
+        return
+    out = MessageBatch()
+    others = []
+    for msg in group:
+        b = bytearray(msg)
+        n = len(b)
+        if n and 0x80 <= b[0] < 0xF0 and n == (2 if is_two_byte(b[0]) else 3):
+            out.append(b[0], b[1], b[2] if n == 3 else 0)
+        else:
+            others.append(msg)
+    if out:
+        send(out)
+    for msg in others:
+        send(msg)
+
+
+def capture_sink(path, **kwargs):
+    return CaptureSink(path, **kwargs)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -7,10 +7,20 @@ References:
 
 from __future__ import with_statement
 
+import functools
+
+# package-relative imports are made inside the functions which need
+# them, so that this module still runs on its own for its doctests
+
+
 def coroutine(func):
     """
     prime the coroutine. Based on [dabeaz].
+
+    The wrapper takes the name of the generator function, so decorated
+    stages can still be pickled by reference (e.g. for a process pool).
     """
+    @functools.wraps(func)
     def start(*args,**kwargs):
         cr = func(*args,**kwargs)
         if hasattr(cr, '__next__'):
@@ -71,52 +81,75 @@ def broadcast(targets):
         for t in targets:
             t.send(rx)
 
-def net_source(addr, target):
-    # basic UDP
-    import socket
-    try:
-        s = net_source._socket
-    except AttributeError:
-        s = net_source._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind(addr) # TODO: have a mapping addr -> socket
+def net_source(addr, target, proto='udp'):
+    """
+    receive messages on addr: one per datagram for UDP, or
+    length-prefixed messages from any number of clients for TCP.
+    The bound socket is kept in net.sockets, keyed by protocol and
+    address, so later calls for the same endpoint reuse it.
+    """
+    from .net import sockets, tcp_serve
+    s = sockets.listener(addr, proto)
+    if proto == 'tcp':
+        tcp_serve(s, target)
+        return
     while True:
-        # XXX: what is the equivalent of having a loop
-        # and break on recv() returning null for TCP?
-        # do we simply lose anything over (buflen) bytes
-        # on a UDP recv?
-        rx = s.recv(8192)
+        # anything over 64K in one datagram is truncated by UDP anyway
+        rx = s.recv(65536)
         target.send(rx)
 
 @coroutine
-def net_sink(addr):
+def net_sink(addr, proto='udp'):
+    "send each message to addr, with a length prefix over TCP"
     import socket
-    try:
-        s = net_sink._socket
-    except AttributeError:
-        s = net_sink._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    from .batch import MessageBatch
+    from .net import sockets, send_framed
+    s = sockets.sender(addr, proto)
     while True:
         data = (yield)
-        s.sendto(data, addr)
+        if isinstance(data, MessageBatch):
+            data = data.to_bytes()
+        if proto == 'tcp':
+            try:
+                send_framed(s, data)
+            except socket.error:
+                # reconnect once on a dropped connection
+                sockets.discard(s)
+                s = sockets.sender(addr, proto)
+                send_framed(s, data)
+        else:
+            s.sendto(data, addr)
 
 
-def file_source(path, target):
-    with open(path) as f:
+def file_source(path, target, chunk_size=65536, per_byte=True):
+    """
+    send a file a byte at a time (for midi_in_stream), or in chunks of
+    up to chunk_size bytes with per_byte false (for midi_in_chunks);
+    mapped.mapped_source can also start at an event
+    """
+    with open(path, 'rb') as f:
         while True:
             try:
-                c = f.read(1)
-                if c == '':
-                    break
-                target.send(c)
+                data = f.read(chunk_size)
             except IOError:
                 break
+            if not data:
+                break
+            if per_byte:
+                for i in range(len(data)):
+                    target.send(data[i:i + 1])
+            else:
+                target.send(data)
     target.close()
 
 @coroutine
 def file_sink(path):
+    from .batch import MessageBatch
     with open(path, 'wb') as f:
         while True:
             c = (yield)
+            if isinstance(c, MessageBatch):
+                c = c.to_bytes()
             f.write(c)
 
 
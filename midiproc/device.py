@@ -0,0 +1,273 @@
+"""
+buffered bulk reading from MIDI devices
+
+midi_reader calls source.read(1) in a loop, so every byte on the wire
+costs a system call. DeviceReader instead waits for the device to become
+readable (poll, or select where poll is missing) and then reads whatever
+has arrived with a single non-blocking os.read into a reusable buffer,
+stamping each chunk with a monotonic clock as it arrives.
+
+Devices without a file descriptor (pylibftdi) are polled instead: their
+read() returns immediately with whatever is waiting, so the reader
+sleeps for `interval` whenever it comes back empty.
+
+pipe_device() and pty_device() give a stand-in for a real device, so a
+pipeline can be exercised without hardware:
+
+    >>> dev, write = pipe_device()
+    >>> write(b'\\x90\\x3c\\x64\\xf8')
+    >>> reader = DeviceReader(dev)
+    >>> reader.read_chunk(timeout=1.0) == b'\\x90\\x3c\\x64\\xf8'
+    True
+    >>> reader.read_chunk(timeout=0) is None
+    True
+    >>> dev.close()
+"""
+
+import errno
+import os
+import select
+import time
+
+# the time a chunk arrived is taken from this (monotonic on Python 3.3+)
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def _set_nonblocking(fd):
+    try:
+        os.set_blocking(fd, False)
+    except AttributeError:
+        # Python < 3.5
+        import fcntl
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class _Poller(object):
+    # waits for one descriptor to become readable
+    def __init__(self, fd):
+        self.fd = fd
+        if hasattr(select, 'poll'):
+            self._poll = select.poll()
+            self._poll.register(fd, select.POLLIN | select.POLLPRI)
+        else:
+            self._poll = None
+
+    def wait(self, timeout):
+        "True if readable (or at EOF / error) within timeout seconds"
+        if self._poll is not None:
+            return bool(self._poll.poll(
+                None if timeout is None else int(timeout * 1000)))
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        return bool(ready)
+
+
+class DeviceReader(object):
+    """
+    Read a device in whole chunks.
+
+    `source` is a file descriptor, an object with fileno() (such as the
+    file midi_snddev() returns), or an object whose read(n) never blocks
+    (such as a pylibftdi Device). The descriptor is switched to
+    non-blocking mode.
+
+    Each chunk is timestamped with clock() on arrival; the time of the
+    most recent chunk is also kept in `timestamp`.
+    """
+
+    def __init__(self, source, chunk_size=4096, interval=0.001):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.timestamp = 0.0
+        self.chunks = 0
+        self.bytes = 0
+        if isinstance(source, int):
+            self.fd = source
+        elif hasattr(source, 'fileno'):
+            try:
+                self.fd = source.fileno()
+            except (AttributeError, IOError, ValueError):
+                self.fd = None
+        else:
+            self.fd = None
+        if self.fd is not None:
+            _set_nonblocking(self.fd)
+            self._poller = _Poller(self.fd)
+            self._buf = bytearray(chunk_size)
+            self._view = memoryview(self._buf)
+
+    def read_chunk(self, timeout=None):
+        """
+        wait up to timeout seconds (None waits for ever) for data,
+        returning it as bytes, or None if nothing arrived. Returns b''
+        at end of file.
+        """
+        if self.fd is None:
+            return self._poll_chunk(timeout)
+        if not self._poller.wait(timeout):
+            return None
+        while True:
+            try:
+                n = _readinto(self.fd, self._buf, self._view)
+            except OSError as exc:
+                if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # spurious wakeup
+                    return None
+                if exc.errno == errno.EINTR:
+                    continue
+                if exc.errno == errno.EIO:
+                    # the other end of a pty has closed
+                    return b''
+                raise
+            break
+        if n:
+            self.timestamp = clock()
+            self.chunks += 1
+            self.bytes += n
+        return bytes(self._view[:n])
+
+    def _poll_chunk(self, timeout):
+        deadline = None if timeout is None else clock() + timeout
+        while True:
+            data = self.source.read(self.chunk_size)
+            if data:
+                self.timestamp = clock()
+                self.chunks += 1
+                self.bytes += len(data)
+                return bytes(data)
+            if deadline is not None and clock() >= deadline:
+                return None
+            time.sleep(self.interval)
+
+    def run(self, target, timeout=None, per_byte=False):
+        """
+        send every chunk read to target until end of file, or until
+        nothing arrives for timeout seconds (with no timeout, a wakeup
+        which finds nothing to read just waits again). Targets with a
+        feed(data, timestamp) method (StreamParser) are fed with the
+        chunk timestamp; otherwise chunks are sent as bytes, or one byte
+        at a time with per_byte (for midi_in_stream).
+        """
+        feed = getattr(target, 'feed', None)
+        send = getattr(target, 'send', None)
+        while True:
+            data = self.read_chunk(timeout)
+            if data is None:
+                if timeout is not None:
+                    return
+                continue
+            if not data:
+                return
+            if per_byte:
+                for i in range(len(data)):
+                    send(data[i:i + 1])
+            elif feed is not None:
+                feed(data, self.timestamp)
+            else:
+                send(data)
+
+
+if hasattr(os, 'readv'):
+    def _readinto(fd, buf, view):
+        return os.readv(fd, [buf])
+else:
+    def _readinto(fd, buf, view):
+        data = os.read(fd, len(buf))
+        view[:len(data)] = data
+        return len(data)
+
+
+# device back ends by name: an opener, or where to import it from
+# ('module:function') when first opened, so that optional dependencies
+# such as pylibftdi are only loaded by the processes which use them
+BACKENDS = {
+    'snddev': 'midiproc.processors:midi_snddev',
+    'ftdi': 'midiproc.processors:midi_ftdi_dev',
+}
+
+
+def register_backend(name, opener):
+    """
+    make a device back end available to open_device(); opener is a
+    callable returning a device, or a 'module:function' string naming
+    one, which is not imported until the back end is first opened.
+    """
+    BACKENDS[name] = opener
+
+
+def open_device(name, *args, **kwargs):
+    "open a device with the named back end"
+    try:
+        opener = BACKENDS[name]
+    except KeyError:
+        raise ValueError('no device back end %r' % (name,))
+    if not callable(opener):
+        module, _, attr = opener.partition(':')
+        opener = getattr(__import__(module, None, None, [attr]), attr)
+        BACKENDS[name] = opener
+    return opener(*args, **kwargs)
+
+
+def bulk_reader(source, target, chunk_size=4096, timeout=None,
+                per_byte=False):
+    "source reading a device in chunks; see DeviceReader.run"
+    DeviceReader(source, chunk_size).run(target, timeout, per_byte)
+
+
+def pipe_device():
+    """
+    a pipe standing in for a device: returns (fd, write), where fd is
+    the read end to give to DeviceReader and write(data) writes to the
+    other end. Closing fd closes both ends.
+    """
+    r, w = os.pipe()
+    _set_nonblocking(w)
+    return _StandIn(r, w), lambda data: _write_all(w, data)
+
+
+def pty_device():
+    """
+    as pipe_device, but using a pseudo-terminal in raw mode, which
+    behaves more like a serial MIDI port (Unix only).
+    """
+    import tty
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    return _StandIn(slave, master), lambda data: _write_all(master, data)
+
+
+class _StandIn(int):
+    # the reading descriptor, which closes the writing one along with it
+    def __new__(cls, fd, other):
+        self = int.__new__(cls, fd)
+        self.other = other
+        return self
+
+    def fileno(self):
+        return int(self)
+
+    def close(self):
+        for fd in (int(self), self.other):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while len(view):
+        try:
+            n = os.write(fd, view)
+        except OSError as exc:
+            if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            select.select([], [fd], [])
+            continue
+        view = view[n:]
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
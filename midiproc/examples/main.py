@@ -1,5 +1,6 @@
-from midiproc import *
-from midiproc.examples.mid_data import d as midi_track
+from midiproc import chain, file_source, iter_source, net_source, net_sink, \
+    process_smf_track, midi_in_stream, hex_print, harmonize, drop_off, \
+    midi_in_snddev, midi_out_snddev, midi_out_ftdi
 import itertools
 import functools
 
@@ -20,6 +21,7 @@ def main():
 
 
 def net_client():
+    from midiproc.examples.mid_data import d as midi_track
     chain([functools.partial(iter_source, itertools.imap(chr, midi_track)),
            process_smf_track,
            midi_in_stream,
@@ -0,0 +1,404 @@
+"""
+lookup-table note, velocity and channel transforms
+
+A Transform compiles a note map, a velocity curve and channel routing
+into flat tables once, when it is built. After that, handling a message
+costs a couple of table lookups, however elaborate the mapping:
+
+    notes     a 128-entry sequence, dict or function of the note
+              number; each entry is a note, None (drop the note), a
+              (channel, note) pair (route the note to a channel), or a
+              list of those (a chord). See transposition(), quantize(),
+              chord() and split() for common maps.
+    velocity  a 128-entry sequence or function for note-on velocities,
+              e.g. vector.velocity_table(curve=0.7)
+    route     channel routing for every channel message: a 16-entry
+              sequence or a dict of {from: to}
+    channels  the input channels the note map and velocity curve apply
+              to (None for every channel)
+
+Tables are keyed on the status byte and one data byte together
+(status << 7 | data, 32768 entries rather than a 128-entry table per
+status), so a key split, a chord or a map which differs by channel is
+one lookup per message, no dearer than a plain transposition.
+
+Batches take the cheapest route the transform allows. Most maps
+(transpositions, scales, velocity curves, routing by channel) apply
+the same 128-entry row to every note status, and there data1 and data2
+are translated whole with bytes.translate, and the results kept only
+for the messages whose status byte selects them, using the columns as
+big-int bit masks; no per-message work is left. Otherwise the keys are
+mapped through the tables with map(), so the loops still run in C, and
+chords join each key's output bytes into the columns in one pass.
+
+    >>> t = Transform(notes=transposition(12), route={0: 3})
+    >>> t.message(b'\\x90\\x3c\\x64') == (b'\\x93\\x48\\x64',)
+    True
+    >>> t.message(b'\\xb0\\x07\\x40') == (b'\\xb3\\x07\\x40',)
+    True
+    >>> t = Transform(notes=chord(MAJOR_TRIAD))
+    >>> [bytearray(m)[1] for m in t.message(b'\\x90\\x3c\\x64')]
+    [60, 64, 67]
+"""
+
+from array import array
+from itertools import chain, compress, repeat
+from operator import add, itemgetter, mul
+
+from .co_util import coroutine
+from .batch import MessageBatch, _byte_array
+
+if b'\x00'[0] == 0:
+    _byte_buffer = lambda data: data
+    _pack = bytes
+else:
+    _byte_buffer = bytearray
+    _pack = lambda values: bytes(bytearray(values))
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+POLY_PRESSURE = 0xA0
+MAJOR = (0, 2, 4, 5, 7, 9, 11)
+MINOR = (0, 2, 3, 5, 7, 8, 10)
+MAJOR_TRIAD = (0, 4, 7)
+MINOR_TRIAD = (0, 3, 7)
+
+_BYTE = [_pack((i,)) for i in range(256)]
+# byte masks: a dropped note (keep 0) is 0xFF; then 0xFF is dropped
+_DROPPED = _pack(0xFF if i == 0 else 0 for i in range(256))
+_KEEP = _pack(0 if i == 0xFF else 1 for i in range(256))
+# array.tostring() was renamed tobytes() in Python 3
+_tobytes = getattr(array, 'tobytes', None) or array.tostring
+
+if hasattr(int, 'from_bytes'):
+    # a byte string as one big int, so that masking a whole column
+    # is a couple of integer operations
+    _from_bytes = lambda data: int.from_bytes(data, 'little')
+    _to_bytes = lambda value, n: value.to_bytes(n, 'little')
+
+    def _where(mask, a, b):
+        "bytes of a where the int mask has 0xFF, of b where it has 0"
+        x = _from_bytes(b)
+        return _to_bytes(x ^ ((_from_bytes(a) ^ x) & mask), len(b))
+else:
+    # Python 2 batches go through the keyed tables
+    _from_bytes = None
+# status << 7, for building keys with map() rather than a Python loop
+_SHIFTED = [s << 7 for s in range(256)]
+_first = itemgetter(0)
+_second = itemgetter(1)
+
+
+def transposition(semitones):
+    "note map shifting every note; notes pushed out of range are dropped"
+    return [n + semitones if 0 <= n + semitones < 128 else None
+            for n in range(128)]
+
+
+def quantize(scale=MAJOR, root=0):
+    "note map moving each note down to the nearest note of a scale"
+    steps = set((root + s) % 12 for s in scale)
+    out = []
+    for n in range(128):
+        m = n
+        while m % 12 not in steps:
+            m -= 1
+        out.append(m if m >= 0 else None)
+    return out
+
+
+def chord(intervals=MAJOR_TRIAD):
+    "note map playing a chord on each note, leaving out notes out of range"
+    return [[n + i for i in intervals if 0 <= n + i < 128]
+            for n in range(128)]
+
+
+def split(point, lower, upper):
+    "note map sending notes below point to channel lower, the rest to upper"
+    return [(lower, n) if n < point else (upper, n) for n in range(128)]
+
+
+def _table(values, size):
+    # a list from a sequence, a {key: value} dict or a function
+    if values is None:
+        return list(range(size))
+    if callable(values):
+        return [values(i) for i in range(size)]
+    if isinstance(values, dict):
+        table = list(range(size))
+        for k, v in values.items():
+            table[k] = v
+        return table
+    table = list(values)
+    if len(table) != size:
+        raise ValueError('table needs %d entries, not %d' % (size,
+                                                              len(table)))
+    return table
+
+
+def _targets(value, channel):
+    # a note map entry as a list of (channel, note)
+    if value is None:
+        return []
+    if isinstance(value, tuple):
+        return [value]
+    if isinstance(value, list):
+        out = []
+        for v in value:
+            out.extend(_targets(v, channel))
+        return out
+    return [(channel, value)]
+
+
+class Transform(object):
+    """
+    A compiled note / velocity / channel transform; see the module
+    documentation for the arguments. message() transforms one message
+    (as bytes), batch() a whole MessageBatch; both leave system
+    messages alone.
+    """
+
+    def __init__(self, notes=None, velocity=None, route=None, channels=None):
+        notes = _table(notes, 128)
+        route = _table(route, 16)
+        velocity = None if velocity is None else _table(velocity, 128)
+        selected = [True] * 16 if channels is None else [False] * 16
+        for c in channels or ():
+            selected[c] = True
+        for c in route:
+            if not 0 <= c < 16:
+                raise ValueError('no channel %r' % (c,))
+
+        # (status << 7 | data1) -> the (status, data1) pairs it becomes
+        self.fan = fan = [()] * 32768
+        self.chords = False
+        self.drops = False
+        for s in range(0x80, 0x100):
+            base = s << 7
+            if s >= 0xF0:
+                for d in range(128):
+                    fan[base | d] = ((s, d),)
+                continue
+            command = s & 0xF0
+            channel = s & 0x0F
+            routed = command | route[channel]
+            note = command in (NOTE_OFF, NOTE_ON, POLY_PRESSURE) and \
+                selected[channel]
+            for d in range(128):
+                if not note:
+                    fan[base | d] = ((routed, d),)
+                    continue
+                out = tuple((command | c, n) for c, n in
+                            _targets(notes[d], route[channel])
+                            if 0 <= n < 128 and 0 <= c < 16)
+                if len(out) > 1:
+                    self.chords = True
+                elif not out:
+                    self.drops = True
+                fan[base | d] = out
+
+        # the 1:1 columns, by key; dropped keys map to themselves
+        self.keep = bytearray(1 if out else 0 for out in fan)
+        self.status = bytearray(out[0][0] if out else k >> 7
+                                for k, out in enumerate(fan))
+        self.data1 = bytearray(out[0][1] if out else k & 0x7F
+                               for k, out in enumerate(fan))
+        # unless a note map routes notes, the status byte alone decides
+        # the new status, so the column can go through bytes.translate
+        by_status = [set() for _ in range(256)]
+        for k, out in enumerate(fan):
+            if out:
+                by_status[k >> 7].add(self.status[k])
+        self.status_table = None
+        if all(len(s) <= 1 for s in by_status):
+            self.status_table = bytes(bytearray(
+                s.pop() if s else i for i, s in enumerate(by_status)))
+
+        # (status << 7 | data2) -> data2; None if velocities are unchanged
+        self.velocity = None
+        if velocity is not None:
+            table = bytearray(range(128)) * 256
+            for c in range(16):
+                if not selected[c]:
+                    continue
+                base = (NOTE_ON | c) << 7
+                for v in range(1, 128):
+                    # a note-on must not turn into a note-off
+                    table[base | v] = max(1, min(127, int(velocity[v])))
+            self.velocity = table
+
+        # when the status byte alone decides the new status, and every
+        # selected note status maps data1 through the same 128-entry row
+        # (any map but a chord or one routing notes by note number), a
+        # batch's data columns are translated whole; see _row_batch
+        self._rows = None
+        note_statuses = [s for s in range(0x80, 0xF0)
+                         if s & 0xF0 in (NOTE_OFF, NOTE_ON, POLY_PRESSURE)
+                         and selected[s & 0x0F]]
+        rows = set(bytes(self.data1[s << 7:(s + 1) << 7])
+                   for s in note_statuses)
+        keeps = set(bytes(self.keep[s << 7:(s + 1) << 7])
+                    for s in note_statuses)
+        if _from_bytes is not None and self.status_table is not None and \
+                not self.chords and len(rows) <= 1 and len(keeps) <= 1:
+            high = bytes(bytearray(range(128, 256)))
+            row = rows.pop() if rows else bytes(bytearray(range(128)))
+            keep = keeps.pop() if keeps else b'\x01' * 128
+            on = [s for s in note_statuses if s & 0xF0 == NOTE_ON]
+            velocity_row = bytes(bytearray(range(128)))
+            if self.velocity is not None and on:
+                velocity_row = bytes(self.velocity[on[0] << 7:
+                                                   (on[0] + 1) << 7])
+            self._rows = (
+                _pack(0xFF if s in note_statuses else 0 for s in range(256)),
+                row + high,
+                bytearray(keep).translate(_DROPPED) + bytes(128),
+                _pack(0xFF if s in on else 0 for s in range(256)),
+                velocity_row + high)
+
+        # single messages: the bytes of each output without its data2,
+        # and whether the message passes unchanged
+        self._heads = [tuple(_pack(pair) for pair in out) for out in fan]
+        self._same = bytearray(1 if out == ((k >> 7, k & 0x7F),) else 0
+                               for k, out in enumerate(fan))
+        self._velocity_bytes = None
+        if self.velocity is not None:
+            self._velocity_bytes = [_BYTE[v] for v in self.velocity]
+        # batches through a chord: the status and data1 bytes of each
+        # key's outputs, and how many there are
+        if self.chords:
+            self._fan_status = [_pack(map(_first, out)) for out in fan]
+            self._fan_data1 = [_pack(map(_second, out)) for out in fan]
+            self._fan_len = [len(out) for out in fan]
+
+    def message(self, rx):
+        "the messages one message becomes, as a tuple of bytes"
+        b = _byte_buffer(rx)
+        s = b[0]
+        if s >= 0xF0 or len(b) < 2:
+            return (rx,)
+        key = s << 7 | b[1]
+        if len(b) == 2:
+            if self._same[key]:
+                return (rx,)
+            return self._heads[key]
+        vel = self._velocity_bytes
+        if vel is None:
+            if self._same[key]:
+                return (rx,)
+            # from the table rather than sliced, so memoryviews work too
+            d2 = _BYTE[b[2]]
+        else:
+            d2 = vel[s << 7 | b[2]]
+        heads = self._heads[key]
+        if len(heads) == 1:
+            return (heads[0] + d2,)
+        return tuple([head + d2 for head in heads])
+
+    def batch(self, batch):
+        "a transformed copy of a MessageBatch"
+        if not batch:
+            return batch
+        if self._rows is not None:
+            return self._row_batch(batch)
+        status = batch.status
+        keys = list(map(add, map(_SHIFTED.__getitem__, status), batch.data1))
+        if self.chords:
+            return self._fan_batch(batch, keys)
+        if self.drops:
+            keep = bytearray(map(self.keep.__getitem__, keys))
+            if 0 in keep:
+                keys = list(compress(keys, keep))
+                batch = batch.compress(keep)
+                status = batch.status
+        data2 = batch.data2
+        timestamp = batch.timestamp
+        if self.velocity is not None:
+            data2 = _byte_array(map(
+                self.velocity.__getitem__,
+                map(add, map(_SHIFTED.__getitem__, status), data2)))
+        if self.status_table is not None:
+            new_status = _byte_array(
+                bytearray(status).translate(self.status_table))
+        else:
+            new_status = _byte_array(map(self.status.__getitem__, keys))
+        return MessageBatch(new_status,
+                            _byte_array(map(self.data1.__getitem__, keys)),
+                            array('B', data2), array('d', timestamp))
+
+    def _row_batch(self, batch):
+        # whole columns at a time: translate data1 and data2 through
+        # their rows, then keep the result only where the status byte
+        # says so, selecting bytes with big-int masks
+        notes, row, drop, on, velocity_row = self._rows
+        status = _tobytes(batch.status)
+        data1 = _tobytes(batch.data1)
+        n = len(status)
+        is_note = _from_bytes(status.translate(notes))
+        if self.drops:
+            dropped = _from_bytes(data1.translate(drop)) & is_note
+            if dropped:
+                batch = batch.compress(bytearray(
+                    _to_bytes(dropped, n)).translate(_KEEP))
+                status = _tobytes(batch.status)
+                data1 = _tobytes(batch.data1)
+                n = len(status)
+                is_note = _from_bytes(status.translate(notes))
+        data2 = batch.data2
+        if self.velocity is not None:
+            data2 = _tobytes(data2)
+            data2 = array('B', _where(_from_bytes(status.translate(on)),
+                                      data2.translate(velocity_row), data2))
+        else:
+            data2 = array('B', data2)
+        return MessageBatch(array('B', status.translate(self.status_table)),
+                            array('B', _where(is_note, data1.translate(row),
+                                              data1)),
+                            data2, array('d', batch.timestamp))
+
+    def _fan_batch(self, batch, keys):
+        # one message to many: each key's status and data1 bytes are
+        # joined straight into the columns, and data2 and the timestamps
+        # repeated as many times as the key has outputs
+        lens = list(map(self._fan_len.__getitem__, keys))
+        data2 = batch.data2
+        if self.velocity is not None:
+            data2 = map(self.velocity.__getitem__,
+                        map(add, map(_SHIFTED.__getitem__, batch.status),
+                            data2))
+        return MessageBatch(
+            array('B', b''.join(map(self._fan_status.__getitem__, keys))),
+            array('B', b''.join(map(self._fan_data1.__getitem__, keys))),
+            array('B', b''.join(map(mul, map(_BYTE.__getitem__, data2),
+                                    lens))),
+            array('d', chain.from_iterable(map(repeat, batch.timestamp,
+                                               lens))))
+
+
+@coroutine
+def transform(target, table=None, **kwargs):
+    """
+    stage applying a Transform (table, or one built from kwargs) to
+    messages and MessageBatches.
+
+    >>> chain([midi_in_snddev, midi_in_stream,
+    ...        lambda t: transform(t, notes=quantize(MINOR, root=9)),
+    ...        midi_out_snddev])                    # doctest: +SKIP
+    """
+    if table is None:
+        table = Transform(**kwargs)
+    message = table.message
+    while True:
+        rx = (yield)
+        if isinstance(rx, MessageBatch):
+            rx = table.batch(rx)
+            if rx:
+                target.send(rx)
+            continue
+        for msg in message(rx):
+            target.send(msg)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
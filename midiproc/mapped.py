@@ -0,0 +1,246 @@
+"""
+memory-mapped file sources
+
+file_source reads a file and sends it on. MappedFile maps a raw
+MIDI stream (such as file_sink writes) into memory instead, and hands
+out memoryview slices of the mapping without copying, or runs them
+through a StreamParser to give MessageBatches. A position can be given
+as a byte offset, reached directly, or as an event index, through a
+sparse index of the running status every `stride` channel messages.
+The index is only built as far as the events asked for, so seeking
+near the start of a long file doesn't walk the rest of it; only the
+`events` count needs the whole file.
+
+A Standard MIDI File can be mapped too, but its events are delta-timed
+track chunks rather than a stream, so the event methods refuse it;
+midi_file() parses a copy of it with the smf module instead.
+
+    >>> with MappedFile(path) as f:                      # doctest: +SKIP
+    ...     for batch in f.batches(event=100000):
+    ...         ...
+    ...     smf = f.midi_file()
+"""
+
+from __future__ import with_statement
+
+from array import array
+import mmap
+import os
+
+from .smf import MidiFile
+from .stream import StreamParser, SYS_RT_BASE, SOX, EOX
+
+DEFAULT_STRIDE = 1024
+
+if b'\x00'[0] == 0:
+    _byte_buffer = lambda data: data
+    _pack = bytes
+else:
+    _byte_buffer = bytearray
+    _pack = lambda values: bytes(bytearray(values))
+
+
+def _walk(buf, pos, rstat, count):
+    """
+    step over `count` channel messages of a raw stream from pos, where
+    pos is a message boundary with running status rstat. Returns
+    (pos, rstat, walked): the position just after the last message
+    walked, the running status there and how many messages were found
+    (fewer than count at the end of buf).
+    """
+    end = len(buf)
+    if rstat:
+        need = 1 if 0xC0 <= rstat <= 0xDF else 2
+    else:
+        need = 0
+    left = need
+    insysex = False
+    walked = 0
+    while walked < count and pos < end:
+        b = buf[pos]
+        pos += 1
+        if b < 0x80:
+            if need and not insysex:
+                left -= 1
+                if not left:
+                    walked += 1
+                    left = need
+        elif b >= SYS_RT_BASE:
+            continue
+        elif b == EOX:
+            # ends a sysex; otherwise ignored
+            insysex = False
+        else:
+            # any other status byte also ends a sysex
+            insysex = b == SOX
+            if b >= 0xF0:
+                rstat = need = left = 0
+            else:
+                rstat = b
+                need = left = 1 if 0xC0 <= b <= 0xDF else 2
+    return pos, rstat, walked
+
+
+class MappedFile(object):
+    """
+    A read-only memory map of a file. `view` is a memoryview of the
+    whole file; close() releases the mapping once nothing else holds a
+    view of it (slices handed out keep it alive until they go).
+    """
+
+    def __init__(self, path, stride=DEFAULT_STRIDE):
+        self.path = path
+        self.stride = stride
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self._mmap = mmap.mmap(f.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            else:
+                # an empty file can't be mapped
+                self._mmap = None
+        self.data = self._mmap if self._mmap is not None else b''
+        self.view = memoryview(self.data)
+        self._buf = None
+        # the sparse index: the offset and running status of every
+        # stride-th channel message, as far as it has been walked
+        self._offsets = array('L', [0])
+        self._status = array('B', [0])
+        self._events = None  # known once the walk reaches the end
+
+    def __len__(self):
+        return len(self.data)
+
+    def close(self):
+        if self.view is not None:
+            if hasattr(self.view, 'release'):
+                # Python 3.2+
+                self.view.release()
+            self.view = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # slices are still in use; the mapping goes with them
+                pass
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def chunks(self, offset=0, chunk_size=65536, stop=None):
+        "memoryview slices of the file from offset, without copying"
+        view = self.view
+        stop = len(view) if stop is None else min(stop, len(view))
+        for pos in range(offset, stop, chunk_size):
+            yield view[pos:min(pos + chunk_size, stop)]
+
+    @property
+    def is_smf(self):
+        "True if the file is a Standard MIDI File rather than a stream"
+        return bytes(self.data[:4]) == b'MThd'
+
+    def _stream_buffer(self):
+        if self.is_smf:
+            raise ValueError('%s is a Standard MIDI File, not a raw MIDI '
+                             'stream; use midi_file()' % self.path)
+        if self._buf is None:
+            self._buf = _byte_buffer(self.data)
+        return self._buf
+
+    def _index_to(self, block=None):
+        # extend the index to cover the start of block `block` (or the
+        # whole file), or as far as the file goes
+        buf = self._stream_buffer()
+        offsets, status, stride = self._offsets, self._status, self.stride
+        while self._events is None and (block is None or
+                                        len(offsets) <= block):
+            pos, rstat, walked = _walk(buf, offsets[-1], status[-1], stride)
+            if walked < stride:
+                self._events = (len(offsets) - 1) * stride + walked
+                break
+            offsets.append(pos)
+            status.append(rstat)
+
+    @property
+    def events(self):
+        "number of channel messages in the file (this walks all of it)"
+        self._index_to()
+        return self._events
+
+    def seek_event(self, index):
+        """
+        (offset, running status) at the start of channel message
+        `index`, or at the end of the file if there are fewer messages.
+        The file is only walked as far as index.
+        """
+        k = index // self.stride
+        self._index_to(k)
+        k = min(k, len(self._offsets) - 1)
+        pos, rstat = self._offsets[k], self._status[k]
+        if index > k * self.stride:
+            pos, rstat, _ = _walk(self._stream_buffer(), pos, rstat,
+                                  index - k * self.stride)
+        return pos, rstat
+
+    def stream(self, offset=0, event=None, chunk_size=65536):
+        """
+        the raw stream from a byte offset or event index, as memoryview
+        slices. Starting at an event in running status, the first chunk
+        is the status byte, so any stream parser can follow on.
+        """
+        if event is not None:
+            offset, rstat = self.seek_event(event)
+            if rstat and offset < len(self.data) and \
+                    _byte_buffer(self.data)[offset] < 0x80:
+                yield memoryview(_pack((rstat,)))
+        for chunk in self.chunks(offset, chunk_size):
+            yield chunk
+
+    def batches(self, offset=0, event=None, chunk_size=65536):
+        "the channel messages from offset or event, a MessageBatch per chunk"
+        self._stream_buffer()
+        parser = StreamParser(batch=True)
+        if event is not None:
+            offset, rstat = self.seek_event(event)
+            parser.resume(rstat)
+        for chunk in self.chunks(offset, chunk_size):
+            batch = parser.parse(chunk)
+            if batch:
+                yield batch
+
+    def midi_file(self):
+        """
+        parse the mapping as a Standard MIDI File. The MidiFile holds a
+        copy of the data, so it outlives close()
+        """
+        return MidiFile(self.data[:])
+
+
+def mapped_source(path, target, offset=0, event=None, chunk_size=65536,
+                  batch=False, per_byte=False):
+    """
+    source sending a file to target from a mapping: as memoryview
+    chunks, as MessageBatches with batch set, or one byte at a time with
+    per_byte (for midi_in_stream). The target is closed at the end.
+    """
+    with MappedFile(path) as f:
+        if batch:
+            for b in f.batches(offset, event, chunk_size):
+                target.send(b)
+        elif per_byte:
+            for chunk in f.stream(offset, event, chunk_size):
+                chunk = chunk.tobytes()
+                for i in range(len(chunk)):
+                    target.send(chunk[i:i + 1])
+        else:
+            for chunk in f.stream(offset, event, chunk_size):
+                target.send(chunk)
+    target.close()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,261 @@
+"""
+opt-in pipeline instrumentation
+
+Pass a Metrics instance to chain() and every stage after the source is
+wrapped in a probe recording, per stage: send() calls, messages in and
+out (a MessageBatch counts as its length), messages dropped (in but not
+passed on), and time spent in the stage itself (excluding downstream
+stages) as a cumulative total and a log2 histogram, in nanoseconds.
+Without a Metrics instance chain() builds exactly the pipeline it always
+did, so there is no cost when instrumentation is off.
+
+    >>> m = Metrics()
+    >>> chain([midi_in_snddev, midi_in_stream, hex_print,
+    ...        midi_out_snddev], metrics=m)       # doctest: +SKIP
+    >>> m.start_reporter(10, fmt='prometheus')   # doctest: +SKIP
+
+Stages which buffer messages (such as a ring buffer) can register a
+gauge for their queue depth, which is included in every snapshot.
+"""
+
+import sys
+import threading
+import time
+
+from .batch import MessageBatch
+
+try:
+    _now_ns = time.perf_counter_ns
+except AttributeError:
+    _clock = getattr(time, 'perf_counter', time.time)
+    _now_ns = lambda: int(_clock() * 1e9)
+
+HISTOGRAM_BUCKETS = 32  # bucket n counts durations < 2**n ns
+
+
+def _count(rx):
+    return len(rx) if isinstance(rx, MessageBatch) else 1
+
+
+class StageMetrics(object):
+    "counters for a single stage"
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.messages_in = 0
+        self.messages_out = 0
+        self.dropped = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def record(self, elapsed_ns, count_in, count_out):
+        self.calls += 1
+        self.messages_in += count_in
+        self.messages_out += count_out
+        if count_out < count_in:
+            self.dropped += count_in - count_out
+        if elapsed_ns < 0:
+            elapsed_ns = 0
+        self.total_ns += elapsed_ns
+        if elapsed_ns > self.max_ns:
+            self.max_ns = elapsed_ns
+        self.histogram[min(elapsed_ns.bit_length(),
+                           HISTOGRAM_BUCKETS - 1)] += 1
+
+    def percentile_ns(self, pct):
+        "upper bound of the histogram bucket holding the pct'th call"
+        wanted = self.calls * pct / 100.0
+        seen = 0
+        for n, c in enumerate(self.histogram):
+            seen += c
+            if c and seen >= wanted:
+                return 1 << n
+        return 0
+
+    def snapshot(self):
+        return {
+            'calls': self.calls,
+            'messages_in': self.messages_in,
+            'messages_out': self.messages_out,
+            'dropped': self.dropped,
+            'total_ns': self.total_ns,
+            'max_ns': self.max_ns,
+            'mean_ns': self.total_ns // self.calls if self.calls else 0,
+            'p50_ns': self.percentile_ns(50),
+            'p99_ns': self.percentile_ns(99),
+            'histogram': list(self.histogram),
+        }
+
+
+class _OutProbe(object):
+    # sits between a stage and its target, timing and counting output
+    __slots__ = ('target', 'count', 'ns')
+
+    def __init__(self, target):
+        self.target = target
+        self.count = 0
+        self.ns = 0
+
+    def send(self, rx):
+        self.count += _count(rx)
+        start = _now_ns()
+        self.target.send(rx)
+        self.ns += _now_ns() - start
+
+    def close(self):
+        self.target.close()
+
+    def __bool__(self):
+        return bool(self.target)
+    __nonzero__ = __bool__
+
+
+class _InProbe(object):
+    # stands in for a stage, timing each send() net of downstream time
+    __slots__ = ('stage', 'out', 'metrics')
+
+    def __init__(self, stage, out, metrics):
+        self.stage = stage
+        self.out = out
+        self.metrics = metrics
+
+    def send(self, rx):
+        out = self.out
+        if out is not None:
+            count_before, ns_before = out.count, out.ns
+        start = _now_ns()
+        self.stage.send(rx)
+        elapsed = _now_ns() - start
+        if out is not None:
+            downstream = out.ns - ns_before
+            count_out = out.count - count_before
+        else:
+            # a sink: everything it receives counts as passed on
+            downstream = 0
+            count_out = _count(rx)
+        self.metrics.record(elapsed - downstream, _count(rx), count_out)
+
+    def close(self):
+        self.stage.close()
+
+    def __getattr__(self, name):
+        return getattr(self.stage, name)
+
+
+def _stage_name(fn):
+    while hasattr(fn, 'func'):
+        # functools.partial
+        fn = fn.func
+    return getattr(fn, '__name__', fn.__class__.__name__)
+
+
+class Metrics(object):
+    "registry of per-stage metrics and gauges for one or more chains"
+
+    def __init__(self):
+        self.stages = []
+        self.gauges = {}
+        self._lock = threading.Lock()
+        self._reporter = None
+
+    def stage(self, name):
+        with self._lock:
+            names = set(s.name for s in self.stages)
+            unique, n = name, 1
+            while unique in names:
+                n += 1
+                unique = '%s_%d' % (name, n)
+            m = StageMetrics(unique)
+            self.stages.append(m)
+        return m
+
+    def register(self, fns):
+        "create StageMetrics for a list of stage factories, in order"
+        return [self.stage(_stage_name(fn)) for fn in fns]
+
+    def wrap(self, fn, target=None, m=None):
+        """
+        build the stage fn (with target, if given) inside probes,
+        returning the probe to use in its place.
+        """
+        if m is None:
+            m = self.stage(_stage_name(fn))
+        if target is None:
+            return _InProbe(fn(), None, m)
+        out = _OutProbe(target)
+        return _InProbe(fn(out), out, m)
+
+    def gauge(self, name, fn):
+        "register a callable returning a current value, e.g. queue depth"
+        self.gauges[name] = fn
+
+    def snapshot(self):
+        snap = dict((s.name, s.snapshot()) for s in self.stages)
+        return {'stages': snap,
+                'gauges': dict((k, fn()) for k, fn in self.gauges.items())}
+
+    def format_text(self):
+        lines = ['%-20s %10s %10s %8s %12s %10s %10s' % (
+            'stage', 'in', 'out', 'dropped', 'mean ns', 'p99 ns', 'max ns')]
+        for s in self.stages:
+            snap = s.snapshot()
+            lines.append('%-20s %10d %10d %8d %12d %10d %10d' % (
+                s.name, snap['messages_in'], snap['messages_out'],
+                snap['dropped'], snap['mean_ns'], snap['p99_ns'],
+                snap['max_ns']))
+        for name, fn in sorted(self.gauges.items()):
+            lines.append('%-20s %s' % (name, fn()))
+        return '\n'.join(lines) + '\n'
+
+    def format_prometheus(self, prefix='midiproc'):
+        out = []
+        counters = (('calls', 'calls_total'),
+                    ('messages_in', 'messages_in_total'),
+                    ('messages_out', 'messages_out_total'),
+                    ('dropped', 'messages_dropped_total'))
+        for key, metric in counters:
+            out.append('# TYPE %s_stage_%s counter' % (prefix, metric))
+            for s in self.stages:
+                out.append('%s_stage_%s{stage="%s"} %d' % (
+                    prefix, metric, s.name, getattr(s, key)))
+        name = '%s_stage_latency_ns' % prefix
+        out.append('# TYPE %s histogram' % name)
+        for s in self.stages:
+            seen = 0
+            for n, c in enumerate(s.histogram):
+                seen += c
+                out.append('%s_bucket{stage="%s",le="%d"} %d' % (
+                    name, s.name, 1 << n, seen))
+            out.append('%s_bucket{stage="%s",le="+Inf"} %d' % (
+                name, s.name, s.calls))
+            out.append('%s_sum{stage="%s"} %d' % (name, s.name, s.total_ns))
+            out.append('%s_count{stage="%s"} %d' % (name, s.name, s.calls))
+        for gname, fn in sorted(self.gauges.items()):
+            out.append('# TYPE %s_%s gauge' % (prefix, gname))
+            out.append('%s_%s %s' % (prefix, gname, fn()))
+        return '\n'.join(out) + '\n'
+
+    def start_reporter(self, interval, write=None, fmt='text'):
+        """
+        write a dump every `interval` seconds from a daemon thread,
+        until stop_reporter() is called.
+        """
+        write = write or sys.stderr.write
+        formatter = self.format_prometheus if fmt == 'prometheus' \
+            else self.format_text
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                write(formatter())
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        self._reporter = stop
+        thread.start()
+
+    def stop_reporter(self):
+        if self._reporter is not None:
+            self._reporter.set()
+            self._reporter = None
@@ -0,0 +1,491 @@
+"""
+framed network transport
+
+net_sink sends one datagram per message, and net_source can't tell where
+messages start, or whether any went missing. The frame format here packs
+many timestamped messages into each datagram:
+
+    header:  magic 'MP', version, flags, sequence (u32),
+             base time (f64 seconds), record count (u16)
+    records: time offset from base (i32 microseconds), length (u8, or
+             255 and a u16), message bytes
+
+Sequence numbers let the receiver count lost, duplicated and reordered
+frames. FramedSink flushes a frame when it would exceed max_size, or
+once its oldest message has waited flush_interval; it has no timer of
+its own, so the caller drives that with poll() (see FramedSink).
+
+Python has no binding for sendmmsg / recvmmsg, so bulk I/O here comes
+from packing many messages per datagram, plus draining every queued
+datagram into one reusable buffer on each wakeup of the receiver.
+
+Sockets are held in a SocketPool keyed by protocol, address and role, so
+that many endpoints can be open at once without reconnecting. For TCP,
+each message is sent with a 4-byte big-endian length prefix.
+"""
+
+import errno
+import select
+import socket
+import struct
+import time
+
+from .batch import MessageBatch, is_two_byte
+
+MAGIC = b'MP'
+VERSION = 2
+HEADER = struct.Struct('!2sBBIdH')
+RECORD = struct.Struct('!iB')
+LONG_LENGTH = struct.Struct('!H')
+MAX_RECORDS = 0xFFFF
+MAX_DATAGRAM = 65507
+LENGTH = struct.Struct('!I')
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class FrameError(ValueError):
+    "datagram is not a valid frame"
+
+
+def encode_frame(seq, base, records):
+    """
+    build a frame from (timestamp, message) records.
+
+    >>> f = encode_frame(7, 1.5, [(1.5, b'\\x90\\x3c\\x64'), (1.501, b'\\xf8')])
+    >>> seq, base, recs = decode_frame(f)
+    >>> seq, base, [(round(t, 6), bytes(m)) for t, m in recs] == [(1.5, b'\\x90\\x3c\\x64'), (1.501, b'\\xf8')]
+    (7, 1.5, True)
+    """
+    parts = [HEADER.pack(MAGIC, VERSION, 0, seq & 0xFFFFFFFF, base,
+                         len(records))]
+    pack = RECORD.pack
+    for t, msg in records:
+        n = len(msg)
+        offset = int(round((t - base) * 1e6))
+        if n < 255:
+            parts.append(pack(offset, n))
+        elif n <= 0xFFFF:
+            parts.append(pack(offset, 255) + LONG_LENGTH.pack(n))
+        else:
+            raise FrameError('message of %d bytes is too long to frame' % n)
+        parts.append(bytes(msg))
+    return b''.join(parts)
+
+
+def record_size(n):
+    "bytes taken in a frame by a record holding a message of n bytes"
+    return RECORD.size + n + (LONG_LENGTH.size if n >= 255 else 0)
+
+
+def decode_frame(data):
+    """
+    split a frame into (seq, base, records), where records is a list of
+    (timestamp, message) and each message is a memoryview into data.
+    """
+    if len(data) < HEADER.size:
+        raise FrameError('short frame')
+    magic, version, _, seq, base, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise FrameError('bad frame header')
+    view = memoryview(data)
+    pos = HEADER.size
+    unpack = RECORD.unpack_from
+    records = []
+    for _ in range(count):
+        offset, length = unpack(data, pos)
+        pos += RECORD.size
+        if length == 255:
+            (length,) = LONG_LENGTH.unpack_from(data, pos)
+            pos += LONG_LENGTH.size
+        if pos + length > len(data):
+            raise FrameError('truncated frame')
+        records.append((base + offset * 1e-6, view[pos:pos + length]))
+        pos += length
+    return seq, base, records
+
+
+class FrameStats(object):
+    "receive-side counters for a framed stream"
+
+    def __init__(self):
+        self.frames = 0
+        self.messages = 0
+        self.lost = 0
+        self.reordered = 0
+        self.duplicates = 0
+        self.errors = 0
+
+    def __str__(self):
+        return ('%d frames, %d messages, %d lost, %d reordered, '
+                '%d duplicates, %d bad' % (
+                    self.frames, self.messages, self.lost, self.reordered,
+                    self.duplicates, self.errors))
+
+
+class FramedSink(object):
+    """
+    Sink packing messages into frames and sending them to addr.
+
+    Accepts single messages (stamped with the current time) or
+    MessageBatches (which keep their own timestamps, unless these are
+    zero). A message too big for max_size (a long sysex) goes in a frame
+    of its own; one too big for any datagram raises FrameError.
+
+    There is no timer: the flush_interval is only checked when a message
+    arrives or poll() is called. If the stream can go quiet, the caller
+    must call poll() every flush_interval or so (from its event loop, or
+    a timer thread) or the last messages wait until the next one; and
+    close() at the end.
+    """
+
+    def __init__(self, addr, max_size=1400, flush_interval=0.005, sock=None):
+        self.addr = addr
+        self.max_size = min(max_size, MAX_DATAGRAM)
+        self.flush_interval = flush_interval
+        self.sock = sock or sockets.sender(addr)
+        self.seq = 0
+        self.frames_sent = 0
+        self._records = []
+        self._size = HEADER.size
+        self._first = None
+
+    def _add(self, t, msg, now):
+        size = record_size(len(msg))
+        if HEADER.size + size > MAX_DATAGRAM:
+            raise FrameError('message of %d bytes does not fit in a '
+                             'datagram' % len(msg))
+        records = self._records
+        if records and (self._size + size > self.max_size or
+                        len(records) == MAX_RECORDS or
+                        abs(t - records[0][0]) > 2000.0):
+            self.flush()
+        if not self._records:
+            self._first = now
+        self._records.append((t, msg))
+        self._size += size
+
+    def send(self, rx):
+        now = clock()
+        if isinstance(rx, MessageBatch):
+            add = self._add
+            for view, t in zip(rx.iter_bytes(), rx.timestamp):
+                add(t or now, view, now)
+        else:
+            self._add(now, rx, now)
+        if self._records and now - self._first >= self.flush_interval:
+            self.flush()
+
+    def poll(self, now=None):
+        "flush if the oldest waiting message has waited flush_interval"
+        if self._records:
+            if now is None:
+                now = clock()
+            if now - self._first >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        if not self._records:
+            return
+        frame = encode_frame(self.seq, self._records[0][0], self._records)
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        self._records = []
+        self._size = HEADER.size
+        self.sock.sendto(frame, self.addr)
+        self.frames_sent += 1
+
+    def close(self):
+        self.flush()
+
+
+class Deframer(object):
+    """
+    Stage turning received frames back into messages, tracking sequence
+    numbers. With batch set, the channel messages of each frame go to
+    target as one MessageBatch and any others (realtime, sysex) follow as
+    bytes; otherwise every message is sent as bytes in frame order.
+
+    The last `window` sequence numbers are remembered, so a late frame
+    is delivered once and any repeat of it dropped as a duplicate;
+    frames from further back than that are dropped (and counted) as
+    duplicates too.
+    """
+
+    window = 64
+
+    def __init__(self, target, batch=True):
+        self.target = target
+        self.batch = batch
+        self.stats = FrameStats()
+        self._expected = None
+        # bit i set: sequence number expected - 1 - i has been delivered
+        self._seen = 0
+
+    def _track(self, seq):
+        stats = self.stats
+        expected = self._expected
+        if expected is None:
+            ahead = 0
+        else:
+            ahead = (seq - expected) & 0xFFFFFFFF
+        if ahead < 0x80000000:
+            stats.lost += ahead
+            self._expected = (seq + 1) & 0xFFFFFFFF
+            self._seen = (self._seen << (ahead + 1) | 1) & \
+                ((1 << self.window) - 1)
+            return True
+        back = (expected - 1 - seq) & 0xFFFFFFFF
+        if back >= self.window or self._seen >> back & 1:
+            stats.duplicates += 1
+            return False
+        # a late frame, counted as lost when the frames after it came
+        self._seen |= 1 << back
+        if stats.lost:
+            stats.lost -= 1
+        stats.reordered += 1
+        return True
+
+    def send(self, data):
+        stats = self.stats
+        try:
+            seq, _, records = decode_frame(data)
+        except (FrameError, struct.error):
+            stats.errors += 1
+            return
+        if not self._track(seq):
+            return
+        stats.frames += 1
+        stats.messages += len(records)
+        target = self.target
+        if not self.batch:
+            for _, msg in records:
+                target.send(bytes(msg))
+            return
+        out = MessageBatch()
+        others = []
+        for t, msg in records:
+            n = len(msg)
+            status = msg[0] if n else 0
+            if not isinstance(status, int):
+                status = ord(status)
+            if 0x80 <= status < 0xF0 and n == (2 if is_two_byte(status) else 3):
+                msg = bytearray(msg)
+                out.append(status, msg[1], msg[2] if n == 3 else 0, t)
+            else:
+                others.append(bytes(msg))
+        if out:
+            target.send(out)
+        for msg in others:
+            target.send(msg)
+
+    def close(self):
+        self.target.close()
+
+
+def recv_frames(sock, target, bufsize=MAX_DATAGRAM, timeout=None):
+    """
+    receive datagrams on sock into a single reusable buffer, draining
+    everything queued on each wakeup, and pass each to target. Returns
+    if nothing arrives within timeout seconds (None waits for ever).
+    """
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    sock.setblocking(False)
+    while True:
+        ready, _, _ = select.select([sock], [], [], timeout)
+        if not ready:
+            return
+        while True:
+            try:
+                n = sock.recv_into(buf)
+            except socket.error as exc:
+                if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            target.send(view[:n])
+
+
+def framed_net_source(addr, target, batch=True, timeout=None):
+    "source receiving frames on addr and sending their messages to target"
+    recv_frames(sockets.listener(addr), Deframer(target, batch),
+                timeout=timeout)
+
+
+def framed_net_sink(addr, **kwargs):
+    return FramedSink(addr, **kwargs)
+
+
+class SocketPool(object):
+    """
+    Registry of open sockets keyed by (protocol, address, role), where
+    role is 'listen' for a bound / listening socket and 'send' for a
+    sending or connected one. Asking for the same key again returns the
+    same socket until it is closed.
+    """
+
+    def __init__(self):
+        self._sockets = {}
+
+    def __contains__(self, key):
+        return key in self._sockets
+
+    def __len__(self):
+        return len(self._sockets)
+
+    def listener(self, addr, proto='udp'):
+        "a socket bound to addr (and listening, for TCP)"
+        key = (proto, addr, 'listen')
+        s = self._sockets.get(key)
+        if s is None:
+            s = socket.socket(socket.AF_INET, _sock_type(proto))
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                s.bind(addr)
+                if proto == 'tcp':
+                    s.listen(16)
+            except socket.error:
+                s.close()
+                raise
+            self._sockets[key] = s
+        return s
+
+    def sender(self, addr, proto='udp'):
+        "a socket for sending to addr; connected, for TCP"
+        key = (proto, addr, 'send')
+        s = self._sockets.get(key)
+        if s is None:
+            s = socket.socket(socket.AF_INET, _sock_type(proto))
+            if proto == 'tcp':
+                try:
+                    s.connect(addr)
+                except socket.error:
+                    s.close()
+                    raise
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._sockets[key] = s
+        return s
+
+    def close(self, addr=None, proto=None, role=None):
+        "close every socket matching the given address / protocol / role"
+        for key in list(self._sockets):
+            p, a, r = key
+            if (addr is None or a == addr) and \
+                    (proto is None or p == proto) and \
+                    (role is None or r == role):
+                self._sockets.pop(key).close()
+
+    def adopt(self, sock, addr, proto='udp', role='listen'):
+        """
+        hold a socket opened elsewhere (e.g. with its own buffer sizes)
+        under the given key, so that net_source / net_sink use it
+        """
+        key = (proto, addr, role)
+        if key in self._sockets:
+            raise ValueError('already holding a socket for %r' % (key,))
+        self._sockets[key] = sock
+
+    def discard(self, sock):
+        "forget (and close) a socket which has failed"
+        for key, s in list(self._sockets.items()):
+            if s is sock:
+                del self._sockets[key]
+        sock.close()
+
+    def close_all(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close_all()
+
+
+def _sock_type(proto):
+    if proto == 'udp':
+        return socket.SOCK_DGRAM
+    if proto == 'tcp':
+        return socket.SOCK_STREAM
+    raise ValueError('unknown protocol %r' % proto)
+
+
+# the registry used by co_util.net_source / net_sink
+sockets = SocketPool()
+
+
+def send_framed(sock, data):
+    "send one length-prefixed message on a stream socket"
+    sock.sendall(LENGTH.pack(len(data)) + bytes(data))
+
+
+class LengthFramer(object):
+    """
+    reassembles length-prefixed messages from arbitrary stream chunks,
+    sending each complete payload to target as bytes.
+    """
+
+    def __init__(self, target, max_length=1 << 24):
+        self.target = target
+        self.max_length = max_length
+        self._buf = bytearray()
+
+    def send(self, data):
+        buf = self._buf
+        buf += data
+        pos = 0
+        end = len(buf)
+        while end - pos >= LENGTH.size:
+            (length,) = LENGTH.unpack_from(buf, pos)
+            if length > self.max_length:
+                raise FrameError('message length %d too large' % length)
+            if end - pos - LENGTH.size < length:
+                break
+            start = pos + LENGTH.size
+            self.target.send(bytes(buf[start:start + length]))
+            pos = start + length
+        if pos:
+            del buf[:pos]
+
+
+def tcp_serve(listener, target, timeout=None, bufsize=65536):
+    """
+    accept any number of TCP clients on a listening socket, reading
+    length-framed messages from each and sending them to target. A
+    client which sends a bad length is disconnected; the others carry
+    on. Returns if nothing happens within timeout seconds (None waits
+    for ever).
+    """
+    framers = {}
+    buf = bytearray(bufsize)
+    try:
+        while True:
+            ready, _, _ = select.select([listener] + list(framers), [], [],
+                                        timeout)
+            if not ready:
+                return
+            for s in ready:
+                if s is listener:
+                    conn, _ = listener.accept()
+                    framers[conn] = LengthFramer(target)
+                    continue
+                try:
+                    n = s.recv_into(buf)
+                except socket.error:
+                    n = 0
+                if n:
+                    try:
+                        framers[s].send(memoryview(buf)[:n])
+                        continue
+                    except FrameError:
+                        pass
+                # client closed, or sent garbage: keep serving the others
+                del framers[s]
+                s.close()
+    finally:
+        for s in framers:
+            s.close()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,350 @@
+"""
+note state tracking
+
+drop_off and harmonize decide one message at a time, so a note-on can
+reach the output while its note-off never does: harmonize passes no
+note-offs at all, and changing a filter mid-performance can strand
+notes it already let through. NoteState keeps what is sounding in a
+16 x 128 bitmap (one int of 128 bits per channel), with the velocity and
+onset time of every note in flat arrays, so asking whether a note is on,
+how many notes a channel holds or what has been held too long costs the
+same however busy the stream.
+
+NoteGuard wraps a stage so that what it lets through stays balanced:
+every note-on the stage produces is remembered against the note-on that
+caused it, and that input's note-off releases exactly those notes,
+whatever the stage would have done with it. Swapping the stage with
+reconfigure() releases everything still sounding first.
+
+    >>> from midiproc.processors import harmonize
+    >>> out = []
+    >>> guard = NoteGuard(_Collect(out), harmonize)
+    >>> guard.send(b'\\x90\\x24\\x64')
+    >>> guard.send(b'\\x80\\x24\\x00')
+    >>> out == [b'\\x90\\x24\\x64', b'\\x90\\x0c\\x64',
+    ...         b'\\x80\\x24\\x00', b'\\x80\\x0c\\x00']
+    True
+    >>> guard.state.total
+    0
+"""
+
+from array import array
+
+from .batch import MessageBatch
+from .device import clock
+
+if b'\x00'[0] == 0:
+    _byte_buffer = lambda data: data
+    _pack = bytes
+else:
+    _byte_buffer = bytearray
+    _pack = lambda values: bytes(bytearray(values))
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+CONTROL_CHANGE = 0xB0
+ALL_SOUND_OFF = 120
+ALL_NOTES_OFF = 123
+RESET = 0xFF
+
+
+class NoteState(object):
+    """
+    The notes sounding on each channel, with velocity and onset time.
+
+    Feed it every message that reaches the output, with update() (or
+    put a NoteTracker stage in front of the sink). Note-offs, zero
+    velocity note-ons, all sound off / all notes off and system reset
+    all release notes.
+
+    >>> state = NoteState()
+    >>> state.update(0x91, 60, 100, 1.5)
+    >>> state.is_on(1, 60), state.velocity_of(1, 60), state.onset_of(1, 60)
+    (True, 100, 1.5)
+    >>> state.update(0x81, 60, 0)
+    >>> state.is_on(1, 60), state.count(1), state.total
+    (False, 0, 0)
+    """
+
+    def __init__(self):
+        self.bits = [0] * 16
+        self.counts = array('H', [0]) * 16
+        self.total = 0
+        self.velocity = bytearray(16 * 128)
+        self.onset = array('d', [0.0]) * (16 * 128)
+
+    def clear(self, channel=None):
+        "forget the notes of one channel, or of every channel"
+        channels = range(16) if channel is None else (channel,)
+        for c in channels:
+            self.total -= self.counts[c]
+            self.counts[c] = 0
+            self.bits[c] = 0
+
+    def note_on(self, channel, note, velocity, t=0.0):
+        bit = 1 << note
+        if not self.bits[channel] & bit:
+            self.bits[channel] |= bit
+            self.counts[channel] += 1
+            self.total += 1
+        i = channel << 7 | note
+        self.velocity[i] = velocity
+        self.onset[i] = t
+
+    def note_off(self, channel, note):
+        bit = 1 << note
+        if self.bits[channel] & bit:
+            self.bits[channel] &= ~bit
+            self.counts[channel] -= 1
+            self.total -= 1
+
+    def update(self, status, data1, data2=0, t=0.0):
+        "account for one channel message (or system reset)"
+        command = status & 0xF0
+        if command == NOTE_ON and data2:
+            self.note_on(status & 0x0F, data1, data2, t)
+        elif command == NOTE_ON or command == NOTE_OFF:
+            self.note_off(status & 0x0F, data1)
+        elif command == CONTROL_CHANGE and data1 in (ALL_SOUND_OFF,
+                                                     ALL_NOTES_OFF):
+            self.clear(status & 0x0F)
+        elif status == RESET:
+            self.clear()
+
+    def update_message(self, rx, t=0.0):
+        b = _byte_buffer(rx)
+        if len(b) >= 3:
+            self.update(b[0], b[1], b[2], t)
+        elif len(b) == 1:
+            self.update(b[0], 0)
+
+    def update_batch(self, batch, now=None):
+        """
+        account for a MessageBatch; unstamped messages (timestamp 0.0,
+        as from StreamParser) start their notes at now, by default
+        clock(), so that stuck() measures every onset on one clock
+        """
+        if now is None:
+            now = clock()
+        update = self.update
+        for s, d1, d2, t in zip(batch.status, batch.data1, batch.data2,
+                                batch.timestamp):
+            if s < 0xC0:
+                update(s, d1, d2, t or now)
+
+    def is_on(self, channel, note):
+        return bool(self.bits[channel] >> note & 1)
+
+    def velocity_of(self, channel, note):
+        "velocity of a sounding note, or 0"
+        if self.bits[channel] >> note & 1:
+            return self.velocity[channel << 7 | note]
+        return 0
+
+    def onset_of(self, channel, note):
+        "when a sounding note started, or None"
+        if self.bits[channel] >> note & 1:
+            return self.onset[channel << 7 | note]
+        return None
+
+    def count(self, channel=None):
+        "notes sounding on a channel, or on all of them"
+        return self.total if channel is None else self.counts[channel]
+
+    def notes(self, channel):
+        "the notes sounding on a channel, lowest first"
+        bits = self.bits[channel]
+        while bits:
+            low = bits & -bits
+            yield low.bit_length() - 1
+            bits ^= low
+
+    def active(self):
+        "(channel, note) of every sounding note"
+        for c in range(16):
+            if self.counts[c]:
+                for n in self.notes(c):
+                    yield c, n
+
+    def stuck(self, max_age, now=None):
+        "(channel, note) of notes held for more than max_age seconds"
+        if now is None:
+            now = clock()
+        onset = self.onset
+        return [(c, n) for c, n in self.active()
+                if now - onset[c << 7 | n] > max_age]
+
+
+def note_offs(notes):
+    "note-off messages for a list of (channel, note)"
+    return [_pack((NOTE_OFF | c, n, 0)) for c, n in notes]
+
+
+def all_notes_off(channels):
+    "all notes off (control change 123) for each channel"
+    return [_pack((CONTROL_CHANGE | c, ALL_NOTES_OFF, 0)) for c in channels]
+
+
+class _Collect(object):
+    # sink appending everything sent to it onto a list
+
+    def __init__(self, out):
+        self.send = out.append
+
+    def close(self):
+        pass
+
+
+class NoteTracker(object):
+    """
+    Stage keeping a NoteState up to date with everything passing
+    through it to target. Single messages, and batch messages without
+    a timestamp, are stamped on arrival.
+    """
+
+    def __init__(self, target, state=None):
+        self.target = target
+        self.state = NoteState() if state is None else state
+
+    def send(self, rx):
+        if isinstance(rx, MessageBatch):
+            self.state.update_batch(rx)
+        else:
+            self.state.update_message(rx, clock())
+        self.target.send(rx)
+
+    def close(self):
+        self.target.close()
+
+
+class NoteGuard(object):
+    """
+    Stage running messages through an inner stage (fn(target), as in a
+    chain) while keeping note-ons and note-offs paired on the output.
+
+    A note-on goes through the inner stage, and the note-ons that come
+    out are recorded against it; its note-off does not go through the
+    stage, but releases each recorded note once nothing else holds it.
+    Everything else just goes through the stage. A MessageBatch is
+    handled message by message and passed on as one batch; onsets are
+    taken from its timestamps, or from clock() where those are 0.0.
+
+    reconfigure(fn) sends note-offs for every sounding note, then all
+    notes off on each channel that had any, and swaps in a new inner
+    stage. release_stuck(max_age) lets go of notes held too long, and
+    close() releases everything before closing the target.
+    """
+
+    def __init__(self, target, fn, state=None):
+        self.target = target
+        self.state = NoteState() if state is None else state
+        # input (channel << 7 | note) -> output (channel << 7 | note)s
+        self._caused = {}
+        # output notes -> how many sounding inputs hold them
+        self._holds = array('H', [0]) * (16 * 128)
+        self._out = []
+        self._collect = _Collect(self._out)
+        self._stage = fn(self._collect)
+
+    def reconfigure(self, fn):
+        "release every sounding note, then replace the inner stage"
+        self.release()
+        self._stage = fn(self._collect)
+
+    def release(self, channels=None):
+        """
+        note-offs for the sounding notes (on the given channels, or
+        all), then all notes off for each channel which had any.
+        """
+        if channels is None:
+            channels = range(16)
+        affected = [c for c in channels if self.state.count(c)]
+        notes = [(c, n) for c in affected for n in self.state.notes(c)]
+        self._forget(notes)
+        for msg in note_offs(notes) + all_notes_off(affected):
+            self.target.send(msg)
+
+    def release_stuck(self, max_age, now=None):
+        "note-offs for notes held longer than max_age seconds"
+        notes = self.state.stuck(max_age, now)
+        self._forget(notes)
+        for msg in note_offs(notes):
+            self.target.send(msg)
+
+    def _forget(self, notes):
+        for c, n in notes:
+            self.state.note_off(c, n)
+            self._holds[c << 7 | n] = 0
+        if notes:
+            released = set(c << 7 | n for c, n in notes)
+            for key, outs in list(self._caused.items()):
+                outs = [o for o in outs if o not in released]
+                if outs:
+                    self._caused[key] = outs
+                else:
+                    del self._caused[key]
+
+    def _message(self, rx, t, emit):
+        b = _byte_buffer(rx)
+        command = b[0] & 0xF0 if b[0] < 0xF0 else 0
+        if command == NOTE_OFF or (command == NOTE_ON and len(b) > 2 and
+                                   not b[2]):
+            self._note_off(b[0] & 0x0F, b[1], emit)
+            return
+        out = self._out
+        del out[:]
+        self._stage.send(rx)
+        if command == NOTE_ON:
+            key = (b[0] & 0x0F) << 7 | b[1]
+            # a repeated note-on first releases what the last one caused
+            if key in self._caused:
+                self._note_off(b[0] & 0x0F, b[1], emit)
+            caused = []
+            for msg in out:
+                m = _byte_buffer(msg)
+                if m[0] & 0xF0 == NOTE_ON and len(m) > 2 and m[2]:
+                    o = (m[0] & 0x0F) << 7 | m[1]
+                    caused.append(o)
+                    self._holds[o] += 1
+            if caused:
+                self._caused[key] = caused
+        for msg in out:
+            self.state.update_message(msg, t)
+            emit(msg)
+
+    def _note_off(self, channel, note, emit):
+        caused = self._caused.pop(channel << 7 | note, ())
+        holds = self._holds
+        for o in caused:
+            if holds[o]:
+                holds[o] -= 1
+                if not holds[o]:
+                    self.state.note_off(o >> 7, o & 0x7F)
+                    emit(_pack((NOTE_OFF | o >> 7, o & 0x7F, 0)))
+
+    def send(self, rx):
+        if not isinstance(rx, MessageBatch):
+            self._message(rx, clock(), self.target.send)
+            return
+        batch = MessageBatch()
+        append = batch.append
+        now = [0.0]
+        arrived = clock()
+
+        def emit(msg):
+            m = bytearray(msg)
+            append(m[0], m[1], m[2] if len(m) > 2 else 0, now[0])
+        for msg, t in zip(rx.iter_bytes(), rx.timestamp):
+            now[0] = t
+            self._message(msg, t or arrived, emit)
+        if batch:
+            self.target.send(batch)
+
+    def close(self):
+        self.release()
+        self.target.close()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
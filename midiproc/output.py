@@ -0,0 +1,338 @@
+"""
+coalescing MIDI output
+
+midi_writer makes one write() per message, and sends every status byte.
+OutputSink collects messages into one buffer and writes it in a single
+call per send() (a MessageBatch, such as a Scheduler group, is one
+send), or per `tick` seconds when tick is set. On the way it applies
+running status: a channel message whose status byte matches the last
+one sent goes out as its data bytes only, which saves a third of the
+bytes of a run of note messages on a serial link.
+
+An optional rate limiter paces writes to the bandwidth of a DIN link
+(31250 baud with 10 bits per byte, so 3125 bytes a second) for devices
+which would otherwise drop what they can't send in time.
+
+By default single messages are held for up to DEFAULT_TICK (1 ms,
+about the time one note message takes on a DIN link) and written
+together, with a timer thread making sure nothing waits longer than
+that when the stream goes quiet.
+"""
+
+from array import array
+import os
+import threading
+import time
+
+from .batch import MessageBatch, is_two_byte
+from .device import clock
+
+DIN_BAUD = 31250
+# how long single messages are held for, by default
+DEFAULT_TICK = 0.001
+
+if b'\x00'[0] == 0:
+    _byte_buffer = lambda data: data
+    _INDEXED = True
+else:
+    _byte_buffer = bytearray
+    _INDEXED = False
+
+# number of data bytes following each status byte (0 for sysex, which
+# runs up to EOX, and for data bytes)
+_DATA_LENGTH = array('B', [0] * 128 + [2] * 64 + [1] * 32 + [2] * 16 +
+                     [0, 1, 2, 1] + [0] * 12)
+# (status << 2 | length) -> 1 for a whole channel message
+_WHOLE = bytearray(1024)
+for _s in range(0x80, 0xF0):
+    _WHOLE[_s << 2 | 1 + _DATA_LENGTH[_s]] = 1
+
+
+class RunningStatus(object):
+    """
+    Transmit-side running status, carrying the last status sent across
+    calls. System common and sysex messages cancel running status;
+    realtime bytes leave it alone.
+
+    >>> rs = RunningStatus()
+    >>> out = bytearray()
+    >>> rs.encode(b'\\x90\\x3c\\x64', out)
+    >>> rs.encode(b'\\x90\\x3e\\x64\\xf8\\x80\\x3c\\x00', out)
+    >>> bytes(out) == b'\\x90\\x3c\\x64\\x3e\\x64\\xf8\\x80\\x3c\\x00'
+    True
+    """
+
+    def __init__(self):
+        self.status = 0
+        self.dropped = 0
+
+    def reset(self):
+        "send the next status byte whatever it is, e.g. after an error"
+        self.status = 0
+
+    def encode(self, data, out):
+        """
+        append the messages in data (bytes holding one or more whole
+        messages) to the bytearray out, dropping repeated status bytes.
+        Data bytes with no status of their own pass through unchanged.
+        """
+        buf = _byte_buffer(data)
+        n = len(buf)
+        rstat = self.status
+        if n and 0x80 <= buf[0] < 0xF0 and n == 1 + _DATA_LENGTH[buf[0]]:
+            # the usual case: a single channel message
+            if buf[0] == rstat:
+                out += buf[1:]
+                self.dropped += 1
+            else:
+                out += buf
+                self.status = buf[0]
+            return
+        i = 0
+        while i < n:
+            b = buf[i]
+            if b < 0x80 or b >= 0xF8:
+                out.append(b)
+                i += 1
+            elif b < 0xF0:
+                if b != rstat:
+                    out.append(b)
+                    rstat = b
+                else:
+                    self.dropped += 1
+                end = i + 1 + _DATA_LENGTH[b]
+                out += buf[i + 1:end]
+                i = end
+            else:
+                rstat = 0
+                if b == 0xF0:
+                    end = bytes(buf).find(b'\xf7', i) + 1 or n
+                else:
+                    end = i + 1 + _DATA_LENGTH[b]
+                out += buf[i:end]
+                i = end
+        self.status = rstat
+
+    def encode_batch(self, batch, out):
+        "as encode(), for the messages of a MessageBatch"
+        rstat = self.status
+        append = out.append
+        dropped = 0
+        for s, d1, d2 in zip(batch.status, batch.data1, batch.data2):
+            if s != rstat:
+                append(s)
+                rstat = s
+            else:
+                dropped += 1
+            append(d1)
+            if not is_two_byte(s):
+                append(d2)
+        self.status = rstat
+        self.dropped += dropped
+
+
+class OutputSink(object):
+    """
+    Sink writing messages to a device with as few writes as possible.
+
+    `device` is anything with a write() method (an unbuffered file,
+    a pylibftdi Device) or a file descriptor. Messages are held until
+    `tick` seconds after the first one pending (or until max_buffer
+    bytes are waiting), then written in one go. A daemon thread flushes
+    them when the tick is up; with timer=False there is none, and as
+    with FramedSink the tick is only checked when a message arrives or
+    poll() is called, so the caller must poll() every tick or so if
+    the stream can go quiet. close() flushes whatever is left.
+
+    With tick=0, each send() is written at once, and without baud a
+    single channel message is written straight from send(), with no
+    buffering.
+
+    With baud set (DIN_BAUD for a standard MIDI port), each write waits
+    until the previous one would have gone out on the wire.
+    """
+
+    def __init__(self, device, running_status=True, tick=DEFAULT_TICK,
+                 baud=None, max_buffer=4096, timer=True):
+        self.device = device
+        if hasattr(device, 'write'):
+            self._write = device.write
+        else:
+            self._write = lambda data: os.write(device, data)
+        self.encoder = RunningStatus() if running_status else None
+        self.tick = tick
+        self.bytes_per_second = baud / 10.0 if baud else None
+        self.max_buffer = max_buffer
+        self.messages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.writes = 0
+        self._buf = bytearray()
+        self._first = None
+        self._wire_free = 0.0
+        self._lock = threading.Lock()
+        self._timer = bool(tick and timer)
+        if not tick and not baud:
+            self.send = self._send_now
+        elif tick:
+            self.send = self._send_held if _INDEXED else self._send_locked
+        if self._timer:
+            self._wake = threading.Event()
+            self._stopped = False
+            thread = threading.Thread(target=self._run_timer)
+            thread.daemon = True
+            thread.start()
+
+    def _run_timer(self):
+        # flush what is pending once it has waited tick seconds; sends
+        # wake the thread when the buffer stops being empty
+        wake = self._wake
+        lock = self._lock
+        while True:
+            wake.wait()
+            with lock:
+                if self._stopped:
+                    return
+                if not self._buf:
+                    wake.clear()
+                    continue
+                wait = self._first + self.tick - clock()
+                if wait <= 0:
+                    self._flush()
+                    wake.clear()
+                    continue
+            time.sleep(wait)
+
+    def _send_locked(self, rx):
+        with self._lock:
+            OutputSink.send(self, rx)
+
+    def _send_held(self, rx):
+        # the usual single channel message goes straight into the buffer
+        n = len(rx)
+        if n > 3 or rx.__class__ is MessageBatch:
+            return self._send_locked(rx)
+        s = rx[0] if n else 0
+        if not _WHOLE[s << 2 | n]:
+            return self._send_locked(rx)
+        with self._lock:
+            buf = self._buf
+            before = len(buf)
+            self.messages += 1
+            self.bytes_in += n
+            encoder = self.encoder
+            if encoder is not None and s == encoder.status:
+                buf += rx[1:]
+                encoder.dropped += 1
+            else:
+                if encoder is not None:
+                    encoder.status = s
+                buf += rx
+            if not before:
+                self._first = clock()
+                if self._timer:
+                    self._wake.set()
+            elif len(buf) >= self.max_buffer or \
+                    clock() - self._first >= self.tick:
+                self._flush()
+
+    def _send_now(self, rx):
+        # nothing to hold back or pace: the usual single channel message
+        # goes straight to the device, skipping the buffer
+        if rx.__class__ is MessageBatch:
+            return OutputSink.send(self, rx)
+        b = _byte_buffer(rx)
+        n = len(b)
+        s = b[0] if n else 0
+        if n > 3 or not _WHOLE[s << 2 | n]:
+            return OutputSink.send(self, rx)
+        self.messages += 1
+        self.bytes_in += n
+        self.writes += 1
+        encoder = self.encoder
+        if encoder is not None and s == encoder.status:
+            self._write(rx[1:])
+            encoder.dropped += 1
+            self.bytes_out += n - 1
+        else:
+            if encoder is not None:
+                encoder.status = s
+            self._write(rx)
+            self.bytes_out += n
+
+    def send(self, rx):
+        buf = self._buf
+        before = len(buf)
+        encoder = self.encoder
+        if isinstance(rx, MessageBatch):
+            self.messages += len(rx)
+            if encoder is not None:
+                dropped = encoder.dropped
+                encoder.encode_batch(rx, buf)
+                self.bytes_in += encoder.dropped - dropped
+            else:
+                buf += rx.to_bytes()
+        else:
+            self.messages += 1
+            if encoder is not None:
+                dropped = encoder.dropped
+                encoder.encode(rx, buf)
+                self.bytes_in += encoder.dropped - dropped
+            else:
+                buf += rx
+        self.bytes_in += len(buf) - before
+        if not self.tick:
+            self._flush()
+            return
+        if not before:
+            self._first = clock()
+            if self._timer:
+                self._wake.set()
+        if len(buf) >= self.max_buffer or \
+                before and clock() - self._first >= self.tick:
+            self._flush()
+
+    def poll(self, now=None):
+        "flush if the oldest pending message has waited tick seconds"
+        if self._buf:
+            if now is None:
+                now = clock()
+            if now - self._first >= self.tick:
+                self.flush()
+
+    def flush(self):
+        "write whatever is pending now"
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        buf = self._buf
+        if not buf:
+            return
+        rate = self.bytes_per_second
+        if rate:
+            wait = self._wire_free - clock()
+            if wait > 0:
+                time.sleep(wait)
+        data = bytes(buf)
+        del buf[:]
+        self._write(data)
+        self.writes += 1
+        self.bytes_out += len(data)
+        if rate:
+            self._wire_free = max(clock(), self._wire_free) + \
+                len(data) / rate
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            if self._timer:
+                self._stopped = True
+                self._wake.set()
+        if hasattr(self.device, 'close'):
+            self.device.close()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,168 @@
+"""
+process-pool execution of stage chains
+
+chain() runs everything on one core. The executor here runs the same
+stage factories in a multiprocessing pool, sharding the work either by
+file (one SMF per task) or by MIDI channel (one group of channels per
+task), and merges the results back into timestamp order.
+
+Stages are given as a list of factories, exactly as for chain() but
+without a source or sink: each is called with the next stage as its
+target. Everything sent to a worker must pickle, so factories should be
+module-level functions or functools.partial objects rather than lambdas.
+"""
+
+from array import array
+import multiprocessing
+
+from .batch import MessageBatch
+from .smf import read_smf
+
+
+class Collector(object):
+    """
+    sink gathering everything sent to it into a single MessageBatch;
+    single messages (bytes) are appended with the given timestamp.
+    """
+
+    def __init__(self, timestamp=0.0):
+        self.batch = MessageBatch()
+        self.timestamp = timestamp
+
+    def send(self, rx):
+        if isinstance(rx, MessageBatch):
+            self.batch.extend(rx)
+        else:
+            msg = bytearray(rx)
+            self.batch.append(msg[0], msg[1], msg[2] if len(msg) > 2 else 0,
+                              self.timestamp)
+
+    def close(self):
+        pass
+
+
+def run_stages(stages, batch):
+    "push a batch through a list of stage factories, returning the output"
+    collector = Collector()
+    target = collector
+    for fn in reversed(stages):
+        target = fn(target)
+    target.send(batch)
+    return collector.batch
+
+
+def merge_batches(batches):
+    """
+    combine batches which are each in timestamp order into one, ordered
+    by timestamp. Ties keep the order of `batches`, then within-batch
+    order.
+    """
+    merged = MessageBatch()
+    for b in batches:
+        merged.extend(b)
+    ts = merged.timestamp
+    if any(ts[i] > ts[i + 1] for i in range(len(ts) - 1)):
+        merged = merged.select(sorted(range(len(ts)), key=ts.__getitem__))
+    return merged
+
+
+def split_channels(batch, shards):
+    "split a batch into `shards` batches, by channel number modulo shards"
+    channels = array('B', [s & 0x0F for s in batch.status])
+    return [batch.compress([c % shards == n for c in channels])
+            for n in range(shards)]
+
+
+def _file_task(args):
+    stages, path, tracks = args
+    smf = read_smf(path)
+    return run_stages(stages, smf.channel_batch(tracks))
+
+
+def _named_file_task(args):
+    return args[1], _file_task(args)
+
+
+def _batch_task(args):
+    stages, batch = args
+    return run_stages(stages, batch)
+
+
+class Executor(object):
+    """
+    Runs stage chains over a multiprocessing pool.
+
+    >>> from midiproc import drop_off
+    >>> with Executor(processes=2) as ex:         # doctest: +SKIP
+    ...     results = ex.map_files([drop_off], paths)
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes)
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def map_files(self, stages, paths, tracks=None, chunksize=1):
+        """
+        load each SMF in a worker and run its channel messages through
+        stages, returning one result MessageBatch per path, in order.
+        """
+        return self.pool.map(_file_task,
+                             [(stages, p, tracks) for p in paths],
+                             chunksize)
+
+    def imap_files(self, stages, paths, tracks=None, chunksize=1):
+        """
+        as map_files, but yielding (path, result) as workers finish, in
+        whatever order that is
+        """
+        return self.pool.imap_unordered(_named_file_task,
+                                        [(stages, p, tracks) for p in paths],
+                                        chunksize)
+
+    def map_channels(self, stages, batch, shards=None):
+        """
+        run a batch through stages with its channels spread over the
+        pool, merging the output back into timestamp order, and messages
+        at the same time (such as the unstamped output of StreamParser)
+        into their order in batch. Stages must not depend on messages
+        from other channels, nor on timestamps: they see each message's
+        index in batch in its place, and the timestamps are put back on
+        the output.
+        """
+        shards = min(shards or self.processes, 16)
+        times = batch.timestamp
+        indexed = MessageBatch(batch.status, batch.data1, batch.data2,
+                               array('d', range(len(batch))))
+        parts = [p for p in split_channels(indexed, shards) if p]
+        if not parts:
+            return MessageBatch()
+        merged = merge_batches(self.pool.map(
+            _batch_task, [(stages, p) for p in parts]))
+        merged.timestamp = array('d', map(times.__getitem__,
+                                          map(int, merged.timestamp)))
+        return merge_batches([merged])
+
+    def map_pipelines(self, pipelines, batch):
+        """
+        parallel broadcast: run the same batch through each of several
+        stage lists, returning a result batch per pipeline.
+        """
+        return self.pool.map(_batch_task, [(p, batch) for p in pipelines])
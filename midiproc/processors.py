@@ -2,7 +2,13 @@
 midiproc - a coroutine-based MIDI processing package
 """
 
+from array import array
+from itertools import chain as _chain, repeat
+from operator import add, mul
+
 from .co_util import coroutine, net_source, iter_source, net_sink, NullSink, file_source
+# the other submodules are imported where they are used, so importing
+# processors (say, for chain) doesn't load devices, output and graphs
 
 EOX = b'\xF7'  # end of sysex
 SOX = b'\xF0'  # start of sysex
@@ -10,19 +16,45 @@ SYS_COM_BASE = b'\xF0'
 SYS_RT_BASE = b'\xF8'
 
 
+# the builtin, which takes a length-1 byte string on either Python
+_builtin_ord = ord
+
 if b'\x00'[0] == 0:
     # if bytestrings are already int-like, make ord an identity function
     # (this is effectively a Python3 check, but pretending it's a bit more
     # subtle than that)
     ord = lambda x: x
+    _pack = bytes
+else:
+    _pack = lambda values: bytes(bytearray(values))
+
+# tables for the batch paths of drop_off and harmonize, which work on
+# whole columns with bytes.translate and map() so their loops run in C:
+# drop_off adds a status flag (note-off 2, note-on 1) to a data2 flag
+# (velocity 0: 1), and drops messages where that comes to 2 or more
+_OFF_STATUS = _pack(2 if s == 0x80 else 1 if s == 0x90 else 0
+                    for s in range(256))
+_ZERO_DATA = _pack(1 if d == 0 else 0 for d in range(256))
+_KEEP_FLAGS = _pack(1 if n < 2 else 0 for n in range(256))
+_IS_NOTE_ON = _pack(1 if s == 0x90 else 0 for s in range(256))
+# harmonize: how many messages each note becomes, and their data1 bytes
+_HARMONY_COUNT = _pack(2 if 24 <= n < 0x38 else 1 for n in range(256))
+_HARMONY = [_pack((n, n - 24) if 24 <= n < 0x38 else (n,))
+            for n in range(256)]
+_BYTE = [_pack((n,)) for n in range(256)]
 
 
 @coroutine
 def hex_print(target=None):
     "This can be either a sink or a transparent filter"
+    from .batch import MessageBatch
     while True:
         rx = (yield)
-        if isinstance(rx, (str, bytes)):
+        if isinstance(rx, MessageBatch):
+            if rx:
+                print('\n'.join(' '.join('%02X' % c for c in bytearray(m))
+                                for m in rx.iter_bytes()))
+        elif isinstance(rx, (str, bytes)):
             print(' '.join('%02X' % (ord(c)) for c in rx))
         else:
             print('%02X ' % (rx))
@@ -32,55 +64,79 @@ def hex_print(target=None):
 
 @coroutine
 def apply_tx_running_status(target):
-    rstat = 0
-    insysex = False
-    data = (yield)
-    if not insysex:
-        rx = data[0]
-        if rx == EOX:
-            insysex = False
-        elif rx == SOX:
-            insysex = True
-        elif rx >= SYS_COM_BASE:
-            # system common - clear running status
-            rstat = 0
-        elif rx >= b'\x80':
-            if rstat == rx:
-                data = data[1:]
-            else:
-                rstat = rx
-    for byte in data:
-        target.send(data)
+    """
+    in: messages (or batches)
+    out: the same messages as bytes, without any status byte which
+    repeats the last one sent
+    """
+    from .batch import MessageBatch
+    from .output import RunningStatus
+    encoder = RunningStatus()
+    while True:
+        rx = (yield)
+        out = bytearray()
+        if isinstance(rx, MessageBatch):
+            encoder.encode_batch(rx, out)
+        else:
+            encoder.encode(rx, out)
+        if out:
+            target.send(bytes(out))
 
 
 @coroutine
-def midi_in_stream(msg_target, rt_target=None, sysex_target=None):
+def midi_in_stream(msg_target, rt_target=None, sysex_target=None,
+                   sysex_max=None, sysex_chunk=None):
+    """
+    in: single bytes
+    out: channel messages to msg_target, realtime bytes to rt_target and
+    sysex payloads (as bytes; see SysexBuffer for sysex_max and
+    sysex_chunk) to sysex_target. A sysex ends at EOX or at any other
+    non-realtime status byte.
+    """
+    from .stream import SysexBuffer, DEFAULT_SYSEX_BUFFER
     rt_target = rt_target or NullSink()
     sysex_target = sysex_target or NullSink()
+    sysex = SysexBuffer(sysex_target, sysex_max, sysex_chunk) \
+        if sysex_target else None
+    # payload bytes are gathered here and handed over a block at a time
+    pending = bytearray()
+    block = sysex_chunk or DEFAULT_SYSEX_BUFFER
     rstat = 0
     origbytecount = 0
     bytecount = 0
     msg = ''
     insysex = False
-    sysex_msg = []
     while True:
         rx = (yield)  # get a byte (in str format)
-        if (insysex and rx != EOX):
-            if sysex_target:
-                sysex_msg.append(rx)
-        elif rx >= SYS_RT_BASE:
-            # sysex or system realtime - ignore
+        if rx >= SYS_RT_BASE:
+            # realtime messages are only the single byte, and may come
+            # at any point, even inside sysex
             if rt_target:
-                # realtime messages are only the single byte
                 rt_target.send(rx)
-        elif rx == EOX:
+            continue
+        if insysex:
+            if rx < b'\x80':
+                if sysex is not None:
+                    pending += rx
+                    if len(pending) >= block:
+                        sysex.add(pending)
+                        del pending[:]
+                continue
             insysex = False
-            if sysex_target:
-                sysex_target.send(sysex_msg)
-            sysex_msg = []
-        elif rx == SOX:
+            if sysex is not None:
+                sysex.add(pending)
+                del pending[:]
+                sysex.end()
+            if rx == EOX:
+                continue
+        if rx == SOX:
             insysex = True
-            sysex_msg = []
+            rstat = 0
+            if sysex is not None:
+                sysex.start()
+        elif rx == EOX:
+            # EOX outside sysex: ignore
+            pass
         elif rx >= SYS_COM_BASE:
             # system common - clear running status
             rstat = 0
@@ -110,34 +166,43 @@ def midi_ftdi_dev():
     return d
 
 
-def midi_snddev(dev_name=None):
+def midi_snddev(dev_name=None, mode='rb'):
+    "open a MIDI device (the first found, if not named), unbuffered"
     import glob
     if dev_name is None:
         for pattern in '/dev/midi*', '/dev/snd/midi*':
             candidates = glob.glob(pattern)
             for c in candidates:
                 try:
-                    return open(c, 'rb')
-                except OSError:
+                    return open(c, mode, 0)
+                except (IOError, OSError):
                     pass
     assert dev_name is not None
-    return open(dev_name, 'rb')
+    return open(dev_name, mode, 0)
 
 
-def midi_out_ftdi():
-    midi_writer(midi_ftdi_dev())
+def midi_out_ftdi(**kwargs):
+    "output sink for an FTDI device; kwargs are as for OutputSink"
+    from .device import open_device
+    from .output import OutputSink
+    return OutputSink(open_device('ftdi'), **kwargs)
 
 
-def midi_in_ftdi(target):
-    midi_reader(midi_ftdi_dev(), target)
+def midi_in_ftdi(target, per_byte=True):
+    from .device import bulk_reader, open_device
+    bulk_reader(open_device('ftdi'), target, per_byte=per_byte)
 
 
-def midi_in_snddev(target, dev_name=None):
-    midi_reader(midi_snddev(dev_name), target)
+def midi_in_snddev(target, dev_name=None, per_byte=True):
+    from .device import bulk_reader, open_device
+    bulk_reader(open_device('snddev', dev_name), target, per_byte=per_byte)
 
 
-def midi_out_snddev(dev_name=None):
-    midi_writer(midi_snddev(dev_name))
+def midi_out_snddev(dev_name=None, **kwargs):
+    "output sink for a MIDI device; kwargs are as for OutputSink"
+    from .device import open_device
+    from .output import OutputSink
+    return OutputSink(open_device('snddev', dev_name, 'wb'), **kwargs)
 
 
 @coroutine
@@ -149,8 +214,11 @@ def midi_reader(source, target):
 
 @coroutine
 def midi_writer(target):
+    from .batch import MessageBatch
     while True:
         rx = (yield)
+        if isinstance(rx, MessageBatch):
+            rx = rx.to_bytes()
         target.write(rx)
 
 
@@ -164,44 +232,45 @@ def process_smf_track(target):
     tempo_us_per_beat = 1000000 / (120 / 60.0)
 
     # MThd header
-    expected_header = 'MThd'
+    expected_header = b'MThd'
     for i in range(4):
         rx = (yield)
-        assert rx == expected_header[i]
+        assert rx == expected_header[i:i + 1]
     length = 0
     for i in range(4):
         rx = (yield)
-        length = 256 * length + ord(rx)
+        length = 256 * length + _builtin_ord(rx)
     assert length == 6, 'expected header length of 6'
     mid_fmt = 0
     for i in range(2):
         rx = (yield)
-        mid_fmt = 256 * mid_fmt + ord(rx)
+        mid_fmt = 256 * mid_fmt + _builtin_ord(rx)
     assert mid_fmt == 0, 'only midi format 0 files supported (%d)' % mid_fmt
     track_count = 0
     for i in range(2):
         rx = (yield)
-        track_count = 256 * track_count + ord(rx)
+        track_count = 256 * track_count + _builtin_ord(rx)
     assert track_count == 1, 'wanted a single track...'
     ppqn = 0
     for i in range(2):
         rx = (yield)
-        ppqn = 256 * ppqn + ord(rx)
+        ppqn = 256 * ppqn + _builtin_ord(rx)
     # MTrk header
-    expected_header = 'MTrk'
+    expected_header = b'MTrk'
     for i in range(4):
         rx = (yield)
-        assert rx == expected_header[i]
+        assert rx == expected_header[i:i + 1]
     length = 0
     for i in range(4):
         rx = (yield)
-        length = 256 * length + ord(rx)
+        length = 256 * length + _builtin_ord(rx)
     # the data...
+    rstat = None
     while True:
         l = 0
         for count in range(4):
             z = (yield)
-            z = ord(z)
+            z = _builtin_ord(z)
             l = l * 128 + (z & 127)
             if (z & 128) == 0:
                 break
@@ -210,7 +279,7 @@ def process_smf_track(target):
         rx = (yield)
         if (rx == SOX or rx == EOX):
             rx = (yield)  # length
-            length = ord(rx)
+            length = _builtin_ord(rx)
             for b in range(length):
                 rx = (yield)  # throw it away
             continue
@@ -223,11 +292,11 @@ def process_smf_track(target):
                 tempo = 0
                 for i in range(3):
                     rx = (yield)
-                    tempo = 256 * tempo + ord(rx)
+                    tempo = 256 * tempo + _builtin_ord(rx)
                 tempo_us_per_beat = tempo
             else:  # don't care about other meta events
                 rx = (yield)  # length
-                length = ord(rx)
+                length = _builtin_ord(rx)
                 for b in range(length):
                     rx = (yield)
             continue
@@ -240,32 +309,92 @@ def process_smf_track(target):
         target.send(rstat)
         data1 = rx
         target.send(data1)
-        if not (rstat >= 0xC0 and rstat <= 0xDF):
+        if not (b'\xC0' <= rstat <= b'\xDF'):
             data2 = (yield)
             target.send(data2)
 
 
 @coroutine
 def drop_off(target):
+    from .batch import MessageBatch
     while True:
         rx = (yield)
-        if len(rx) == 3 and rx[0] == b'\x80' or (rx[0] == b'\x90' and rx[2] == b'\x00'):
+        if isinstance(rx, MessageBatch):
+            keep = bytearray(map(add,
+                                 bytearray(rx.status).translate(_OFF_STATUS),
+                                 bytearray(rx.data2).translate(_ZERO_DATA))
+                             ).translate(_KEEP_FLAGS)
+            if 0 in keep:
+                rx = rx.compress(keep)
+            if rx:
+                target.send(rx)
+            continue
+        if len(rx) == 3 and ord(rx[0]) == 0x80 or (ord(rx[0]) == 0x90 and ord(rx[2]) == 0):
             continue
         target.send(rx)
 
 
 @coroutine
 def harmonize(target):
+    from .batch import MessageBatch
     while True:
         rx = (yield)
-        if len(rx) == 3 and rx[0] == b'\x90':
+        if isinstance(rx, MessageBatch):
+            keep = bytearray(rx.status).translate(_IS_NOTE_ON)
+            if 0 in keep:
+                rx = rx.compress(keep)
+            counts = bytearray(rx.data1).translate(_HARMONY_COUNT)
+            if 2 in counts:
+                # follow each low note with its harmony, 2 octaves down
+                rx = MessageBatch(
+                    array('B', b'\x90' * sum(counts)),
+                    array('B', b''.join(map(_HARMONY.__getitem__, rx.data1))),
+                    array('B', b''.join(map(mul, map(_BYTE.__getitem__,
+                                                     rx.data2), counts))),
+                    array('d', _chain.from_iterable(map(repeat, rx.timestamp,
+                                                       counts))))
+            if rx:
+                target.send(rx)
+            continue
+        if len(rx) == 3 and ord(rx[0]) == 0x90:
             target.send(rx)
-            if rx[1] < b'\x38':
-                rx = ''.join((rx[0], chr(ord(rx[1]) - 24), rx[2]))
+            note = ord(rx[1])
+            if 24 <= note < 0x38:
+                rx = bytes(bytearray((0x90, note - 24, ord(rx[2]))))
                 target.send(rx)
 
 
-def chain(iterable):
+# drop_off and harmonize hold no state between messages, so a Graph can
+# fuse them: `kernel` is their per-message work, as source to inline
+# (compiled by graph.kernel_of when first fused). The kernels index the
+# message's bytes directly rather than through ord, which is a Python
+# function on Python 3 and would cost the calls fusing saves.
+_KERNEL_BYTES = {'b': 'rx' if b'\x00'[0] == 0 else 'bytearray(rx)'}
+drop_off.kernel = """
+if not (len(rx) == 3 and %(b)s[0] == 0x80 or
+        (%(b)s[0] == 0x90 and %(b)s[2] == 0)):
+    emit(rx)
+""" % _KERNEL_BYTES
+harmonize.kernel = """
+if len(rx) == 3 and %(b)s[0] == 0x90:
+    emit(rx)
+    if 24 <= %(b)s[1] < 0x38:
+        emit(bytes(bytearray((0x90, %(b)s[1] - 24, %(b)s[2]))))
+""" % _KERNEL_BYTES
+
+
+def chain(iterable, metrics=None):
+    """
+    connect a list of stages, each one the target of the one before, and
+    start the first (the source). With a metrics.Metrics instance, every
+    stage after the source is instrumented.
+    """
+    iterable = list(iterable)
+    if metrics is not None:
+        stage_metrics = [None] + metrics.register(iterable[1:])
     result = None
-    for fn in reversed(iterable):
-        result = fn(result) if result is not None else fn()
+    for n, fn in reversed(list(enumerate(iterable))):
+        if metrics is not None and n > 0:
+            result = metrics.wrap(fn, result, stage_metrics[n])
+        else:
+            result = fn(result) if result is not None else fn()
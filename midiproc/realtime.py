@@ -0,0 +1,290 @@
+"""
+realtime message fast path
+
+midi_in_stream and StreamParser test every byte in turn before they
+reach a realtime byte (0xF8-0xFF), and while a long sysex is in flight
+those bytes wait behind it. RealtimeDemux pulls every realtime byte out
+of a chunk in one pass (bytes.translate, so the scan runs in C),
+forwards them first, and passes the rest of the chunk on for parsing.
+Realtime bytes are legal anywhere in the stream, including inside
+sysex, so taking them out never changes the meaning of what is left.
+
+ClockTracker follows the 0xF8 timing clock (24 per quarter note) and
+start / continue / stop, keeping tempo and song position up to date on
+every tick in constant time, for tempo-synced stages to read.
+
+    >>> import functools
+    >>> clk = ClockTracker()
+    >>> chain([midi_in_snddev, functools.partial(RealtimeDemux, clk),
+    ...        midi_in_chunks, hex_print])          # doctest: +SKIP
+    >>> clk.bpm, clk.beat, clk.phase                 # doctest: +SKIP
+"""
+
+from collections import deque
+import math
+
+from .device import clock
+
+CLOCK = 0xF8
+START = 0xFA
+CONTINUE = 0xFB
+STOP = 0xFC
+ACTIVE_SENSING = 0xFE
+RESET = 0xFF
+PPQN = 24
+SENSING_TIMEOUT = 0.3  # seconds, from the MIDI specification
+
+if b'\x00'[0] == 0:
+    _byte_buffer = lambda data: data
+    _pack = bytes
+else:
+    _byte_buffer = bytearray
+    _pack = lambda values: bytes(bytearray(values))
+
+_BYTE = [_pack((i,)) for i in range(256)]
+# translate() deletion tables: everything but realtime, and realtime only
+_NOT_REALTIME = _pack(range(0xF8))
+_REALTIME = _pack(range(0xF8, 0x100))
+_CLOCK_OR_SENSING = _pack((CLOCK, ACTIVE_SENSING))
+
+
+def split_realtime(data):
+    """
+    (realtime bytes, everything else) of a chunk, each in stream order.
+
+    >>> rt, rest = split_realtime(b'\\x90\\xf8\\x3c\\x64\\xfe')
+    >>> rt == b'\\xf8\\xfe', rest == b'\\x90\\x3c\\x64'
+    (True, True)
+    """
+    data = bytes(data)
+    rt = data.translate(None, _NOT_REALTIME)
+    if not rt:
+        return rt, data
+    return rt, data.translate(None, _REALTIME)
+
+
+class RealtimeDemux(object):
+    """
+    Stage splitting realtime bytes from chunks of a raw stream.
+
+    Realtime bytes go to rt_target one at a time, before the rest of
+    the chunk goes to target (if given). Targets with a
+    feed(data, timestamp) method, such as StreamParser and ClockTracker,
+    are fed with the chunk timestamp, which is the time of arrival if
+    the chunk came through send().
+    """
+
+    def __init__(self, rt_target, target=None):
+        self.rt_target = rt_target
+        self.target = target
+        self._rt_feed = getattr(rt_target, 'feed', None)
+        self._feed = getattr(target, 'feed', None)
+
+    def send(self, data):
+        self.feed(data, clock())
+
+    def feed(self, data, timestamp=0.0):
+        rt, rest = split_realtime(data)
+        if rt:
+            if self._rt_feed is not None:
+                self._rt_feed(rt, timestamp)
+            else:
+                send = self.rt_target.send
+                for b in _byte_buffer(rt):
+                    send(_BYTE[b])
+        if rest and self.target is not None:
+            if self._feed is not None:
+                self._feed(rest, timestamp)
+            else:
+                self.target.send(rest)
+
+    def close(self):
+        if self.target is not None:
+            self.target.close()
+
+
+class ClockTracker(object):
+    """
+    Tempo and position from MIDI clock.
+
+    Tempo is averaged over about the last `window` clock intervals (a
+    moving window, updated in constant time per chunk). Clocks which
+    arrive together, in one chunk or with one timestamp, are spread
+    evenly over the time since the clocks before them, so a device or
+    ring buffer handing over several clocks at once doesn't give zero
+    intervals; tempo only moves when the time of arrival does. Song
+    position counts clocks since the last start (or continue) while
+    running.
+
+    `bpm` is 0 until clocks have arrived at two different times.
+    `jitter` is the standard deviation of the clock interval over the
+    window, in seconds.
+
+    Anything sent is passed on to target, if one is given.
+
+    >>> clk = ClockTracker()
+    >>> for i in range(49):
+    ...     clk.feed(b'\\xf8', i * 0.02)
+    >>> round(clk.bpm, 3), clk.ticks, clk.running
+    (125.0, 0, False)
+    >>> clk.feed(b'\\xfa' + b'\\xf8' * 36, 1.0)
+    >>> clk.beat, clk.phase
+    (1, 0.5)
+    >>> clk.feed(b'\\xf8' * 12, 1.0)
+    >>> clk.feed(b'\\xf8' * 12, 1.48)
+    >>> round(clk.bpm, 3), round(clk.jitter, 6)
+    (125.0, 0.0)
+    """
+
+    def __init__(self, target=None, ppqn=PPQN, window=PPQN):
+        self.target = target
+        self.ppqn = ppqn
+        self.window = window
+        # (seconds per clock, clocks) for each arrival time in the window
+        self._times = deque()
+        self._clocks = 0
+        self._sum = 0.0
+        self._sum_sq = 0.0
+        self._pending = 0
+        self.last_clock = None
+        self.last_sensing = None
+        self.running = False
+        self.ticks = 0
+
+    def reset(self):
+        "forget tempo and position"
+        self._times.clear()
+        self._clocks = self._pending = 0
+        self._sum = self._sum_sq = 0.0
+        self.last_clock = None
+        self.running = False
+        self.ticks = 0
+
+    def send(self, data):
+        self.feed(data, clock())
+
+    def feed(self, data, timestamp=0.0):
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        if not data.translate(None, _CLOCK_OR_SENSING):
+            # just clocks and active sensing, the usual case: count them
+            clocks = data.count(_BYTE[CLOCK])
+            if clocks < len(data):
+                self.last_sensing = timestamp
+            if self.running:
+                self.ticks += clocks
+        else:
+            # transport messages: take the bytes in order
+            clocks = 0
+            for b in _byte_buffer(data):
+                if b == CLOCK:
+                    clocks += 1
+                    if self.running:
+                        self.ticks += 1
+                elif b == START:
+                    self.running = True
+                    self.ticks = 0
+                elif b == CONTINUE:
+                    self.running = True
+                elif b == STOP:
+                    self.running = False
+                elif b == ACTIVE_SENSING:
+                    self.last_sensing = timestamp
+                elif b == RESET:
+                    self.reset()
+                    clocks = 0
+        if clocks:
+            self._clock(timestamp, clocks)
+        if self.target is not None:
+            self.target.send(data)
+
+    def _clock(self, t, clocks):
+        # `clocks` clocks arrived at time t
+        last = self.last_clock
+        if last is None:
+            # the first clock only marks the time
+            self.last_clock = t
+            return
+        self._pending += clocks
+        if t <= last:
+            # no time has passed: wait for clocks which arrive later
+            return
+        n = self._pending
+        self._pending = 0
+        self.last_clock = t
+        interval = (t - last) / n
+        times = self._times
+        times.append((interval, n))
+        self._clocks += n
+        self._sum += interval * n
+        self._sum_sq += interval * interval * n
+        while self._clocks - times[0][1] >= self.window:
+            old, k = times.popleft()
+            self._clocks -= k
+            self._sum -= old * k
+            self._sum_sq -= old * old * k
+
+    @property
+    def interval(self):
+        "mean seconds between clocks, or 0.0 if unknown"
+        n = self._clocks
+        return self._sum / n if n else 0.0
+
+    @property
+    def bpm(self):
+        interval = self.interval
+        return 60.0 / (interval * self.ppqn) if interval > 0 else 0.0
+
+    @property
+    def jitter(self):
+        n = self._clocks
+        if not n:
+            return 0.0
+        mean = self._sum / n
+        return math.sqrt(max(0.0, self._sum_sq / n - mean * mean))
+
+    @property
+    def beat(self):
+        "whole beats (quarter notes) since start"
+        return self.ticks // self.ppqn
+
+    @property
+    def phase(self):
+        "position within the current beat, from 0.0 up to 1.0"
+        return (self.ticks % self.ppqn) / float(self.ppqn)
+
+    def beat_at(self, t):
+        """
+        the (fractional) beat position at time t, extrapolated from the
+        last clock at the current tempo
+        """
+        position = float(self.ticks)
+        interval = self.interval
+        if self.running and interval > 0 and self.last_clock is not None:
+            position += (t - self.last_clock) / interval
+        return position / self.ppqn
+
+    def next_beat_time(self):
+        "when the next beat is due at the current tempo, or None"
+        interval = self.interval
+        if not interval or self.last_clock is None:
+            return None
+        return self.last_clock + (self.ppqn - self.ticks % self.ppqn) * \
+            interval
+
+    def sensing_lost(self, now=None):
+        "True if active sensing was seen but has since stopped"
+        if self.last_sensing is None:
+            return False
+        if now is None:
+            now = clock()
+        return now - self.last_sensing > SENSING_TIMEOUT
+
+    def close(self):
+        if self.target is not None:
+            self.target.close()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
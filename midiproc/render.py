@@ -0,0 +1,256 @@
+"""
+writing Standard MIDI Files, and offline rendering
+
+process_smf_track sleeps out every delta as it goes, so transforming a
+file through harmonize takes as long as playing it. render() instead
+runs stages over the parsed event table of a MidiFile as fast as they
+will go, one MessageBatch per track, and write_smf() encodes the result
+into a single buffer (variable-length deltas, running status) and
+writes it with one call.
+
+Timestamps passed through the stages are in ticks rather than seconds,
+so every event keeps its exact position in the file. Meta and sysex
+events (tempo, names, and so on) don't go through the stages; they are
+put back in their places afterwards.
+
+    >>> render_file('in.mid', 'out.mid', [drop_off, harmonize])  # doctest: +SKIP
+"""
+
+from __future__ import with_statement
+
+from array import array
+import struct
+
+from .batch import MessageBatch
+from .smf import EventTable, read_smf, SMFError, META, SYSEX, \
+    META_END_OF_TRACK
+
+DEFAULT_DIVISION = 480
+END_OF_TRACK = b'\xff\x2f\x00'
+
+
+def vlq(value):
+    """
+    a variable-length quantity as used in SMF deltas and lengths
+
+    >>> vlq(0) == b'\\x00', vlq(0x80) == b'\\x81\\x00'
+    (True, True)
+    """
+    if value < 0:
+        raise ValueError('negative VLQ %d' % value)
+    out = bytearray((value & 0x7F,))
+    value >>= 7
+    while value:
+        out.append(0x80 | (value & 0x7F))
+        value >>= 7
+    out.reverse()
+    return bytes(out)
+
+
+# deltas below a bar or two at common divisions, encoded the first time
+# a track is (not every time the module is imported)
+_VLQ = []
+
+
+def _vlq_table():
+    if not _VLQ:
+        _VLQ[:] = [vlq(i) for i in range(1 << 14)]
+    return _VLQ
+
+
+def encode_track(events, order=None, running_status=True):
+    """
+    the body of an MTrk chunk holding events (an EventTable) in the
+    given order of indices (default, table order), ending with end of
+    track (at the tick of the table's own end of track, if that is
+    later than the last event). Ticks must not go backwards.
+    """
+    tick, status, data1, data2 = (events.tick, events.status, events.data1,
+                                  events.data2)
+    offset, length = events.offset, events.length
+    data = memoryview(events.data) if events.data is not None else None
+    if order is None:
+        order = range(len(events))
+    out = bytearray()
+    append = out.append
+    cached = _vlq_table()
+    ncached = len(cached)
+    last = end = 0
+    rstat = 0
+    for i in order:
+        s = status[i]
+        t = tick[i]
+        if s < SYSEX:
+            delta = t - last
+            last = t
+            out += cached[delta] if 0 <= delta < ncached else vlq(delta)
+            if s != rstat:
+                append(s)
+                if running_status:
+                    rstat = s
+            append(data1[i])
+            if not 0xC0 <= s <= 0xDF:
+                append(data2[i])
+            continue
+        if s == META and data1[i] == META_END_OF_TRACK:
+            end = t
+            continue
+        delta = t - last
+        last = t
+        out += cached[delta] if 0 <= delta < ncached else vlq(delta)
+        # meta and sysex events cancel running status
+        rstat = 0
+        append(s)
+        if s == META:
+            append(data1[i])
+        n = length[i]
+        out += vlq(n)
+        if n:
+            out += data[offset[i]:offset[i] + n]
+    # end of track where the table had it, if that is later
+    out += vlq(max(0, end - last))
+    out += END_OF_TRACK
+    return out
+
+
+def encode_smf(events, division=DEFAULT_DIVISION, fmt=None,
+               running_status=True):
+    """
+    a whole Standard MIDI File, as bytes, from an EventTable whose
+    track column says which MTrk each event goes in. fmt defaults to 0
+    for a single track and 1 otherwise.
+    """
+    ntracks = max(events.track) + 1 if len(events) else 1
+    if fmt is None:
+        fmt = 0 if ntracks == 1 else 1
+    if fmt == 0 and ntracks != 1:
+        raise SMFError('format 0 needs a single track, not %d' % ntracks)
+    by_track = [[] for _ in range(ntracks)]
+    for i, t in enumerate(events.track):
+        by_track[t].append(i)
+    out = bytearray(b'MThd' + struct.pack('>IHHH', 6, fmt, ntracks,
+                                          division))
+    for order in by_track:
+        body = encode_track(events, order, running_status)
+        out += b'MTrk' + struct.pack('>I', len(body))
+        out += body
+    return bytes(out)
+
+
+def write_smf(path, events, division=DEFAULT_DIVISION, fmt=None,
+              running_status=True):
+    "write an EventTable as a Standard MIDI File in one go"
+    data = encode_smf(events, division, fmt, running_status)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return len(data)
+
+
+class _TickCollector(object):
+    # sink gathering a chain's output; single messages are given the
+    # tick of the message which caused them
+
+    def __init__(self):
+        self.batch = MessageBatch()
+        self.tick = 0.0
+
+    def send(self, rx):
+        if isinstance(rx, MessageBatch):
+            self.batch.extend(rx)
+        else:
+            msg = bytearray(rx)
+            if msg and 0x80 <= msg[0] < SYSEX:
+                self.batch.append(msg[0], msg[1],
+                                  msg[2] if len(msg) > 2 else 0, self.tick)
+
+    def close(self):
+        pass
+
+
+def _track_batch(events, indices):
+    # channel events of one track, timestamped in ticks
+    tick, status, data1, data2 = (events.tick, events.status, events.data1,
+                                  events.data2)
+    channel = [i for i in indices if status[i] < SYSEX]
+    return MessageBatch(array('B', [status[i] for i in channel]),
+                        array('B', [data1[i] for i in channel]),
+                        array('B', [data2[i] for i in channel]),
+                        array('d', [tick[i] for i in channel]))
+
+
+def render(smf, stages, per_message=False):
+    """
+    run the channel events of each track of a MidiFile through stages
+    (factories as for chain(), without source or sink; built afresh for
+    each track) without any pacing, returning an EventTable of the
+    output with the meta and sysex events of the original.
+
+    Each track goes through as one MessageBatch, or with per_message a
+    message at a time, for stages which don't handle batches. Stages
+    are closed at the end of each track; anything they send then lands
+    on the last tick.
+    """
+    events = smf.events
+    ntracks = max(events.track) + 1 if len(events) else 0
+    by_track = [[] for _ in range(ntracks)]
+    for i, t in enumerate(events.track):
+        by_track[t].append(i)
+    out = EventTable(events.data)
+    columns = out.columns()
+    for track, indices in enumerate(by_track):
+        collector = _TickCollector()
+        target = collector
+        for fn in reversed(stages):
+            target = fn(target)
+        batch = _track_batch(events, indices)
+        if per_message:
+            for view, t in zip(batch, batch.timestamp):
+                collector.tick = t
+                target.send(view.to_bytes())
+        elif batch:
+            target.send(batch)
+        if indices:
+            collector.tick = events.tick[indices[-1]]
+        target.close()
+        result = collector.batch
+        # meta and sysex events first at equal ticks, then the output
+        rows, ends = [], []
+        for i in indices:
+            if events.status[i] >= SYSEX:
+                row = (events.tick[i], events.track[i], events.status[i],
+                       events.data1[i], 0, events.offset[i], events.length[i])
+                if row[2] == META and row[3] == META_END_OF_TRACK:
+                    ends.append(row)
+                else:
+                    rows.append(row)
+        rows.extend((int(round(t)), track, s, d1, d2, 0, 0)
+                    for s, d1, d2, t in zip(result.status, result.data1,
+                                            result.data2, result.timestamp))
+        rows.sort(key=lambda r: r[0])
+        if ends:
+            # end of track stays last, however late the output runs
+            last = rows[-1][0] if rows else 0
+            end = ends[-1]
+            rows.append((max(end[0], last),) + end[1:])
+        for col, values in zip(columns, zip(*rows)):
+            col.extend(values)
+    return out
+
+
+def render_file(src, dst, stages, per_message=False, cache=None,
+                running_status=True):
+    """
+    render an SMF through stages to a new file in the same format and
+    division. Returns the output EventTable.
+    """
+    smf = read_smf(src, cache=cache)
+    out = render(smf, stages, per_message)
+    if not len(out):
+        raise SMFError('%s: nothing to write' % src)
+    write_smf(dst, out, smf.division, smf.format, running_status)
+    return out
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,341 @@
+"""
+decoupling input from processing with a ring buffer
+
+A blocking source such as midi_in_snddev calls straight into the stages
+after it, so a slow stage (hex_print writing to a terminal) holds up
+reading, and the kernel drops what it can't buffer. decoupled() runs the
+source on a thread of its own, writing into a RingBuffer, while the
+calling thread drains the buffer into the rest of the chain.
+
+RingBuffer is single producer, single consumer: only the producer moves
+`head` and only the consumer moves `tail`, so neither side takes a lock
+(both rely on the GIL making each counter update atomic). Storage is
+allocated up front as `slots` fixed-size slots; a message longer than a
+slot takes several consecutive ones. What happens when the buffer is
+full is chosen by `policy`:
+
+    DROP_NEWEST  the message being put is discarded (the default)
+    DROP_OLDEST  the oldest slots are overwritten; the consumer notices
+                 and skips them
+    BLOCK        the producer waits for space
+
+    >>> import functools
+    >>> from midiproc import midi_in_snddev, midi_in_chunks, hex_print
+    >>> chain([functools.partial(decoupled,
+    ...                          functools.partial(midi_in_snddev,
+    ...                                            per_byte=False)),
+    ...        midi_in_chunks, hex_print])          # doctest: +SKIP
+"""
+
+from array import array
+import threading
+
+from .batch import MessageBatch
+from .device import clock
+
+DROP_NEWEST = 'drop-newest'
+DROP_OLDEST = 'drop-oldest'
+BLOCK = 'block'
+POLICIES = (DROP_NEWEST, DROP_OLDEST, BLOCK)
+
+# how long either side sleeps at most between checks when waiting
+_POLL = 0.01
+
+
+class RingBuffer(object):
+    """
+    Preallocated SPSC queue of byte strings with timestamps.
+
+    put() copies each message into the preallocated storage rather
+    than keeping it, so nothing lives on per message; the copy itself
+    still makes short-lived slice objects. Counters: `overflows` (puts which found the
+    buffer full), `dropped` (messages lost: discarded by drop-newest,
+    too long for the whole buffer, or slots overwritten by
+    drop-oldest) and `high_water` (greatest depth seen, in slots).
+
+    >>> ring = RingBuffer(slots=4, slot_size=2)
+    >>> ring.put(b'\\x90\\x3c\\x64', 1.0), ring.put(b'\\xf8', 2.0)
+    (True, True)
+    >>> ring.put(b'\\x80\\x3c\\x00')
+    False
+    >>> ring.get() == (b'\\x90\\x3c\\x64', 1.0), len(ring), ring.dropped
+    (True, 1, 1)
+    """
+
+    def __init__(self, slots=1024, slot_size=64, policy=DROP_NEWEST):
+        if policy not in POLICIES:
+            raise ValueError('unknown overflow policy %r' % (policy,))
+        self.slots = slots
+        self.slot_size = slot_size
+        self.policy = policy
+        self._data = bytearray(slots * slot_size)
+        self._view = memoryview(self._data)
+        self._length = array('H', [0]) * slots
+        self._cont = array('B', [0]) * slots
+        self._time = array('d', [0.0]) * slots
+        self.head = 0  # slots ever written; moved only by the producer
+        self.tail = 0  # slots ever consumed; moved only by the consumer
+        self._reserved = 0  # head plus any slots being written
+        self.overflows = 0
+        self.dropped = 0
+        self.high_water = 0
+        self.closed = False
+        # events are only set when the other side says it is waiting,
+        # so the fast path of put() and get() never touches a lock
+        self._readable = threading.Event()
+        self._writable = threading.Event()
+        self._reader_waiting = False
+        self._writer_waiting = False
+
+    def __len__(self):
+        "slots waiting to be read"
+        return min(self.head - self.tail, self.slots)
+
+    # producer side
+
+    def put(self, data, timestamp=0.0, timeout=None):
+        """
+        add a message, returning False if it was dropped (or, with the
+        block policy, if there was no space within timeout seconds).
+        """
+        size = self.slot_size
+        slots = self.slots
+        n = len(data)
+        need = (n + size - 1) // size or 1
+        if need > slots:
+            self.overflows += 1
+            self.dropped += 1
+            return False
+        head = self.head
+        if slots - (head - self.tail) < need:
+            self.overflows += 1
+            if self.policy == DROP_NEWEST:
+                self.dropped += 1
+                return False
+            if self.policy == BLOCK and not self._wait_space(need, timeout):
+                self.dropped += 1
+                return False
+        self._reserved = head + need
+        view = self._view
+        if need == 1:
+            i = head % slots
+            start = i * size
+            view[start:start + n] = data
+            self._length[i] = n
+            self._cont[i] = 0
+            self._time[i] = timestamp
+        else:
+            self._put_slots(data, timestamp, head, need)
+        self.head = head + need
+        depth = self.head - self.tail
+        if depth > self.high_water:
+            self.high_water = min(depth, slots)
+        if self._reader_waiting:
+            self._readable.set()
+        return True
+
+    def _put_slots(self, data, timestamp, head, need):
+        size = self.slot_size
+        slots = self.slots
+        view = self._view
+        for k in range(need):
+            i = (head + k) % slots
+            part = data[k * size:(k + 1) * size]
+            start = i * size
+            view[start:start + len(part)] = part
+            self._length[i] = len(part)
+            self._cont[i] = k > 0
+            self._time[i] = timestamp
+
+    def _wait_space(self, need, timeout):
+        deadline = None if timeout is None else clock() + timeout
+        self._writer_waiting = True
+        try:
+            while self.slots - (self.head - self.tail) < need:
+                self._writable.clear()
+                if self.slots - (self.head - self.tail) >= need:
+                    break
+                wait = _POLL
+                if deadline is not None:
+                    wait = min(wait, deadline - clock())
+                    if wait <= 0:
+                        return False
+                self._writable.wait(wait)
+        finally:
+            self._writer_waiting = False
+        return True
+
+    def close(self):
+        "no more messages will be put"
+        self.closed = True
+        self._readable.set()
+
+    # consumer side
+
+    def _skip_lost(self):
+        # with drop-oldest, jump past anything the producer overwrote,
+        # then past the rest of any message whose start was lost
+        lost = self._reserved - self.tail - self.slots
+        if lost > 0:
+            self.tail += lost
+            self.dropped += lost
+        while self.tail < self.head and self._cont[self.tail % self.slots]:
+            self.tail += 1
+
+    def _wait_data(self, timeout):
+        # True once there is something to read (or the ring is closed)
+        if self.head != self.tail or self.closed:
+            return True
+        deadline = None if timeout is None else clock() + timeout
+        self._reader_waiting = True
+        try:
+            while self.head == self.tail and not self.closed:
+                self._readable.clear()
+                if self.head != self.tail or self.closed:
+                    break
+                wait = _POLL
+                if deadline is not None:
+                    wait = min(wait, deadline - clock())
+                    if wait <= 0:
+                        return False
+                self._readable.wait(wait)
+        finally:
+            self._reader_waiting = False
+        return True
+
+    def _copy(self, out, tail, end):
+        size = self.slot_size
+        view = self._view
+        length = self._length
+        slots = self.slots
+        for j in range(tail, end):
+            i = j % slots
+            start = i * size
+            out += view[start:start + length[i]]
+
+    def get(self, timeout=None):
+        """
+        the next message and its timestamp, or None if there is nothing
+        within timeout seconds, or the ring is closed and empty.
+        """
+        while self._wait_data(timeout):
+            self._skip_lost()
+            tail = self.tail
+            head = self.head
+            if tail == head:
+                if self.closed:
+                    return None
+                continue
+            end = tail + 1
+            while end < head and self._cont[end % self.slots]:
+                end += 1
+            out = bytearray()
+            self._copy(out, tail, end)
+            t = self._time[tail % self.slots]
+            if self._reserved - tail > self.slots:
+                # overwritten while being copied
+                continue
+            self.tail = end
+            if self._writer_waiting:
+                self._writable.set()
+            return bytes(out), t
+        return None
+
+    def read(self, timeout=None):
+        """
+        everything waiting, as one byte string with the timestamp of its
+        first message; None as for get().
+        """
+        while self._wait_data(timeout):
+            self._skip_lost()
+            tail = self.tail
+            head = self.head
+            if tail == head:
+                if self.closed:
+                    return None
+                continue
+            out = bytearray()
+            self._copy(out, tail, head)
+            t = self._time[tail % self.slots]
+            if self._reserved - tail > self.slots:
+                continue
+            self.tail = head
+            if self._writer_waiting:
+                self._writable.set()
+            return bytes(out), t
+        return None
+
+    def drain(self, target, coalesce=True, per_byte=False, timeout=None):
+        """
+        deliver everything put into the ring to target until it is
+        closed and empty (or nothing arrives within timeout seconds).
+        With coalesce, all waiting bytes go as one chunk (for byte
+        streams); otherwise messages go one by one. Targets with a
+        feed(data, timestamp) method are fed; with per_byte, data is
+        sent a byte at a time (for midi_in_stream).
+        """
+        take = self.read if coalesce else self.get
+        feed = getattr(target, 'feed', None)
+        send = getattr(target, 'send', None)
+        while True:
+            item = take(timeout)
+            if item is None:
+                return
+            data, t = item
+            if per_byte:
+                for i in range(len(data)):
+                    send(data[i:i + 1])
+            elif feed is not None:
+                feed(data, t)
+            else:
+                send(data)
+
+    def register(self, metrics, name='ring'):
+        "add gauges for depth and losses to a Metrics instance"
+        metrics.gauge(name + '_depth', self.__len__)
+        metrics.gauge(name + '_dropped', lambda: self.dropped)
+        metrics.gauge(name + '_overflows', lambda: self.overflows)
+
+
+class RingSink(object):
+    "sink putting everything sent to it into a RingBuffer, stamped on arrival"
+
+    def __init__(self, ring):
+        self.ring = ring
+
+    def send(self, rx):
+        if isinstance(rx, MessageBatch):
+            rx = rx.to_bytes()
+        self.ring.put(rx, clock())
+
+    def close(self):
+        self.ring.close()
+
+
+def decoupled(source, target, ring=None, coalesce=True, per_byte=False,
+              **kwargs):
+    """
+    run source (called with a sink, as the first entry of a chain is) on
+    a daemon thread feeding a RingBuffer, and drain the ring into target
+    on this one until the source finishes. kwargs are for RingBuffer, if
+    none is given. Returns the ring, for its counters.
+    """
+    if ring is None:
+        ring = RingBuffer(**kwargs)
+    sink = RingSink(ring)
+
+    def produce():
+        try:
+            source(sink)
+        finally:
+            ring.close()
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    ring.drain(target, coalesce, per_byte)
+    return ring
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,138 @@
+"""
+deadline-based playback scheduling
+
+process_smf_track sleeps for each delta as it parses, so timing errors
+accumulate over a file and every event of a chord costs a sleep() call.
+Scheduler instead plays a time-stamped MessageBatch against absolute
+deadlines measured from a single start time: events sharing a timestamp
+go out as one batch, and each wait is a coarse sleep followed by a short
+spin on a high resolution clock.
+"""
+
+import math
+import time
+
+from .smf import read_smf
+
+# perf_counter is Python 3.3+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class PlaybackStats(object):
+    """
+    Lateness of each dispatched group against its deadline, in seconds.
+    `jitter` is the standard deviation of lateness.
+    """
+
+    def __init__(self, late_threshold=0.001):
+        self.late_threshold = late_threshold
+        self.groups = 0
+        self.events = 0
+        self.late = 0
+        self.max_lateness = 0.0
+        self._sum = 0.0
+        self._sum_sq = 0.0
+
+    def record(self, lateness, events):
+        self.groups += 1
+        self.events += events
+        self._sum += lateness
+        self._sum_sq += lateness * lateness
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+        if lateness > self.late_threshold:
+            self.late += 1
+
+    @property
+    def mean_lateness(self):
+        return self._sum / self.groups if self.groups else 0.0
+
+    @property
+    def jitter(self):
+        if not self.groups:
+            return 0.0
+        mean = self.mean_lateness
+        return math.sqrt(max(0.0, self._sum_sq / self.groups - mean * mean))
+
+    def __str__(self):
+        return ('%d events in %d groups: mean lateness %.1f us, max %.1f us, '
+                'jitter %.1f us, %d late (> %.1f ms)' % (
+                    self.events, self.groups, self.mean_lateness * 1e6,
+                    self.max_lateness * 1e6, self.jitter * 1e6, self.late,
+                    self.late_threshold * 1e3))
+
+
+class Scheduler(object):
+    """
+    Send the messages of a MessageBatch to `target` at the times given
+    by their timestamps (seconds from the start of playback).
+
+    Messages with equal timestamps are sent together as one
+    MessageBatch, or one by one as bytes if batch is False (for targets
+    which don't understand batches). Waiting sleeps until `spin`
+    seconds before each deadline then busy-waits the rest of the way.
+    """
+
+    def __init__(self, target, spin=0.002, batch=True, speed=1.0,
+                 late_threshold=0.001):
+        self.target = target
+        self.spin = spin
+        self.batch = batch
+        self.speed = speed
+        self.late_threshold = late_threshold
+        self.stats = None
+
+    def wait_until(self, deadline):
+        remaining = deadline - clock()
+        if remaining > self.spin:
+            time.sleep(remaining - self.spin)
+        while clock() < deadline:
+            pass
+
+    def play(self, messages, lead=0.01):
+        """
+        play a MessageBatch whose timestamps are ascending, starting
+        `lead` seconds from now. Returns PlaybackStats.
+        """
+        stats = self.stats = PlaybackStats(self.late_threshold)
+        times = messages.timestamp
+        count = len(times)
+        send = self.target.send
+        start = clock() + lead
+        speed = float(self.speed)
+        i = 0
+        while i < count:
+            t = times[i]
+            j = i + 1
+            while j < count and times[j] == t:
+                j += 1
+            deadline = start + t / speed
+            self.wait_until(deadline)
+            stats.record(clock() - deadline, j - i)
+            group = messages.slice(i, j)
+            if self.batch:
+                send(group)
+            else:
+                for msg in group.iter_bytes():
+                    send(msg)
+            i = j
+        return stats
+
+
+def play_smf(smf, target, tracks=None, **kwargs):
+    """
+    play the channel messages of a MidiFile (optionally only some of its
+    tracks) to target. Format 2 files should be played a track at a
+    time, as their tracks are independent sequences.
+    """
+    return Scheduler(target, **kwargs).play(smf.channel_batch(tracks))
+
+
+def smf_source(path, target, **kwargs):
+    """
+    source which loads the SMF at path and plays it to target in real
+    time. The target is closed at the end of playback.
+    """
+    stats = play_smf(read_smf(path), target, **kwargs)
+    target.close()
+    return stats
@@ -0,0 +1,805 @@
+"""
+Standard MIDI File reader
+
+Unlike process_smf_track, which is fed one byte per send() and sleeps as
+it goes, read_smf() loads a whole file with a single read (or an mmap),
+parses every track of a format 0, 1 or 2 file into an EventTable with
+absolute tick times, and builds a TempoMap. Parsing and playback are
+separate steps: the table can be processed offline as a MessageBatch or
+walked in time order for playback.
+
+SMFReader reads files which are too big to want whole, or still being
+written: it loads tracks one at a time, and parses appended data as it
+arrives, with checkpoints to resume from.
+"""
+
+from __future__ import with_statement
+
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import compress
+import mmap
+import os
+import time
+
+from .batch import MessageBatch, is_two_byte
+
+DEFAULT_TEMPO = 500000  # us per beat, i.e. 120 bpm
+# bump whenever parsing changes what ends up in an EventTable, so that
+# anything cached from an older parser is parsed again
+PARSER_VERSION = 2
+
+META = 0xFF
+SYSEX = 0xF0
+SYSEX_ESCAPE = 0xF7
+META_END_OF_TRACK = 0x2F
+META_TEMPO = 0x51
+
+
+class SMFError(ValueError):
+    "malformed or unsupported Standard MIDI File"
+
+
+if b'\x00'[0] == 0:
+    _byte_buffer = lambda data: data
+else:
+    _byte_buffer = lambda data: bytearray(data)
+
+
+def _u16(data, pos):
+    return (data[pos] << 8) | data[pos + 1]
+
+
+def _u32(data, pos):
+    return ((data[pos] << 24) | (data[pos + 1] << 16) |
+            (data[pos + 2] << 8) | data[pos + 3])
+
+
+class EventTable(object):
+    """
+    All the events of a file as parallel arrays, one entry per event.
+
+    - tick: absolute time in ticks
+    - track: index of the MTrk chunk the event came from
+    - status: channel status byte, 0xFF for meta events, or 0xF0 / 0xF7
+      for sysex
+    - data1, data2: channel message data bytes; data1 holds the type of
+      a meta event
+    - offset, length: location of a meta / sysex payload within the file
+      data (see payload())
+
+    Events are in time order for format 0 and 1 files (ties keep track
+    then file order), and in track order for format 2, whose tracks are
+    independent sequences.
+    """
+
+    __slots__ = ('tick', 'track', 'status', 'data1', 'data2',
+                 'offset', 'length', 'data')
+
+    def __init__(self, data=b''):
+        self.tick = array('L')
+        self.track = array('H')
+        self.status = array('B')
+        self.data1 = array('B')
+        self.data2 = array('B')
+        self.offset = array('L')
+        self.length = array('L')
+        self.data = data
+
+    def __len__(self):
+        return len(self.tick)
+
+    def columns(self):
+        return (self.tick, self.track, self.status, self.data1, self.data2,
+                self.offset, self.length)
+
+    def payload(self, index):
+        "the raw bytes of a meta or sysex event, without copying"
+        start = self.offset[index]
+        return memoryview(self.data)[start:start + self.length[index]]
+
+    def message(self, index):
+        "a channel event as its wire-format bytes"
+        status = self.status[index]
+        if is_two_byte(status):
+            return bytes(bytearray((status, self.data1[index])))
+        return bytes(bytearray((status, self.data1[index],
+                                self.data2[index])))
+
+    def channel_mask(self):
+        return [s < SYSEX for s in self.status]
+
+
+class TempoMap(object):
+    """
+    Converts ticks to seconds, following tempo changes.
+
+    >>> t = TempoMap(96, [(0, 500000), (192, 250000)])
+    >>> t.seconds(96), t.seconds(192), t.seconds(288)
+    (0.5, 1.0, 1.25)
+    """
+
+    def __init__(self, division, changes=()):
+        self.division = division
+        if division & 0x8000:
+            # SMPTE timing: -frames per second, ticks per frame
+            fps = 256 - (division >> 8)
+            if fps == 29:
+                fps = 29.97
+            self.smpte_tick = 1.0 / (fps * (division & 0xFF))
+        else:
+            self.smpte_tick = None
+        self.ticks = [0]
+        self.tempos = [DEFAULT_TEMPO]
+        for tick, tempo in sorted(changes, key=lambda c: c[0]):
+            if tick == self.ticks[-1]:
+                self.tempos[-1] = tempo
+            else:
+                self.ticks.append(tick)
+                self.tempos.append(tempo)
+        # seconds at the start of each tempo segment
+        self.starts = [0.0]
+        for i in range(1, len(self.ticks)):
+            self.starts.append(self.starts[-1] + self._span(
+                self.ticks[i] - self.ticks[i - 1], self.tempos[i - 1]))
+
+    def _span(self, ticks, tempo):
+        if self.smpte_tick is not None:
+            return ticks * self.smpte_tick
+        return ticks * tempo * 1.0e-6 / self.division
+
+    def seconds(self, tick):
+        "time in seconds of an absolute tick"
+        i = bisect_right(self.ticks, tick) - 1
+        return self.starts[i] + self._span(tick - self.ticks[i],
+                                           self.tempos[i])
+
+    def seconds_array(self, ticks):
+        """
+        times in seconds for a sequence of ascending ticks, in a single
+        pass rather than a bisect per event.
+        """
+        out = array('d')
+        append = out.append
+        seg_ticks, tempos, starts = self.ticks, self.tempos, self.starts
+        nseg = len(seg_ticks)
+        seg = 0
+        base_tick, base_sec = 0, 0.0
+        scale = self._span(1, tempos[0])
+        for tick in ticks:
+            if tick < base_tick:
+                # not ascending (format 2): restart the segment search
+                seg = bisect_right(seg_ticks, tick) - 1
+                base_tick, base_sec = seg_ticks[seg], starts[seg]
+                scale = self._span(1, tempos[seg])
+            while seg + 1 < nseg and seg_ticks[seg + 1] <= tick:
+                seg += 1
+                base_tick, base_sec = seg_ticks[seg], starts[seg]
+                scale = self._span(1, tempos[seg])
+            append(base_sec + (tick - base_tick) * scale)
+        return out
+
+
+class MidiFile(object):
+    """
+    A parsed Standard MIDI File.
+
+    `events` is the EventTable for the whole file and `tempo_map` its
+    TempoMap, built from every set-tempo meta event in the file. The
+    tracks of a format 2 file are independent sequences, each with its
+    own tempo: `tempo_maps` then holds one TempoMap per track (and
+    `tempo_map` is the first track's); otherwise it is None.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._mmap = None
+        self.format, self.ntracks, self.division, self.track_offsets = \
+            _parse_header(data)
+        self.events = _parse_tracks(data, self.track_offsets,
+                                    self.format != 2)
+        self._set_tempo_maps()
+        self._seconds = None
+
+    @classmethod
+    def from_parsed(cls, data, fmt, ntracks, division, events, tempo_map,
+                    seconds=None):
+        """
+        a MidiFile from an already parsed event table (see cache), with
+        data holding the meta and sysex payloads the table refers to
+        """
+        smf = cls.__new__(cls)
+        smf.data = data
+        smf._mmap = None
+        smf.format = fmt
+        smf.ntracks = ntracks
+        smf.division = division
+        smf.track_offsets = None
+        smf.events = events
+        if fmt == 2:
+            # rebuilt from the events, as the payloads are all in data
+            smf._set_tempo_maps()
+        else:
+            smf.tempo_map = tempo_map
+            smf.tempo_maps = None
+        smf._seconds = seconds
+        return smf
+
+    @classmethod
+    def load(cls, path, use_mmap=False):
+        """
+        read a file in one go, or map it if use_mmap is set; with mmap,
+        meta and sysex payloads stay in the mapping until close().
+        """
+        with open(path, 'rb') as f:
+            if not use_mmap:
+                return cls(f.read())
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        smf = cls(m)
+        smf._mmap = m
+        return smf
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _tempo_changes(self):
+        # (track, tick, tempo) of every set-tempo event
+        ev = self.events
+        buf = _byte_buffer(self.data)
+        changes = []
+        for i in compress(range(len(ev)), [s == META for s in ev.status]):
+            if ev.data1[i] == META_TEMPO and ev.length[i] == 3:
+                pos = ev.offset[i]
+                changes.append((ev.track[i], ev.tick[i], (buf[pos] << 16) |
+                                (buf[pos + 1] << 8) | buf[pos + 2]))
+        return changes
+
+    def _set_tempo_maps(self):
+        changes = self._tempo_changes()
+        if self.format != 2:
+            self.tempo_map = TempoMap(self.division,
+                                      [c[1:] for c in changes])
+            self.tempo_maps = None
+            return
+        per_track = [[] for _ in range(self.ntracks)]
+        for track, tick, tempo in changes:
+            per_track[track].append((tick, tempo))
+        self.tempo_maps = [TempoMap(self.division, c) for c in per_track]
+        self.tempo_map = self.tempo_maps[0] if self.tempo_maps else \
+            TempoMap(self.division)
+
+    @property
+    def seconds(self):
+        "array of event times in seconds, parallel to the event table"
+        if self._seconds is None:
+            ticks = self.events.tick
+            if self.tempo_maps is None:
+                self._seconds = self.tempo_map.seconds_array(ticks)
+            else:
+                # format 2 events are in track order: time each track's
+                # run with its own map
+                tracks = self.events.track
+                seconds = self._seconds = array('d')
+                start = 0
+                while start < len(ticks):
+                    track = tracks[start]
+                    end = bisect_right(tracks, track, start)
+                    seconds.extend(self.tempo_maps[track].seconds_array(
+                        ticks[start:end]))
+                    start = end
+        return self._seconds
+
+    def channel_batch(self, tracks=None):
+        """
+        all channel messages (optionally only those from the given
+        tracks) as a MessageBatch, timestamped in seconds.
+        """
+        ev = self.events
+        mask = ev.channel_mask()
+        if tracks is not None:
+            tracks = set(tracks)
+            mask = [m and t in tracks for m, t in zip(mask, ev.track)]
+        return MessageBatch(array('B', compress(ev.status, mask)),
+                            array('B', compress(ev.data1, mask)),
+                            array('B', compress(ev.data2, mask)),
+                            array('d', compress(self.seconds, mask)))
+
+    def iter_timed(self):
+        """
+        yield (seconds, track, message) for every channel event, in
+        playback order.
+        """
+        ev = self.events
+        seconds = self.seconds
+        for i in range(len(ev)):
+            if ev.status[i] < SYSEX:
+                yield seconds[i], ev.track[i], ev.message(i)
+
+    def duration(self):
+        if not len(self.events):
+            return 0.0
+        # format 2 tracks each start again from 0
+        return max(self.seconds) if self.format == 2 else self.seconds[-1]
+
+
+class TrackParser(object):
+    """
+    Resumable parser for the events of one track.
+
+    parse(data) takes the track's bytes from `pos` on, as far as they
+    go, and returns an EventTable of the complete events in them (with
+    payload offsets relative to data). An event cut off at the end of
+    data is left for the next call, which should start from the new
+    `pos`. `state` is everything needed to carry on later, and a parser
+    made from it carries on where this one stopped.
+    """
+
+    def __init__(self, track, pos, end=None, tick=0, rstat=0, ended=False):
+        self.track = track
+        self.pos = pos
+        self.end = end  # where the chunk ends, if known
+        self.tick = tick
+        self.rstat = rstat
+        self.ended = ended
+
+    @property
+    def state(self):
+        return (self.track, self.pos, self.end, self.tick, self.rstat,
+                self.ended)
+
+    def parse(self, data):
+        table = EventTable(data)
+        if self.ended:
+            return table
+        buf = _byte_buffer(data)
+        end = len(data)
+        if self.end is not None:
+            end = min(end, self.end - self.pos)
+        columns, (pos, self.tick, self.rstat, self.ended) = _parse_track(
+            buf, 0, end, self.track, self.tick, self.rstat, partial=True)
+        self.pos += pos
+        if self.end is not None and self.pos >= self.end:
+            self.ended = True
+        for col, values in zip(table.columns(), columns):
+            col.extend(values)
+        return table
+
+
+def _join_tables(tables, merge):
+    # one EventTable from several, each with its own data
+    if len(tables) == 1:
+        return tables[0]
+    out = EventTable(b''.join(bytes(t.data) for t in tables))
+    base = 0
+    for t in tables:
+        for col, values in zip(out.columns(), t.columns()):
+            col.extend(values)
+        if base:
+            offsets = out.offset
+            for i in range(len(out) - len(t), len(out)):
+                if out.length[i]:
+                    offsets[i] += base
+        base += len(t.data)
+    if merge:
+        # events held from an earlier poll may come from a later track
+        # than new ones at the same tick, so ties go by track too
+        tick, track = out.tick, out.track
+        order = sorted(range(len(out)),
+                       key=lambda i: (tick[i] << 16) | track[i])
+        for col in out.columns():
+            col[:] = array(col.typecode, [col[i] for i in order])
+    return out
+
+
+def _split_table(table, n):
+    """
+    (the first n events of table, the rest); the rest gets a copy of
+    just its own payloads, so that holding on to it doesn't keep all of
+    table's data
+    """
+    head, tail = EventTable(table.data), EventTable()
+    for h, t, col in zip(head.columns(), tail.columns(), table.columns()):
+        h.extend(col[:n])
+        t.extend(col[n:])
+    data = bytearray()
+    view = memoryview(table.data)
+    offsets = tail.offset
+    for i in range(len(tail)):
+        length = tail.length[i]
+        if length:
+            start = offsets[i]
+            offsets[i] = len(data)
+            data += view[start:start + length]
+    tail.data = bytes(data)
+    return head, tail
+
+
+class SMFReader(object):
+    """
+    A Standard MIDI File read a track at a time, or followed as it grows.
+
+    Only the chunk headers are read up front, stepping from one to the
+    next by the MTrk lengths; track(i) then reads and parses just that
+    chunk. poll() parses whatever has been appended to each track since
+    the last poll, so a file still being recorded can be followed
+    without rereading it. A track whose MTrk length runs past the end
+    of the file (or is 0, as some recorders leave it until they finish)
+    is taken to be still growing.
+
+    For format 0 and 1 files, the tables from successive polls are in
+    time order together, not just each on its own: events later than a
+    track which is still growing (or not in the file yet) might have
+    earlier ones added after them, so they are held back until every
+    track has got past them.
+
+    checkpoint() returns the position reached as plain data (suitable
+    for json); SMFReader(path, checkpoint=...) carries on from it, e.g.
+    after a restart, without parsing the file again.
+
+        reader = SMFReader('take.mid')
+        for table in reader.follow(interval=0.1):
+            ...
+            save(reader.checkpoint())
+    """
+
+    CHECKPOINT_VERSION = 2
+
+    def __init__(self, path, checkpoint=None):
+        self.path = path
+        self._f = open(path, 'rb')
+        head = self._read(0, 14)
+        if len(head) < 14 or head[:4] != b'MThd':
+            raise SMFError('%s: missing MThd header' % path)
+        buf = _byte_buffer(head)
+        length = _u32(buf, 4)
+        if length < 6:
+            raise SMFError('expected header length of at least 6')
+        self.format, self.ntracks, self.division = \
+            _u16(buf, 8), _u16(buf, 10), _u16(buf, 12)
+        if self.format not in (0, 1, 2):
+            raise SMFError('unknown SMF format %d' % self.format)
+        self.chunks = []  # (start, end or None if still growing)
+        self._scan_pos = 8 + length
+        self._tracks = {}
+        self._parsers = {}
+        self._held = EventTable()  # parsed, but not yet in time order
+        self._size = 0
+        if checkpoint is not None:
+            self._restore(checkpoint)
+        self.scan()
+
+    def _read(self, pos, size):
+        self._f.seek(pos)
+        return self._f.read(size)
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def size(self):
+        return os.fstat(self._f.fileno()).st_size
+
+    def scan(self):
+        "find any track chunks not yet known, returning how many there are"
+        size = self._size = self.size()
+        chunks = self.chunks
+        while len(chunks) < self.ntracks:
+            if chunks and chunks[-1][1] is None:
+                # still growing: nothing can follow it yet
+                if not self._fix_end(len(chunks) - 1, size):
+                    break
+            pos = self._scan_pos
+            if pos + 8 > size:
+                break
+            head = self._read(pos, 8)
+            length = _u32(_byte_buffer(head), 4)
+            start = pos + 8
+            end = start + length
+            if head[:4] == b'MTrk':
+                chunks.append((start, end if length and end <= size
+                               else None))
+            elif end > size:
+                break
+            self._scan_pos = end
+        return len(chunks)
+
+    def _fix_end(self, i, size):
+        # a growing chunk may have been given its length since
+        start, _ = self.chunks[i]
+        length = _u32(_byte_buffer(self._read(start - 4, 4)), 0)
+        if length and start + length <= size:
+            self.chunks[i] = (start, start + length)
+            self._scan_pos = start + length
+            if i in self._parsers:
+                self._parsers[i].end = start + length
+            return True
+        return False
+
+    def _available(self, i):
+        start, end = self.chunks[i]
+        return self._size if end is None else min(end, self._size)
+
+    def track(self, i):
+        """
+        the EventTable of track i, as far as it is in the file, reading
+        no other track
+        """
+        if i >= self.ntracks:
+            raise IndexError('no track %d' % i)
+        if i not in self._tracks:
+            if i >= self.scan():
+                raise SMFError('track %d not in the file yet' % i)
+            start, end = self.chunks[i]
+            parser = TrackParser(i, start, end)
+            self._tracks[i] = parser.parse(self._read(
+                start, self._available(i) - start))
+        return self._tracks[i]
+
+    def poll(self):
+        """
+        the events appended to the file since the last poll (or, the
+        first time, all of them), as one EventTable in time order for
+        format 0 and 1 files
+        """
+        size = self.size()
+        if size < self._size:
+            raise SMFError('%s shrank' % self.path)
+        if size != self._size:
+            # cached tracks may have grown
+            self._tracks.clear()
+        self.scan()
+        tables = [self._held] if len(self._held) else []
+        for i, (start, end) in enumerate(self.chunks):
+            parser = self._parsers.get(i)
+            if parser is None:
+                parser = self._parsers[i] = TrackParser(i, start, end)
+            if parser.ended:
+                continue
+            available = self._available(i)
+            if available > parser.pos:
+                table = parser.parse(self._read(parser.pos,
+                                                available - parser.pos))
+                if len(table):
+                    tables.append(table)
+        if not tables:
+            return EventTable()
+        table = _join_tables(tables, self.format != 2)
+        horizon = self._horizon()
+        if horizon is None:
+            self._held = EventTable()
+            return table
+        table, self._held = _split_table(
+            table, bisect_left(table.tick, horizon))
+        return table
+
+    def _horizon(self):
+        # the earliest tick at which a track may yet have an event, or
+        # None if nothing can come before what is already parsed
+        if self.format == 2:
+            return None
+        if len(self.chunks) < self.ntracks:
+            # a track not in the file yet may start anywhere
+            return 0
+        ticks = [p.tick for p in self._parsers.values() if not p.ended]
+        return min(ticks) if ticks else None
+
+    def follow(self, interval=0.5, stop=None):
+        """
+        poll() every interval seconds, yielding each non-empty table,
+        until every track has ended or stop() returns true
+        """
+        while True:
+            table = self.poll()
+            if len(table):
+                yield table
+            if self.ended or (stop is not None and stop()):
+                return
+            time.sleep(interval)
+
+    @property
+    def ended(self):
+        "True once poll() has reached the end of every track"
+        return len(self.chunks) == self.ntracks and all(
+            i in self._parsers and self._parsers[i].ended
+            for i in range(self.ntracks))
+
+    def checkpoint(self):
+        held = self._held
+        return {'version': self.CHECKPOINT_VERSION,
+                'size': self._size,
+                'scan': self._scan_pos,
+                'chunks': [list(c) for c in self.chunks],
+                'tracks': [list(p.state) for _, p in
+                           sorted(self._parsers.items())],
+                # the events held back, with their payloads as text
+                'held': [list(col) for col in held.columns()],
+                'held_data': bytes(held.data).decode('latin-1')}
+
+    def _restore(self, checkpoint):
+        # version 1 checkpoints predate holding events back
+        if checkpoint.get('version') not in (1, self.CHECKPOINT_VERSION):
+            raise SMFError('unknown checkpoint version %r' % (
+                checkpoint.get('version'),))
+        if self.size() < checkpoint['size']:
+            raise SMFError('%s is shorter than at the checkpoint' % self.path)
+        self._scan_pos = checkpoint['scan']
+        self.chunks = [tuple(c) for c in checkpoint['chunks']]
+        for state in checkpoint['tracks']:
+            parser = TrackParser(*state)
+            self._parsers[parser.track] = parser
+        if checkpoint.get('held'):
+            held = self._held = EventTable(
+                checkpoint['held_data'].encode('latin-1'))
+            for col, values in zip(held.columns(), checkpoint['held']):
+                col.extend(values)
+        self._size = checkpoint['size']
+
+
+def read_smf(path, use_mmap=False, cache=None):
+    "load and parse a Standard MIDI File, through an SMFCache if given"
+    if cache is not None:
+        return cache.load(path)
+    return MidiFile.load(path, use_mmap)
+
+
+def _parse_header(data):
+    buf = _byte_buffer(data)
+    if bytes(data[:4]) != b'MThd':
+        raise SMFError('missing MThd header')
+    length = _u32(buf, 4)
+    if length < 6:
+        raise SMFError('expected header length of at least 6')
+    fmt, ntracks, division = _u16(buf, 8), _u16(buf, 10), _u16(buf, 12)
+    if fmt not in (0, 1, 2):
+        raise SMFError('unknown SMF format %d' % fmt)
+    if fmt == 0 and ntracks != 1:
+        raise SMFError('format 0 file with %d tracks' % ntracks)
+    # locate the track chunks, skipping any unknown chunk types
+    offsets = []
+    pos = 8 + length
+    size = len(data)
+    while pos + 8 <= size and len(offsets) < ntracks:
+        chunk_len = _u32(buf, pos + 4)
+        if bytes(data[pos:pos + 4]) == b'MTrk':
+            offsets.append((pos + 8, min(pos + 8 + chunk_len, size)))
+        pos += 8 + chunk_len
+    if len(offsets) != ntracks:
+        raise SMFError('expected %d tracks, found %d' % (
+            ntracks, len(offsets)))
+    return fmt, ntracks, division, offsets
+
+
+def _parse_tracks(data, track_offsets, merge):
+    buf = _byte_buffer(data)
+    columns = [[], [], [], [], [], [], []]
+    for track, (start, end) in enumerate(track_offsets):
+        parsed, _ = _parse_track(buf, start, end, track)
+        for col, values in zip(columns, parsed):
+            col.extend(values)
+    if merge and len(track_offsets) > 1:
+        # a stable sort keeps track then file order for equal ticks
+        order = sorted(range(len(columns[0])), key=columns[0].__getitem__)
+        columns = [[col[i] for i in order] for col in columns]
+    table = EventTable(data)
+    for name, values in zip(('tick', 'track', 'status', 'data1', 'data2',
+                             'offset', 'length'), columns):
+        getattr(table, name).extend(values)
+    return table
+
+
+def _parse_track(buf, pos, end, track, tick=0, rstat=0, partial=False):
+    """
+    parse the events of a track from pos up to end, starting with the
+    given tick and running status. Returns the event columns and the
+    state after the last event, (pos, tick, rstat, ended), where ended
+    is true once end of track has been seen. With partial set, an event
+    cut off by end is left for next time rather than an error.
+    """
+    # appending to lists and converting once is quicker than array.append
+    ticks = []
+    statuses = []
+    data1s = []
+    data2s = []
+    offsets = []
+    lengths = []
+    tick_append = ticks.append
+    status_append = statuses.append
+    data1_append = data1s.append
+    data2_append = data2s.append
+    offset_append = offsets.append
+    length_append = lengths.append
+
+    ended = False
+    try:
+        while pos < end:
+            start, start_tick, start_rstat = pos, tick, rstat
+            # delta time
+            b = buf[pos]
+            pos += 1
+            delta = b & 0x7F
+            while b & 0x80:
+                b = buf[pos]
+                pos += 1
+                delta = (delta << 7) | (b & 0x7F)
+            tick += delta
+
+            status = buf[pos]
+            if status < 0x80:
+                if not rstat:
+                    raise SMFError('data byte without running status '
+                                   'at offset %d' % pos)
+                status = rstat
+            else:
+                pos += 1
+
+            if status < SYSEX:
+                rstat = status
+                data1 = buf[pos]
+                if 0xC0 <= status <= 0xDF:
+                    data2 = 0
+                    pos += 1
+                else:
+                    data2 = buf[pos + 1]
+                    pos += 2
+                offset = length = 0
+            else:
+                # meta and sysex events cancel running status
+                rstat = 0
+                data1 = data2 = 0
+                if status == META:
+                    data1 = buf[pos]
+                    pos += 1
+                elif status not in (SYSEX, SYSEX_ESCAPE):
+                    raise SMFError('unexpected status %02X at offset %d' % (
+                        status, pos - 1))
+                b = buf[pos]
+                pos += 1
+                length = b & 0x7F
+                while b & 0x80:
+                    b = buf[pos]
+                    pos += 1
+                    length = (length << 7) | (b & 0x7F)
+                offset = pos
+                pos += length
+                if partial and pos > end:
+                    # the payload isn't all here yet
+                    raise IndexError
+
+            tick_append(tick)
+            status_append(status)
+            data1_append(data1)
+            data2_append(data2)
+            offset_append(offset)
+            length_append(length)
+
+            if status == META and data1 == META_END_OF_TRACK:
+                ended = True
+                break
+    except IndexError:
+        if not partial:
+            raise SMFError('track %d truncated' % track)
+        pos, tick, rstat = start, start_tick, start_rstat
+    if pos > end:
+        raise SMFError('track %d overruns its chunk' % track)
+    return ((ticks, [track] * len(ticks), statuses, data1s, data2s,
+             offsets, lengths), (pos, tick, rstat, ended))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
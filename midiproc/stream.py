@@ -0,0 +1,318 @@
+"""
+chunk-at-a-time MIDI byte stream parsing
+
+midi_in_stream() in processors takes a single byte per send(), which
+costs a generator frame switch and a string concatenation for every byte
+on the wire. StreamParser does the same job over whole bytes / bytearray /
+memoryview chunks in a single pass, carrying running status, partial
+messages and sysex state across chunk boundaries.
+"""
+
+import re
+
+from .co_util import coroutine, NullSink
+from .batch import MessageBatch
+
+EOX = 0xF7  # end of sysex
+SOX = 0xF0  # start of sysex
+SYS_COM_BASE = 0xF0
+SYS_RT_BASE = 0xF8
+
+
+if b'\x00'[0] == 0:
+    # bytes, bytearray and memoryview already index / iterate as ints
+    _byte_buffer = lambda data: data
+    _pack = bytes
+else:
+    _byte_buffer = bytearray
+    _pack = lambda values: bytes(bytearray(values))
+
+# single-byte messages are looked up rather than built, so forwarding
+# realtime bytes never allocates
+_BYTE = [_pack((i,)) for i in range(256)]
+
+# sysex payloads are skipped over by searching for these, in C
+_SOX_SEARCH = re.compile(b'\xf0').search
+_STATUS_SEARCH = re.compile(b'[\x80-\xff]').search
+
+DEFAULT_SYSEX_BUFFER = 4096
+
+
+class SysexBuffer(object):
+    """
+    Collects sysex payloads for a target.
+
+    Payload bytes are copied into a preallocated bytearray, which is
+    reused from one message to the next. A payload longer than max_size
+    is truncated (and counted in `overflows`). With chunk_size, the
+    payload is delivered in pieces of that size as it arrives, followed
+    by an empty bytes object marking the end of the message; otherwise
+    it is delivered whole at the end.
+    """
+
+    def __init__(self, target, max_size=None, chunk_size=None):
+        self.target = target
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self._capacity = chunk_size or min(max_size or DEFAULT_SYSEX_BUFFER,
+                                           DEFAULT_SYSEX_BUFFER)
+        self._buf = bytearray(self._capacity)
+        self._len = 0
+        self.size = 0  # payload bytes of the current message so far
+        self.overflows = 0
+        self._truncated = False
+
+    def start(self):
+        self._len = 0
+        self.size = 0
+        self._truncated = False
+
+    def add(self, data):
+        n = len(data)
+        if self.max_size is not None and self.size + n > self.max_size:
+            if not self._truncated:
+                self._truncated = True
+                self.overflows += 1
+            n = self.max_size - self.size
+            if n <= 0:
+                return
+            data = data[:n]
+        self.size += n
+        buf = self._buf
+        chunk = self.chunk_size
+        if chunk is None:
+            # grows the buffer past its preallocated size if need be
+            buf[self._len:self._len + n] = data
+            self._len += n
+            return
+        pos = 0
+        while pos < n:
+            take = min(chunk - self._len, n - pos)
+            buf[self._len:self._len + take] = data[pos:pos + take]
+            self._len += take
+            pos += take
+            if self._len == chunk:
+                self.target.send(bytes(buf))
+                self._len = 0
+
+    def end(self):
+        buf = self._buf
+        if self.chunk_size is None:
+            self.target.send(bytes(buf[:self._len]))
+            if len(buf) > self._capacity:
+                # don't hold on to the memory of one huge dump
+                del buf[self._capacity:]
+        else:
+            if self._len:
+                self.target.send(bytes(buf[:self._len]))
+            self.target.send(b'')
+        self._len = 0
+
+
+class StreamParser(object):
+    """
+    Parse raw MIDI bytes a chunk at a time.
+
+    Behaviour matches midi_in_stream: realtime bytes (0xF8-0xFF) go to
+    rt_target one at a time without disturbing a partial message or
+    sysex, sysex payloads (excluding F0 / F7) go to sysex_target, system
+    common clears running status, and data bytes with no running status
+    are ignored. A sysex ends at EOX, or at any other status byte.
+
+    Sysex payloads are skipped in bulk rather than byte by byte, and
+    not copied at all without a sysex_target. sysex_max and sysex_chunk
+    are as max_size and chunk_size for SysexBuffer.
+
+    Channel messages are delivered to msg_target in one of two ways:
+
+    - batch=False: one send() per message, as a bytes object, so any
+      existing stage (drop_off, harmonize, hex_print...) can follow.
+    - batch=True: one send() per chunk carrying a MessageBatch of all
+      the messages completed in that chunk. This avoids any per-message
+      allocation.
+
+    >>> out = []
+    >>> class Collect(object):
+    ...     def send(self, m):
+    ...         out.append(bytes(m))
+    >>> p = StreamParser(Collect())
+    >>> p.feed(b'\\x90\\x3c\\x64\\x3e')
+    >>> p.feed(b'\\x64\\xf8\\x40\\x00')
+    >>> out == [b'\\x90\\x3c\\x64', b'\\x90\\x3e\\x64', b'\\x90\\x40\\x00']
+    True
+    """
+
+    def __init__(self, msg_target=None, rt_target=None, sysex_target=None,
+                 batch=False, sysex_max=None, sysex_chunk=None):
+        self.msg_target = msg_target or NullSink()
+        self.rt_target = rt_target or NullSink()
+        self.sysex_target = sysex_target or NullSink()
+        self.batch = batch
+        self.sysex = SysexBuffer(self.sysex_target, sysex_max, sysex_chunk) \
+            if self.sysex_target else None
+        self.reset()
+
+    def reset(self):
+        "forget running status and any partial message or sysex"
+        self._rstat = 0
+        self._need = 0
+        self._data1 = 0
+        self._insysex = False
+        if self.sysex is not None:
+            self.sysex.start()
+
+    def resume(self, status):
+        """
+        start again part way through a stream, at a message boundary
+        with running status `status` (0 for none).
+        """
+        self.reset()
+        if 0x80 <= status < 0xF0:
+            self._rstat = status
+            if 0xC0 <= status <= 0xDF:
+                self._data1 = -1
+                self._need = 1
+            else:
+                self._need = 2
+
+    def feed(self, data, timestamp=0.0):
+        """
+        parse a chunk of bytes, delivering any completed messages. In
+        batch mode, messages are stamped with `timestamp`.
+        """
+        if self.batch:
+            out = self._scan(data, bytearray())
+            if out:
+                self.msg_target.send(MessageBatch.from_packed(out, timestamp))
+        else:
+            self._scan(data, None)
+
+    def parse(self, data, timestamp=0.0):
+        """
+        parse a buffer, returning its channel messages as a MessageBatch
+        rather than sending them to msg_target.
+        """
+        return MessageBatch.from_packed(self._scan(data, bytearray()),
+                                        timestamp)
+
+    def _scan(self, data, out):
+        buf = _byte_buffer(data)
+        if not self._insysex and _SOX_SEARCH(buf) is None:
+            return self._scan_messages(buf, out)
+        # split the chunk into sysex payloads, handled in bulk, and the
+        # runs of other bytes between them
+        sysex = self.sysex
+        n = len(buf)
+        pos = 0
+        while pos < n:
+            if self._insysex:
+                m = _STATUS_SEARCH(buf, pos)
+                end = m.start() if m else n
+                if sysex is not None and end > pos:
+                    sysex.add(buf[pos:end])
+                if m is None:
+                    break
+                b = buf[end]
+                if b >= SYS_RT_BASE:
+                    if self.rt_target:
+                        self.rt_target.send(_BYTE[b])
+                    pos = end + 1
+                    continue
+                self._insysex = False
+                if sysex is not None:
+                    sysex.end()
+                # EOX is consumed; any other status byte starts afresh
+                pos = end + 1 if b == EOX else end
+            else:
+                m = _SOX_SEARCH(buf, pos)
+                end = m.start() if m else n
+                if end > pos:
+                    self._scan_messages(buf[pos:end], out)
+                if m is None:
+                    break
+                # sysex is system common: it clears running status
+                self._rstat = self._need = 0
+                self._insysex = True
+                if sysex is not None:
+                    sysex.start()
+                pos = end + 1
+        return out
+
+    def _scan_messages(self, buf, out):
+        # everything but sysex
+        rstat = self._rstat
+        need = self._need
+        data1 = self._data1
+
+        batch = out is not None
+        oappend = out.append if batch else None
+        msg_send = self.msg_target.send
+        rt_send = self.rt_target.send if self.rt_target else None
+
+        for b in buf:
+            if b < 0x80:
+                # data byte; `need` is zero when there is no running status
+                if need == 2:
+                    data1 = b
+                    need = 1
+                elif need:
+                    if data1 < 0:
+                        # two-byte message: this is its only data byte
+                        if batch:
+                            oappend(rstat)
+                            oappend(b)
+                            oappend(0)
+                        else:
+                            msg_send(_pack((rstat, b)))
+                    else:
+                        if batch:
+                            oappend(rstat)
+                            oappend(data1)
+                            oappend(b)
+                        else:
+                            msg_send(_pack((rstat, data1, b)))
+                        need = 2
+                # otherwise no running status - ignore databyte
+            elif b >= SYS_RT_BASE:
+                if rt_send is not None:
+                    rt_send(_BYTE[b])
+            elif b == EOX:
+                # EOX outside sysex: ignore
+                pass
+            elif b >= SYS_COM_BASE:
+                # system common - clear running status
+                rstat = 0
+                need = 0
+            else:
+                rstat = b
+                if 0xC0 <= b <= 0xDF:
+                    data1 = -1
+                    need = 1
+                else:
+                    data1 = 0
+                    need = 2
+
+        self._rstat = rstat
+        self._need = need
+        self._data1 = data1
+        return out
+
+
+@coroutine
+def midi_in_chunks(msg_target, rt_target=None, sysex_target=None, batch=False,
+                   sysex_max=None, sysex_chunk=None):
+    """
+    Coroutine front end to StreamParser: a drop-in replacement for
+    midi_in_stream which accepts whole chunks per send() rather than
+    single bytes.
+    """
+    parser = StreamParser(msg_target, rt_target, sysex_target, batch,
+                          sysex_max, sysex_chunk)
+    feed = parser.feed
+    while True:
+        feed((yield))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
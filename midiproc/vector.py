@@ -0,0 +1,347 @@
+"""
+NumPy-vectorised filter and transform stages
+
+Each transform here has two halves: a batch_* function which works on a
+whole MessageBatch at once using masked NumPy operations, and a coroutine
+stage which applies it to every MessageBatch it receives. Single messages
+(bytes) sent to a stage go through a per-message version of the same
+transform, so stages can sit anywhere in a chain.
+
+NumPy is optional. Without it, drop_off() and harmonize() with their
+default arguments are simply the coroutines from processors, and the
+other stages process batches one message at a time.
+"""
+
+from array import array
+
+from .co_util import coroutine
+from .batch import MessageBatch, is_two_byte
+from . import processors
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+POLY_PRESSURE = 0xA0
+
+
+def _channel_table(channels):
+    "16-entry list of flags; channels=None selects every channel"
+    if channels is None:
+        return [True] * 16
+    table = [False] * 16
+    for c in channels:
+        table[c] = True
+    return table
+
+
+def velocity_table(factor=1.0, curve=1.0, minimum=1, maximum=127):
+    """
+    128-entry velocity lookup: scale by `factor`, then apply a power
+    `curve` (< 1 is softer, > 1 harder), clamped to minimum..maximum.
+    Velocity 0 (note off) always maps to 0.
+
+    >>> velocity_table(factor=0.5)[:4], velocity_table(factor=0.5)[127]
+    ([0, 1, 1, 2], 64)
+    """
+    table = [0]
+    for v in range(1, 128):
+        scaled = 127.0 * (min(v * factor, 127.0) / 127.0) ** curve
+        table.append(max(minimum, min(maximum, int(scaled + 0.5))))
+    return table
+
+
+def _columns(batch):
+    # zero-copy views onto the batch arrays
+    return (numpy.frombuffer(batch.status, dtype=numpy.uint8),
+            numpy.frombuffer(batch.data1, dtype=numpy.uint8),
+            numpy.frombuffer(batch.data2, dtype=numpy.uint8),
+            numpy.frombuffer(batch.timestamp, dtype=numpy.float64))
+
+
+def _to_batch(status, data1, data2, timestamp):
+    return MessageBatch(array('B', status.astype(numpy.uint8).tobytes()),
+                        array('B', data1.astype(numpy.uint8).tobytes()),
+                        array('B', data2.astype(numpy.uint8).tobytes()),
+                        array('d', timestamp.tobytes()))
+
+
+def _masked(batch, mask):
+    status, data1, data2, timestamp = _columns(batch)
+    return _to_batch(status[mask], data1[mask], data2[mask], timestamp[mask])
+
+
+def _in_channels(status, channels):
+    return numpy.array(_channel_table(channels), dtype=bool)[status & 0x0F]
+
+
+def _is_note(command):
+    return (command == NOTE_OFF) | (command == NOTE_ON) | \
+        (command == POLY_PRESSURE)
+
+
+def batch_drop_off(batch, channels=(0,)):
+    "remove note-offs (including zero-velocity note-ons)"
+    if not batch:
+        return batch
+    status, _, data2, _ = _columns(batch)
+    command = status & 0xF0
+    off = (command == NOTE_OFF) | ((command == NOTE_ON) & (data2 == 0))
+    if channels is not None:
+        off &= _in_channels(status, channels)
+    return _masked(batch, ~off)
+
+
+def batch_transpose(batch, semitones, low=0, high=127, clamp=True,
+                    channels=None):
+    """
+    shift note numbers of note on / off and poly pressure messages.
+    Out of range notes are clamped to low..high, or dropped if clamp
+    is False.
+    """
+    if not batch:
+        return batch
+    status, data1, data2, timestamp = _columns(batch)
+    notes = _is_note(status & 0xF0)
+    if channels is not None:
+        notes &= _in_channels(status, channels)
+    shifted = data1.astype(numpy.int16) + semitones
+    if clamp:
+        shifted = numpy.clip(shifted, low, high)
+        data1 = numpy.where(notes, shifted, data1)
+        return _to_batch(status, data1, data2, timestamp)
+    keep = ~notes | ((shifted >= low) & (shifted <= high))
+    data1 = numpy.where(notes, shifted, data1)
+    return _to_batch(status[keep], data1[keep], data2[keep], timestamp[keep])
+
+
+def batch_harmonize(batch, interval=-24, below=0x38, channels=(0,),
+                    low=0, high=127):
+    """
+    keep only note-on messages, following each one below note `below`
+    with a copy shifted by `interval`, provided that stays in low..high.
+    The defaults match processors.harmonize.
+    """
+    if not batch:
+        return batch
+    status, data1, data2, timestamp = _columns(batch)
+    keep = (status & 0xF0) == NOTE_ON
+    if channels is not None:
+        keep &= _in_channels(status, channels)
+    status, data1, data2, timestamp = (
+        status[keep], data1[keep], data2[keep], timestamp[keep])
+    target = data1.astype(numpy.int16) + interval
+    extra = (data1 < below) & (target >= low) & (target <= high)
+    counts = 1 + extra
+    index = numpy.repeat(numpy.arange(len(status)), counts)
+    data1 = data1[index]
+    # the copy sits immediately after its original
+    data1[(numpy.cumsum(counts) - 1)[extra]] = target[extra]
+    return _to_batch(status[index], data1, data2[index], timestamp[index])
+
+
+def batch_remap_channels(batch, mapping):
+    """
+    move messages between channels. `mapping` is either a 16-entry
+    sequence or a dict of {from: to}; unmapped channels are unchanged.
+    """
+    if not batch:
+        return batch
+    table = _channel_map(mapping)
+    status, data1, data2, timestamp = _columns(batch)
+    status = (status & 0xF0) | numpy.array(table, dtype=numpy.uint8)[
+        status & 0x0F]
+    return _to_batch(status, data1, data2, timestamp)
+
+
+def batch_scale_velocity(batch, table, channels=None):
+    "map note-on velocities through a 128-entry table (see velocity_table)"
+    if not batch:
+        return batch
+    status, data1, data2, timestamp = _columns(batch)
+    notes = (status & 0xF0) == NOTE_ON
+    if channels is not None:
+        notes &= _in_channels(status, channels)
+    mapped = numpy.array(table, dtype=numpy.uint8)[data2 & 0x7F]
+    return _to_batch(status, data1, numpy.where(notes, mapped, data2),
+                     timestamp)
+
+
+def batch_key_split(batch, split_point):
+    """
+    split a batch in two at note `split_point`: notes below it go to
+    the first batch returned, the rest to the second. Messages without
+    a note number go to both.
+    """
+    if not batch:
+        return batch, batch
+    status, data1, _, _ = _columns(batch)
+    notes = _is_note(status & 0xF0)
+    lower = data1 < split_point
+    return (_masked(batch, ~notes | lower), _masked(batch, ~notes | ~lower))
+
+
+def _channel_map(mapping):
+    if isinstance(mapping, dict):
+        table = list(range(16))
+        for src, dst in mapping.items():
+            table[src] = dst
+        return table
+    table = list(mapping)
+    assert len(table) == 16, 'channel map needs 16 entries'
+    return table
+
+
+def _scalar_batch(batch, scalar):
+    # per-message fallback for batches when NumPy is not available
+    out = MessageBatch()
+    append = out.append
+    for s, d1, d2, ts in zip(batch.status, batch.data1, batch.data2,
+                             batch.timestamp):
+        for msg in scalar(s, d1, d2):
+            append(msg[0], msg[1], msg[2], ts)
+    return out
+
+
+def _message(values):
+    if is_two_byte(values[0]):
+        return bytes(bytearray(values[:2]))
+    return bytes(bytearray(values))
+
+
+@coroutine
+def _vector_stage(target, kernel, scalar):
+    while True:
+        rx = (yield)
+        if isinstance(rx, MessageBatch):
+            if numpy is not None:
+                rx = kernel(rx)
+            else:
+                rx = _scalar_batch(rx, scalar)
+            if rx:
+                target.send(rx)
+        else:
+            msg = bytearray(rx)
+            for out in scalar(msg[0], msg[1], msg[2] if len(msg) > 2 else 0):
+                target.send(_message(out))
+
+
+def drop_off(target, channels=(0,)):
+    "vectorised processors.drop_off"
+    if numpy is None and channels == (0,):
+        return processors.drop_off(target)
+    chans = _channel_table(channels)
+
+    def scalar(s, d1, d2):
+        command = s & 0xF0
+        if chans[s & 0x0F] and (command == NOTE_OFF or
+                                (command == NOTE_ON and d2 == 0)):
+            return ()
+        return ((s, d1, d2),)
+    return _vector_stage(target,
+                         lambda b: batch_drop_off(b, channels), scalar)
+
+
+def harmonize(target, interval=-24, below=0x38, channels=(0,),
+              low=0, high=127):
+    "vectorised processors.harmonize, with adjustable interval and range"
+    if numpy is None and (interval, below, channels, low, high) == \
+            (-24, 0x38, (0,), 0, 127):
+        return processors.harmonize(target)
+    chans = _channel_table(channels)
+
+    def scalar(s, d1, d2):
+        if s & 0xF0 != NOTE_ON or not chans[s & 0x0F]:
+            return ()
+        if d1 < below and low <= d1 + interval <= high:
+            return ((s, d1, d2), (s, d1 + interval, d2))
+        return ((s, d1, d2),)
+    return _vector_stage(target, lambda b: batch_harmonize(
+        b, interval, below, channels, low, high), scalar)
+
+
+def transpose(target, semitones, low=0, high=127, clamp=True, channels=None):
+    chans = _channel_table(channels)
+
+    def scalar(s, d1, d2):
+        if s & 0xF0 not in (NOTE_OFF, NOTE_ON, POLY_PRESSURE) or \
+                not chans[s & 0x0F]:
+            return ((s, d1, d2),)
+        note = d1 + semitones
+        if not low <= note <= high:
+            if not clamp:
+                return ()
+            note = max(low, min(high, note))
+        return ((s, note, d2),)
+    return _vector_stage(target, lambda b: batch_transpose(
+        b, semitones, low, high, clamp, channels), scalar)
+
+
+def remap_channels(target, mapping):
+    table = _channel_map(mapping)
+
+    def scalar(s, d1, d2):
+        return (((s & 0xF0) | table[s & 0x0F], d1, d2),)
+    return _vector_stage(target,
+                         lambda b: batch_remap_channels(b, table), scalar)
+
+
+def scale_velocity(target, factor=1.0, curve=1.0, minimum=1, maximum=127,
+                   table=None, channels=None):
+    """
+    scale note-on velocities by `factor` and a power `curve`, or through
+    an explicit 128-entry `table`.
+    """
+    if table is None:
+        table = velocity_table(factor, curve, minimum, maximum)
+    chans = _channel_table(channels)
+
+    def scalar(s, d1, d2):
+        if s & 0xF0 == NOTE_ON and chans[s & 0x0F]:
+            return ((s, d1, table[d2]),)
+        return ((s, d1, d2),)
+    return _vector_stage(target, lambda b: batch_scale_velocity(
+        b, table, channels), scalar)
+
+
+@coroutine
+def key_split(lower_target, upper_target, split_point=60):
+    """
+    route notes below split_point to lower_target and the rest to
+    upper_target; other messages go to both.
+    """
+    while True:
+        rx = (yield)
+        if isinstance(rx, MessageBatch):
+            if numpy is not None:
+                lower, upper = batch_key_split(rx, split_point)
+            else:
+                notes = [s & 0xF0 in (NOTE_OFF, NOTE_ON, POLY_PRESSURE)
+                         for s in rx.status]
+                lower = rx.compress(not n or d1 < split_point
+                                    for n, d1 in zip(notes, rx.data1))
+                upper = rx.compress(not n or d1 >= split_point
+                                    for n, d1 in zip(notes, rx.data1))
+            if lower:
+                lower_target.send(lower)
+            if upper:
+                upper_target.send(upper)
+        else:
+            msg = bytearray(rx)
+            if msg[0] & 0xF0 in (NOTE_OFF, NOTE_ON, POLY_PRESSURE):
+                if msg[1] < split_point:
+                    lower_target.send(rx)
+                else:
+                    upper_target.send(rx)
+            else:
+                lower_target.send(rx)
+                upper_target.send(rx)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
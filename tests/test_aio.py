@@ -0,0 +1,202 @@
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from midiproc.device import pipe_device
+from midiproc.net import send_framed
+
+try:
+    import asyncio
+    from midiproc import aio
+except (ImportError, SyntaxError):
+    # Python < 3.5
+    aio = None
+
+
+class _Collect(object):
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def send(self, data):
+        self.chunks.append(bytes(data))
+
+    def close(self):
+        self.closed = True
+
+
+class _Device(object):
+    # a device whose read() never blocks, like a pylibftdi Device
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.reads = 0
+        self.closed = False
+
+    def read(self, n):
+        self.reads += 1
+        return self.chunks.pop(0) if self.chunks else b''
+
+    def close(self):
+        self.closed = True
+
+
+def _free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+@unittest.skipIf(aio is None, 'asyncio sources need Python 3.5+')
+class AioTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_until(self, coro, timeout=5.0):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, timeout))
+
+    def serve(self, source, client):
+        """
+        run source as a task, call client() once it has had a moment to
+        bind, then cancel the source
+        """
+        task = self.loop.create_task(source)
+
+        def talk():
+            client()
+            self.loop.call_later(0.1, task.cancel)
+        self.loop.call_later(0.05, talk)
+        try:
+            self.run_until(task)
+        except asyncio.CancelledError:
+            pass
+        self.assertTrue(task.done())
+
+    def test_fd_source_restores_blocking(self):
+        dev, write = pipe_device()
+        try:
+            write(b'\x90\x3c\x64\xf8')
+            os.close(dev.other)
+            dev.other = os.open(os.devnull, os.O_RDONLY)
+            self.assertTrue(os.get_blocking(dev))
+            out = _Collect()
+            self.run_until(aio.fd_source(dev, out))
+            self.assertEqual(b''.join(out.chunks), b'\x90\x3c\x64\xf8')
+            self.assertTrue(os.get_blocking(dev))
+        finally:
+            dev.close()
+
+    def test_fd_source_per_byte(self):
+        dev, write = pipe_device()
+        try:
+            write(b'\x90\x3c\x64')
+            os.close(dev.other)
+            dev.other = os.open(os.devnull, os.O_RDONLY)
+            out = _Collect()
+            self.run_until(aio.fd_source(dev, out, per_byte=True))
+            self.assertEqual(out.chunks, [b'\x90', b'\x3c', b'\x64'])
+        finally:
+            dev.close()
+
+    def test_poll_source_stops(self):
+        dev = _Device([b'\x90\x3c', b'', b'\x64'])
+        out = _Collect()
+        self.run_until(aio.poll_source(
+            dev, out, interval=0, stop=lambda: dev.reads >= 5))
+        self.assertEqual(out.chunks, [b'\x90\x3c', b'\x64'])
+        self.assertEqual(dev.reads, 5)
+        self.assertFalse(dev.closed)
+
+    def test_midi_in_ftdi_closes_the_device(self):
+        from midiproc import device
+        dev = _Device([b'\xf8'])
+        saved = device.BACKENDS['ftdi']
+        device.register_backend('ftdi', lambda: dev)
+        try:
+            out = _Collect()
+            self.run_until(aio.midi_in_ftdi(out, stop=lambda: dev.reads))
+            self.assertEqual(out.chunks, [b'\xf8'])
+            self.assertTrue(dev.closed)
+            # and when the task is cancelled
+            dev = _Device([])
+            self.serve(aio.midi_in_ftdi(out), lambda: None)
+            self.assertTrue(dev.closed)
+        finally:
+            device.BACKENDS['ftdi'] = saved
+
+    def test_net_source_udp(self):
+        addr = ('127.0.0.1', _free_port())
+        out = _Collect()
+
+        def client():
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.sendto(b'\x90\x3c\x64', addr)
+            s.sendto(b'\x80\x3c\x00', addr)
+            s.close()
+        self.serve(aio.net_source(addr, out), client)
+        self.assertEqual(out.chunks, [b'\x90\x3c\x64', b'\x80\x3c\x00'])
+        # the endpoint was closed, so the address is free again
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(addr)
+        s.close()
+
+    def test_net_source_tcp(self):
+        addr = ('127.0.0.1', _free_port())
+        out = _Collect()
+        clients = []
+
+        def client():
+            for _ in range(2):
+                s = socket.create_connection(addr)
+                clients.append(s)
+            send_framed(clients[0], b'\x90\x3c\x64')
+            # a message split across sends
+            clients[1].sendall(b'\x00\x00')
+            clients[1].sendall(b'\x00\x03\x80')
+            clients[1].sendall(b'\x3c\x00')
+        try:
+            self.serve(aio.net_source(addr, out, proto='tcp'), client)
+            self.assertEqual(sorted(out.chunks),
+                             [b'\x80\x3c\x00', b'\x90\x3c\x64'])
+            # the server closed its end of each connection
+            for s in clients:
+                s.settimeout(1.0)
+                self.assertEqual(s.recv(1), b'')
+        finally:
+            for s in clients:
+                s.close()
+
+    def test_net_source_refuses_unknown_protocols(self):
+        self.assertRaises(ValueError, self.run_until,
+                          aio.net_source(('127.0.0.1', 0), _Collect(),
+                                         proto='sctp'))
+
+    def test_run_file_sources(self):
+        directory = tempfile.mkdtemp()
+        try:
+            paths = []
+            for i, data in enumerate((b'\x90\x3c\x64' * 3, b'\xf8' * 5)):
+                paths.append(os.path.join(directory, '%d.mid' % i))
+                with open(paths[-1], 'wb') as f:
+                    f.write(data)
+            outs = [_Collect(), _Collect()]
+            aio.run(*[[lambda t, p=p: aio.file_source(p, t, chunk_size=4),
+                       lambda o=o: o] for p, o in zip(paths, outs)])
+            self.assertEqual(outs[0].chunks,
+                             [b'\x90\x3c\x64\x90', b'\x3c\x64\x90\x3c',
+                              b'\x64'])
+            self.assertEqual(outs[1].chunks, [b'\xf8' * 4, b'\xf8'])
+            self.assertTrue(outs[0].closed and outs[1].closed)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
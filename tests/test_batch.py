@@ -0,0 +1,72 @@
+import unittest
+
+from midiproc.batch import MessageBatch
+from midiproc.processors import drop_off, harmonize
+
+
+class _Collect(object):
+    def __init__(self):
+        self.data = []
+
+    def send(self, rx):
+        self.data.append(rx)
+
+    def close(self):
+        pass
+
+
+def every_message():
+    "each three-byte channel message with velocities 0, 1 and 64"
+    batch = MessageBatch()
+    for status in range(0x80, 0xF0):
+        if 0xC0 <= status <= 0xDF:
+            continue
+        for d1 in range(128):
+            for d2 in (0, 1, 64):
+                batch.append(status, d1, d2, len(batch) * 0.001)
+    return batch
+
+
+class MessageBatchTest(unittest.TestCase):
+
+    def test_from_packed(self):
+        packed = b'\x90\x3c\x64\xc0\x05\x00\x80\x3c\x00'
+        for data in (packed, bytearray(packed), memoryview(packed)):
+            b = MessageBatch.from_packed(data, 2.0)
+            self.assertEqual(b.packed(), bytearray(packed))
+            self.assertEqual(list(b.timestamp), [2.0] * 3)
+
+    def test_compress_few_and_many(self):
+        batch = every_message()
+        n = len(batch)
+        for mask in ([i % 50 != 7 for i in range(n)],
+                     [i % 3 == 0 for i in range(n)],
+                     [False] * n, [True] * n):
+            got = batch.compress(bytearray(mask))
+            expected = batch.select(i for i in range(n) if mask[i])
+            self.assertEqual(got.packed(), expected.packed())
+            self.assertEqual(list(got.timestamp), list(expected.timestamp))
+            self.assertEqual(batch.compress(mask).packed(), got.packed())
+
+
+class BatchStageTest(unittest.TestCase):
+
+    def test_batch_matches_messages(self):
+        batch = every_message()
+        for stage in (drop_off, harmonize):
+            whole = _Collect()
+            stage(whole).send(batch)
+            single = _Collect()
+            s = stage(single)
+            times = []
+            for m in batch:
+                before = len(single.data)
+                s.send(m.to_bytes())
+                times.extend([m.timestamp] * (len(single.data) - before))
+            out = whole.data[0]
+            self.assertEqual([m.to_bytes() for m in out], single.data)
+            self.assertEqual(list(out.timestamp), times)
+
+
+if __name__ == '__main__':
+    unittest.main()
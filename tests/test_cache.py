@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from midiproc.bench import smf_file
+from midiproc.cache import CacheError, SMFCache, read_entry, write_entry
+from midiproc.smf import MidiFile
+
+
+class SMFCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'song.mid')
+        with open(self.path, 'wb') as f:
+            f.write(smf_file(3, 500))
+        self.cache = SMFCache(os.path.join(self.directory, 'cache'))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def test_cached_file_is_like_a_parsed_one(self):
+        parsed = MidiFile.load(self.path)
+        self.cache.load(self.path)
+        self.cache._memory.clear()
+        cached = self.cache.load(self.path)
+        self.assertEqual(self.cache.hits, 1)
+        for name in ('tick', 'offset', 'length', 'track', 'status',
+                     'data1', 'data2'):
+            a = getattr(parsed.events, name)
+            b = getattr(cached.events, name)
+            self.assertEqual(b.typecode, a.typecode, name)
+            if name != 'offset':  # into the payloads, not the file
+                self.assertEqual(list(b), list(a), name)
+        self.assertEqual(list(cached.seconds), list(parsed.seconds))
+        for i in range(len(parsed.events)):
+            if parsed.events.length[i]:
+                self.assertEqual(bytes(cached.events.payload(i)),
+                                 bytes(parsed.events.payload(i)))
+        # columns are arrays, so they can grow like the parser's
+        cached.events.tick.extend(parsed.events.tick[:1])
+
+    def test_damaged_entries(self):
+        parsed = MidiFile.load(self.path)
+        entry = os.path.join(self.directory, 'entry')
+        with open(entry, 'wb') as f:
+            write_entry(f, parsed)
+        with open(entry, 'rb') as f:
+            data = f.read()
+        self.assertRaises(CacheError, read_entry, data[:10])
+        self.assertRaises(CacheError, read_entry, data[:len(data) // 2])
+        self.assertRaises(CacheError, read_entry, b'XXXX' + data[4:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from midiproc.batch import MessageBatch
+from midiproc.capture import CaptureReader, CaptureSink
+
+
+class CaptureSeekTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'session.cap')
+        # a batch, all stamped alike, spread over many small blocks which
+        # each start at that time, then one more message
+        sink = CaptureSink(self.path, block_size=64, index_every=1)
+        batch = MessageBatch()
+        for i in range(50):
+            batch.append(0x90, i, 0x40, 0.0)
+        sink.send(batch)
+        sink.send(b'\x80\x3c\x00')
+        sink.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_seek_finds_the_first_message_at_start(self):
+        with CaptureReader(self.path) as r:
+            everything = list(r.records())
+            t = everything[0][0]
+            self.assertTrue(len(r.index_times) > 2)
+            self.assertEqual([(u, bytes(m)) for u, m in r.records(t)],
+                             [(u, bytes(m)) for u, m in everything])
+            self.assertEqual(sum(len(b) for b in r.batches(t)), 51)
+
+    def test_seek_before_and_after(self):
+        with CaptureReader(self.path) as r:
+            self.assertEqual(len(list(r.records(-1.0))), 51)
+            self.assertEqual(list(r.records(r.duration + 1.0)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
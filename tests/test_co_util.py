@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from midiproc.batch import MessageBatch
+from midiproc.co_util import file_sink, file_source
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class CoUtilTest(unittest.TestCase):
+
+    def test_doctests_run_as_a_script(self):
+        path = os.path.join(HERE, os.pardir, 'midiproc', 'co_util.py')
+        self.assertEqual(subprocess.call([sys.executable, path]), 0)
+
+    def test_file_sink_writes_batches(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            sink = file_sink(path)
+            batch = MessageBatch()
+            batch.append(0x90, 0x3c, 0x64, 0.0)
+            sink.send(b'\xf8')
+            sink.send(batch)
+            sink.close()
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'\xf8\x90\x3c\x64')
+        finally:
+            os.remove(path)
+
+    def test_file_source_per_byte_or_in_chunks(self):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, b'\x90\x3c\x64\x3e\x64')
+        os.close(fd)
+        try:
+            for per_byte, expected in (
+                    (True, [b'\x90', b'\x3c', b'\x64', b'\x3e', b'\x64']),
+                    (False, [b'\x90\x3c\x64', b'\x3e\x64'])):
+                sent = []
+                target = _Collect(sent)
+                file_source(path, target, chunk_size=3, per_byte=per_byte)
+                self.assertEqual(sent, expected)
+                self.assertTrue(target.closed)
+        finally:
+            os.remove(path)
+
+
+class _Collect(object):
+
+    def __init__(self, sent):
+        self.sent = sent
+        self.closed = False
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def close(self):
+        self.closed = True
+
+
+if __name__ == '__main__':
+    unittest.main()
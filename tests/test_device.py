@@ -0,0 +1,70 @@
+import os
+import unittest
+
+from midiproc.device import DeviceReader, pipe_device
+
+
+class _Collect(object):
+    def __init__(self):
+        self.chunks = []
+
+    def send(self, data):
+        self.chunks.append(data)
+
+
+class _Wakeups(DeviceReader):
+    # a reader whose first few waits wake up to find nothing, as poll
+    # can after another reader took the data
+    def __init__(self, source, wakeups):
+        DeviceReader.__init__(self, source)
+        self.wakeups = wakeups
+
+    def read_chunk(self, timeout=None):
+        if self.wakeups:
+            self.wakeups -= 1
+            return None
+        return DeviceReader.read_chunk(self, timeout)
+
+
+class DeviceReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dev, self.write = pipe_device()
+
+    def tearDown(self):
+        self.dev.close()
+
+    def close_writer(self):
+        os.close(self.dev.other)
+        self.dev.other = os.open(os.devnull, os.O_RDONLY)
+
+    def test_eof_ends_run(self):
+        self.write(b'\x90\x3c\x64')
+        self.close_writer()
+        out = _Collect()
+        DeviceReader(self.dev).run(out)
+        self.assertEqual(b''.join(out.chunks), b'\x90\x3c\x64')
+
+    def test_spurious_wakeup_is_not_eof(self):
+        self.write(b'\x90\x3c\x64')
+        self.close_writer()
+        out = _Collect()
+        _Wakeups(self.dev, 3).run(out)
+        self.assertEqual(b''.join(out.chunks), b'\x90\x3c\x64')
+
+    def test_timeout_ends_run(self):
+        out = _Collect()
+        DeviceReader(self.dev).run(out, timeout=0.01)
+        self.assertEqual(out.chunks, [])
+
+    def test_read_chunk(self):
+        reader = DeviceReader(self.dev)
+        self.assertEqual(reader.read_chunk(timeout=0), None)
+        self.write(b'\xf8')
+        self.assertEqual(reader.read_chunk(timeout=1.0), b'\xf8')
+        self.close_writer()
+        self.assertEqual(reader.read_chunk(timeout=1.0), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
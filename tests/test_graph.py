@@ -0,0 +1,85 @@
+import unittest
+
+from midiproc import processors
+from midiproc.co_util import iter_source
+from midiproc.graph import Graph, GraphError, fuse, kernel_of
+
+
+class _Collect(object):
+    def __init__(self):
+        self.messages = []
+
+    def send(self, rx):
+        self.messages.append(bytes(rx))
+
+    def close(self):
+        pass
+
+
+def every_message():
+    "each channel message, with velocities 0 and 64 for three-byte ones"
+    out = []
+    for status in range(0x80, 0xF0):
+        for d1 in range(128):
+            if 0xC0 <= status <= 0xDF:
+                out.append(bytes(bytearray((status, d1))))
+            else:
+                for d2 in (0, 64):
+                    out.append(bytes(bytearray((status, d1, d2))))
+    return out
+
+
+def kernel_stages():
+    return sorted((name, fn) for name, fn in vars(processors).items()
+                  if getattr(fn, 'kernel', None) is not None)
+
+
+class KernelTest(unittest.TestCase):
+
+    def test_there_are_kernels(self):
+        self.assertTrue(kernel_stages())
+
+    def test_each_kernel_matches_its_stage(self):
+        messages = every_message()
+        for name, fn in kernel_stages():
+            plain = _Collect()
+            stage = fn(plain)
+            fused_out = _Collect()
+            fused = fuse([kernel_of(fn)], fn(fused_out), [fused_out])
+            for m in messages:
+                stage.send(m)
+                fused.send(m)
+            self.assertEqual(fused_out.messages, plain.messages, name)
+
+    def test_fused_graph_matches_unfused(self):
+        messages = every_message()
+        stages = kernel_stages()
+        outputs = []
+        for fuse_stages in (False, True):
+            g = Graph()
+            out = _Collect()
+            g.source('in', lambda target: iter_source(messages, target))
+            for name, fn in stages:
+                g.stage(name, fn)
+            g.sink('out', lambda: out)
+            g.connect('in', *[name for name, _ in stages] + ['out'])
+            g.run(fuse_stages)
+            outputs.append(out.messages)
+            if fuse_stages:
+                self.assertEqual(g.fused, [[name for name, _ in stages]])
+        self.assertEqual(outputs[0], outputs[1])
+
+
+class GraphTest(unittest.TestCase):
+
+    def test_cycle(self):
+        g = Graph()
+        g.source('in', lambda target: None)
+        g.stage('a', processors.drop_off)
+        g.stage('b', processors.harmonize)
+        g.connect('in', 'a', 'b', 'a')
+        self.assertRaises(GraphError, g.validate)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+
+from midiproc.batch import MessageBatch
+from midiproc.lut import Transform, chord, quantize, split, transposition
+
+
+def note_batch():
+    batch = MessageBatch()
+    for i in range(300):
+        status = (0x90, 0x80, 0xB1, 0xC2, 0x93, 0xA3, 0x83, 0xE0)[i % 8]
+        batch.append(status, (i * 7) % 128, i % 128, i * 0.001)
+    return batch
+
+
+TRANSFORMS = [
+    ('chord', dict(notes=chord())),
+    ('chord with velocity', dict(notes=chord(), velocity=[64] * 128)),
+    ('split', dict(notes=split(60, 0, 1))),
+    ('transpose', dict(notes=transposition(40), route={1: 5},
+                       velocity=lambda v: v // 2)),
+    ('one channel', dict(notes=transposition(-30), channels=[3],
+                         velocity=lambda v: v + 10)),
+    ('quantize', dict(notes=quantize(), route={0: 2})),
+]
+
+
+class TransformTest(unittest.TestCase):
+
+    def test_memoryview_messages(self):
+        for name, kwargs in TRANSFORMS:
+            t = Transform(**kwargs)
+            for m in (b'\x90\x3c\x64', b'\xb1\x07\x40', b'\xc2\x05'):
+                self.assertEqual([bytes(x) for x in t.message(memoryview(m))],
+                                 [bytes(x) for x in t.message(m)], name)
+
+    def test_whole_column_route(self):
+        rows = [name for name, kwargs in TRANSFORMS
+                if Transform(**kwargs)._rows is not None]
+        self.assertEqual(rows, ['transpose', 'one channel', 'quantize'])
+
+    def test_batch_matches_messages(self):
+        batch = note_batch()
+        for name, kwargs in TRANSFORMS:
+            t = Transform(**kwargs)
+            out = t.batch(batch)
+            expected = []
+            times = []
+            for msg in batch:
+                for m in t.message(msg.to_bytes()):
+                    expected.append(bytes(m))
+                    times.append(msg.timestamp)
+            self.assertEqual([m.to_bytes() for m in out], expected, name)
+            self.assertEqual(list(out.timestamp), times, name)
+
+
+if __name__ == '__main__':
+    unittest.main()
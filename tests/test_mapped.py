@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from midiproc.bench import note_stream, smf_file
+from midiproc.mapped import MappedFile, _walk
+from midiproc.smf import MidiFile
+
+
+class MappedFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data = note_stream(5000)
+        self.path = self.write('stream.mid', self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_seek_matches_a_walk_from_the_start(self):
+        with MappedFile(self.path, stride=64) as f:
+            for index in (0, 1, 63, 64, 65, 1000, 4999, 5000, 6000):
+                expected = _walk(self.data, 0, 0, index)[:2]
+                self.assertEqual(f.seek_event(index), expected)
+            self.assertEqual(f.events, 5000)
+
+    def test_index_is_built_only_as_far_as_needed(self):
+        with MappedFile(self.path, stride=64) as f:
+            f.seek_event(100)
+            self.assertEqual(len(f._offsets), 2)
+            self.assertEqual(f._events, None)
+            f.seek_event(10)
+            self.assertEqual(len(f._offsets), 2)
+
+    def test_batches_from_an_event(self):
+        with MappedFile(self.path, stride=64) as f:
+            tail = [m.to_bytes() for b in f.batches(event=4990) for m in b]
+            every = [m.to_bytes() for b in f.batches() for m in b]
+        self.assertEqual(tail, every[4990:])
+
+    def test_smf_refused_for_events(self):
+        data = smf_file(2, 100)
+        path = self.write('song.mid', data)
+        with MappedFile(path) as f:
+            self.assertTrue(f.is_smf)
+            self.assertRaises(ValueError, f.seek_event, 10)
+            self.assertRaises(ValueError, lambda: f.events)
+            self.assertRaises(ValueError, lambda: list(f.batches()))
+            self.assertEqual(len(f.midi_file().events),
+                             len(MidiFile(data).events))
+            smf = f.midi_file()
+        # a copy, still readable once the mapping is gone
+        self.assertEqual(smf.data, data)
+        self.assertEqual(list(smf.iter_timed()),
+                         list(MidiFile(data).iter_timed()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import functools
+import re
+import threading
+import unittest
+
+from midiproc.batch import MessageBatch
+from midiproc.co_util import iter_source
+from midiproc.metrics import Metrics, StageMetrics, HISTOGRAM_BUCKETS
+from midiproc.processors import chain, drop_off, harmonize
+
+
+class _Collect(object):
+    def __init__(self, out):
+        self.out = out
+
+    def send(self, rx):
+        self.out.append(rx)
+
+    def close(self):
+        pass
+
+
+# note on below 0x38, note off, note on above: drop_off passes two,
+# harmonize then doubles the low one
+_MESSAGES = [b'\x90\x30\x64', b'\x80\x30\x00', b'\x90\x40\x64']
+
+
+class MetricsTest(unittest.TestCase):
+
+    def run_chain(self, metrics, messages=_MESSAGES):
+        out = []
+        chain([functools.partial(iter_source, messages), drop_off,
+               harmonize, drop_off, functools.partial(_Collect, out)],
+              metrics=metrics)
+        return out
+
+    def test_same_output_with_and_without(self):
+        self.assertEqual(self.run_chain(Metrics()), self.run_chain(None))
+
+    def test_counts(self):
+        m = Metrics()
+        self.run_chain(m)
+        snap = m.snapshot()['stages']
+        # the same stage twice gets a second name
+        self.assertEqual(sorted(snap), ['_Collect', 'drop_off', 'drop_off_2',
+                                        'harmonize'])
+        counts = dict((name, (s['calls'], s['messages_in'],
+                              s['messages_out'], s['dropped']))
+                      for name, s in snap.items())
+        self.assertEqual(counts, {'drop_off': (3, 3, 2, 1),
+                                  'harmonize': (2, 2, 3, 0),
+                                  'drop_off_2': (3, 3, 3, 0),
+                                  '_Collect': (3, 3, 3, 0)})
+        for s in snap.values():
+            self.assertEqual(sum(s['histogram']), s['calls'])
+            self.assertLessEqual(s['mean_ns'], s['max_ns'])
+
+    def test_batches_count_their_messages(self):
+        batch = MessageBatch.from_messages(_MESSAGES)
+        m = Metrics()
+        self.run_chain(m, [batch])
+        s = m.snapshot()['stages']['drop_off']
+        self.assertEqual((s['calls'], s['messages_in'], s['messages_out']),
+                         (1, 3, 2))
+
+    def test_percentiles(self):
+        s = StageMetrics('x')
+        for ns in [100] * 98 + [5000, 70000]:
+            s.record(ns, 1, 1)
+        self.assertEqual(s.percentile_ns(50), 128)
+        self.assertEqual(s.percentile_ns(99), 8192)
+        self.assertEqual(s.percentile_ns(100), 131072)
+        s.record(1 << 40, 1, 1)
+        self.assertEqual(s.histogram[HISTOGRAM_BUCKETS - 1], 1)
+        self.assertEqual(StageMetrics('y').percentile_ns(50), 0)
+
+    def test_formats(self):
+        m = Metrics()
+        self.run_chain(m)
+        m.gauge('depth', lambda: 7)
+        text = m.format_text()
+        self.assertTrue(text.startswith('stage'))
+        self.assertIn('depth', text)
+        prom = m.format_prometheus()
+        self.assertIn('midiproc_stage_messages_dropped_total'
+                      '{stage="drop_off"} 1', prom)
+        self.assertIn('midiproc_depth 7', prom)
+        # cumulative buckets, ending in the call count
+        buckets = [int(v) for v in re.findall(
+            r'latency_ns_bucket\{stage="harmonize",le="[^"]+"\} (\d+)', prom)]
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertEqual(buckets[-1], 2)
+
+    def test_reporter(self):
+        m = Metrics()
+        written = threading.Event()
+        reports = []
+
+        def write(text):
+            reports.append(text)
+            written.set()
+        m.start_reporter(0.001, write)
+        self.assertTrue(written.wait(5.0))
+        m.stop_reporter()
+        self.assertTrue(reports[0].startswith('stage'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import socket
+import struct
+import unittest
+
+from midiproc.net import Deframer, FramedSink, FrameError, SocketPool, \
+    decode_frame, encode_frame, tcp_serve, clock, MAX_DATAGRAM
+
+
+class _Socket(object):
+    # stands in for a UDP socket, keeping what is sent
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append(data)
+
+
+def sysex(n):
+    return b'\xf0' + b'\x01' * (n - 2) + b'\xf7'
+
+
+def messages(frames):
+    return [bytes(m) for f in frames for _, m in decode_frame(f)[2]]
+
+
+class DeframerTest(unittest.TestCase):
+
+    def receive(self, seqs):
+        out = _Collect()
+        d = Deframer(out, batch=False)
+        for seq in seqs:
+            d.send(encode_frame(seq, 0.0, [(0.0, bytearray((0x90, seq & 0x7F,
+                                                            0x40)))]))
+        return [bytearray(m)[1] for m in out.messages], d.stats
+
+    def test_late_duplicate_is_dropped(self):
+        got, stats = self.receive([0, 2, 2])
+        self.assertEqual(got, [0, 2])
+        self.assertEqual((stats.lost, stats.reordered, stats.duplicates),
+                         (1, 0, 1))
+
+    def test_late_frame_delivered_once(self):
+        got, stats = self.receive([0, 2, 1, 1, 2, 0])
+        self.assertEqual(got, [0, 2, 1])
+        self.assertEqual((stats.lost, stats.reordered, stats.duplicates),
+                         (0, 1, 3))
+
+    def test_too_late_and_wrapping(self):
+        got, stats = self.receive([0xFFFFFFFE, 0xFFFFFFFF, 0, 100, 1])
+        self.assertEqual(got, [0x7E, 0x7F, 0, 100])
+        self.assertEqual((stats.lost, stats.duplicates), (99, 1))
+
+
+class FrameTest(unittest.TestCase):
+
+    def test_long_messages_round_trip(self):
+        records = [(1.0, b'\x90\x3c\x64'), (1.0, sysex(254)),
+                   (1.0, sysex(255)), (1.001, sysex(5000)),
+                   (1.002, b'\xf8')]
+        _, _, got = decode_frame(encode_frame(3, 1.0, records))
+        self.assertEqual([bytes(m) for _, m in got],
+                         [m for _, m in records])
+
+    def test_too_long_to_encode(self):
+        self.assertRaises(FrameError, encode_frame, 0, 0.0,
+                          [(0.0, sysex(0x10000))])
+
+
+class FramedSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sock = _Socket()
+        self.sink = FramedSink(('localhost', 0), max_size=1400,
+                               flush_interval=0.01, sock=self.sock)
+
+    def test_sysex_over_max_size_gets_a_frame_of_its_own(self):
+        self.sink.send(b'\x90\x3c\x64')
+        self.sink.send(sysex(3000))
+        self.sink.send(b'\x80\x3c\x00')
+        self.sink.close()
+        self.assertEqual(messages(self.sock.sent),
+                         [b'\x90\x3c\x64', sysex(3000), b'\x80\x3c\x00'])
+        self.assertEqual(len(self.sock.sent), 3)
+
+    def test_message_too_big_for_a_datagram(self):
+        self.assertRaises(FrameError, self.sink.send, sysex(MAX_DATAGRAM))
+
+    def test_poll_flushes_a_lone_message(self):
+        sent = clock()
+        self.sink.send(b'\x90\x3c\x64')
+        self.sink.poll(sent)
+        self.assertEqual(self.sock.sent, [])
+        self.sink.poll(sent + 0.02)
+        self.assertEqual(messages(self.sock.sent), [b'\x90\x3c\x64'])
+
+
+class _Collect(object):
+    def __init__(self):
+        self.messages = []
+
+    def send(self, msg):
+        self.messages.append(msg)
+
+
+class TCPServeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(4)
+        self.clients = []
+
+    def tearDown(self):
+        for c in self.clients:
+            c.close()
+        self.listener.close()
+
+    def client(self, data):
+        c = socket.create_connection(self.listener.getsockname())
+        c.sendall(data)
+        self.clients.append(c)
+        return c
+
+    def test_bad_length_drops_only_that_client(self):
+        hostile = self.client(struct.pack('!I', 0xFFFFFFFF) + b'junk')
+        self.client(struct.pack('!I', 3) + b'\x90\x3c\x64')
+        out = _Collect()
+        tcp_serve(self.listener, out, timeout=0.2)
+        self.assertEqual(out.messages, [b'\x90\x3c\x64'])
+        # the server hung up on the hostile client
+        hostile.settimeout(1.0)
+        self.assertEqual(hostile.recv(1), b'')
+
+
+class SocketPoolTest(unittest.TestCase):
+
+    def test_adopted_socket_is_used_and_closed(self):
+        pool = SocketPool()
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(('127.0.0.1', 0))
+        addr = s.getsockname()
+        pool.adopt(s, addr)
+        self.assertTrue(pool.listener(addr) is s)
+        self.assertRaises(ValueError, pool.adopt, s, addr)
+        pool.close(addr)
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(s.fileno(), -1)
+
+
+if __name__ == '__main__':
+    unittest.main()
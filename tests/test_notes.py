@@ -0,0 +1,47 @@
+import unittest
+
+from midiproc.device import clock
+from midiproc.notes import NoteGuard, NoteTracker
+from midiproc.processors import harmonize
+from midiproc.stream import StreamParser
+
+
+class _Collect(object):
+    def __init__(self):
+        self.data = []
+
+    def send(self, rx):
+        self.data.append(rx)
+
+    def close(self):
+        pass
+
+
+def parsed(data):
+    # a MessageBatch as StreamParser makes it, every timestamp 0.0
+    return StreamParser(batch=True).parse(data)
+
+
+class StuckTest(unittest.TestCase):
+
+    def test_batch_fed_notes_are_not_stuck(self):
+        for stage in (lambda t: NoteTracker(t),
+                      lambda t: NoteGuard(t, harmonize)):
+            s = stage(_Collect())
+            s.send(parsed(b'\x90\x3c\x64\x90\x40\x64'))
+            self.assertTrue(s.state.total)
+            self.assertEqual(s.state.stuck(5.0), [])
+            self.assertTrue(s.state.stuck(5.0, clock() + 10.0))
+
+    def test_stamped_batches_keep_their_times(self):
+        out = _Collect()
+        guard = NoteGuard(out, harmonize)
+        batch = parsed(b'\x90\x24\x64')
+        batch.timestamp[0] = 2.0
+        guard.send(batch)
+        self.assertEqual(guard.state.onset_of(0, 36), 2.0)
+        self.assertEqual(list(out.data[0].timestamp), [2.0, 2.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import threading
+import time
+import unittest
+
+from midiproc.batch import MessageBatch
+from midiproc.device import clock
+from midiproc.output import OutputSink
+
+
+class _Device(object):
+    def __init__(self):
+        self.data = bytearray()
+        self.writes = 0
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+        self.writes += 1
+
+    def close(self):
+        self.closed = True
+
+
+MESSAGES = [b'\x90\x3c\x64', b'\x90\x3e\x64', b'\xf8', b'\x90\x40\x64',
+            b'\xc0\x05', b'\xc0\x06', b'\xf0\x7e\x01\xf7', b'\x90\x3c\x00',
+            b'\x80\x3e\x00', b'\x80\x40\x00']
+
+
+class OutputSinkTest(unittest.TestCase):
+
+    def send_all(self, sink):
+        for m in MESSAGES:
+            sink.send(m)
+        batch = MessageBatch()
+        batch.append(0x80, 0x3c, 0, 0.0)
+        batch.append(0x90, 0x3c, 0x40, 0.0)
+        sink.send(batch)
+
+    def test_direct_writes_match_buffered(self):
+        direct, held = _Device(), _Device()
+        a = OutputSink(direct, tick=0)
+        b = OutputSink(held, tick=60.0)
+        self.send_all(a)
+        self.send_all(b)
+        b.flush()
+        self.assertEqual(direct.data, held.data)
+        self.assertEqual(direct.writes, len(MESSAGES) + 1)
+        self.assertEqual(held.writes, 1)
+        for name in 'messages', 'bytes_in', 'bytes_out':
+            self.assertEqual(getattr(a, name), getattr(b, name))
+        self.assertEqual(a.bytes_out, len(direct.data))
+        self.assertEqual(a.encoder.dropped, b.encoder.dropped)
+
+    def test_without_running_status(self):
+        dev = _Device()
+        sink = OutputSink(dev, running_status=False, tick=0)
+        self.send_all(sink)
+        self.assertEqual(bytes(dev.data[:len(b''.join(MESSAGES))]),
+                         b''.join(MESSAGES))
+
+    def test_poll_and_close_flush(self):
+        dev = _Device()
+        sink = OutputSink(dev, tick=0.01, timer=False)
+        sent = clock()
+        sink.send(b'\x90\x3c\x64')
+        sink.poll(sent)
+        self.assertEqual(dev.data, b'')
+        sink.poll(sent + 0.02)
+        self.assertEqual(dev.data, b'\x90\x3c\x64')
+        sink.send(b'\x90\x3e\x64')
+        sink.close()
+        self.assertEqual(dev.data, b'\x90\x3c\x64\x3e\x64')
+        self.assertTrue(dev.closed)
+
+    def test_timer_flushes_a_quiet_stream(self):
+        threads = threading.active_count()
+        dev = _Device()
+        sink = OutputSink(dev)
+        for m in MESSAGES[:3]:
+            sink.send(m)
+        self.assertEqual(dev.writes, 0)
+        deadline = time.time() + 1.0
+        while not dev.writes and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(dev.writes, 1)
+        self.assertEqual(bytes(dev.data), b'\x90\x3c\x64\x3e\x64\xf8')
+        sink.send(MESSAGES[3])
+        sink.close()
+        self.assertEqual(dev.writes, 2)
+        self.assertTrue(dev.closed)
+        deadline = time.time() + 1.0
+        while threading.active_count() > threads and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(threading.active_count(), threads)
+
+
+if __name__ == '__main__':
+    unittest.main()
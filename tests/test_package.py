@@ -0,0 +1,36 @@
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+
+def run(code):
+    # in a fresh interpreter, so earlier imports don't count
+    return subprocess.check_output([sys.executable, '-c', code],
+                                   cwd=ROOT).decode().split()
+
+
+class PackageTest(unittest.TestCase):
+
+    def test_render_is_the_submodule(self):
+        self.assertEqual(run(
+            'import midiproc, midiproc.render, types\n'
+            'print(isinstance(midiproc.render, types.ModuleType))\n'
+            'print(midiproc.render.encode_smf is midiproc.encode_smf)\n'
+            'from midiproc import render, write_smf\n'
+            'print(render is midiproc.render)\n'), ['True'] * 3)
+
+    def test_chain_imports_only_what_it_needs(self):
+        loaded = run(
+            'import sys\n'
+            'from midiproc import chain, drop_off, harmonize\n'
+            'print(" ".join(sorted(m for m in sys.modules'
+            ' if m.startswith("midiproc."))))\n')
+        for name in ('batch', 'device', 'output', 'stream', 'graph'):
+            self.assertNotIn('midiproc.' + name, loaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
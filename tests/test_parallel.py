@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from midiproc.batch import MessageBatch
+from midiproc.bench import smf_file
+from midiproc.parallel import Executor
+from midiproc.processors import drop_off
+from midiproc.parallel import run_stages
+
+
+class ExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(4):
+            path = os.path.join(self.directory, '%d.mid' % i)
+            with open(path, 'wb') as f:
+                f.write(smf_file(2, 200 * (4 - i), seed=i))
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_imap_files_pairs_each_path_with_its_result(self):
+        with Executor(processes=2) as ex:
+            expected = dict(zip(self.paths, ex.map_files([drop_off],
+                                                         self.paths)))
+            got = dict(ex.imap_files([drop_off], self.paths))
+        self.assertEqual(sorted(got), sorted(self.paths))
+        for path in self.paths:
+            self.assertEqual(got[path].to_bytes(), expected[path].to_bytes())
+
+    def test_map_channels_keeps_the_order_of_unstamped_messages(self):
+        batch = MessageBatch()
+        for i in range(200):
+            batch.append(0x90 | i % 5, 24 + i % 60, i % 3 and 0x40, 0.0)
+        batch.append(0x91, 40, 0x40, -1.0)
+        with Executor(processes=2) as ex:
+            got = ex.map_channels([drop_off], batch, shards=3)
+        expected = run_stages([drop_off], batch)
+        n = len(expected) - 1
+        expected = expected.select([n] + list(range(n)))
+        self.assertEqual(got.to_bytes(), expected.to_bytes())
+        self.assertEqual(list(got.timestamp), list(expected.timestamp))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+from midiproc.realtime import ClockTracker, RealtimeDemux
+
+
+class _Collect(object):
+    def __init__(self):
+        self.data = []
+
+    def send(self, data):
+        self.data.append(data)
+
+    def close(self):
+        pass
+
+
+class ClockTrackerTest(unittest.TestCase):
+
+    def test_coalesced_clocks_give_the_tempo(self):
+        # 125 bpm is 24 clocks every 0.48 s; hand them over six at a time
+        clk = ClockTracker()
+        for i in range(40):
+            clk.feed(b'\xf8' * 6, i * 0.12)
+        self.assertAlmostEqual(clk.bpm, 125.0)
+        self.assertAlmostEqual(clk.jitter, 0.0)
+
+    def test_clocks_with_one_timestamp_are_held_over(self):
+        clk = ClockTracker()
+        clk.feed(b'\xf8', 0.0)
+        for _ in range(24):
+            clk.feed(b'\xf8', 0.5)
+        # the others at 0.5 add no zero intervals, but wait for time to pass
+        self.assertAlmostEqual(clk.interval, 0.5)
+        clk.feed(b'\xf8', 0.52)
+        self.assertAlmostEqual(clk.interval, 0.02 / 24)
+        self.assertAlmostEqual(clk.jitter, 0.0)
+
+    def test_transport_within_a_chunk(self):
+        clk = ClockTracker()
+        clk.feed(b'\xf8\xf8\xfa' + b'\xf8' * 30 + b'\xfc\xf8', 1.0)
+        self.assertEqual(clk.ticks, 30)
+        self.assertFalse(clk.running)
+        clk.feed(b'\xfb\xf8\xfe', 2.0)
+        self.assertEqual(clk.ticks, 31)
+        self.assertEqual(clk.last_sensing, 2.0)
+        clk.feed(b'\xff', 3.0)
+        self.assertEqual((clk.ticks, clk.bpm), (0, 0.0))
+
+
+class RealtimeDemuxTest(unittest.TestCase):
+
+    def test_realtime_first_then_the_rest(self):
+        rt, rest = _Collect(), _Collect()
+        demux = RealtimeDemux(rt, rest)
+        demux.send(b'\x90\xf8\x3c\x64\xf0\x01\xfe\xf7')
+        self.assertEqual(rt.data, [b'\xf8', b'\xfe'])
+        self.assertEqual(rest.data, [b'\x90\x3c\x64\xf0\x01\xf7'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from midiproc.bench import smf_file
+from midiproc.processors import drop_off, harmonize
+from midiproc.render import encode_smf, encode_track, render, render_file, \
+    vlq
+from midiproc.smf import MidiFile, SMFError, EventTable
+
+
+def _events(table):
+    return [(table.tick[i], table.track[i], table.status[i], table.data1[i],
+             table.data2[i], bytes(table.payload(i)))
+            for i in range(len(table))]
+
+
+def _table(rows, data=b''):
+    # an EventTable from (tick, track, status, data1, data2, offset, length)
+    table = EventTable(data)
+    for col, values in zip(table.columns(), zip(*rows)):
+        col.extend(values)
+    return table
+
+
+class EncodeTest(unittest.TestCase):
+
+    def test_vlq(self):
+        for value, encoded in ((0, b'\x00'), (0x7F, b'\x7f'),
+                               (0x80, b'\x81\x00'), (0x3FFF, b'\xff\x7f'),
+                               (0x4000, b'\x81\x80\x00'),
+                               (0x0FFFFFFF, b'\xff\xff\xff\x7f')):
+            self.assertEqual(vlq(value), encoded)
+        self.assertRaises(ValueError, vlq, -1)
+
+    def test_round_trip(self):
+        for data in (smf_file(3, 300), smf_file(1, 300, fmt=0),
+                     smf_file(2, 300, max_delta=40000)):
+            smf = MidiFile(data)
+            again = MidiFile(encode_smf(smf.events, smf.division,
+                                        smf.format))
+            self.assertEqual((again.format, again.ntracks, again.division),
+                             (smf.format, smf.ntracks, smf.division))
+            self.assertEqual(_events(again.events), _events(smf.events))
+
+    def test_running_status(self):
+        rows = [(0, 0, 0x90, 0x3c, 0x64, 0, 0),
+                (10, 0, 0x90, 0x3e, 0x64, 0, 0),
+                (10, 0, 0xc0, 0x05, 0, 0, 0), (20, 0, 0xc0, 0x06, 0, 0, 0)]
+        table = _table(rows)
+        self.assertEqual(bytes(encode_track(table)),
+                         b'\x00\x90\x3c\x64\x0a\x3e\x64\x00\xc0\x05\x0a\x06'
+                         b'\x00\xff\x2f\x00')
+        self.assertEqual(bytes(encode_track(table, running_status=False)),
+                         b'\x00\x90\x3c\x64\x0a\x90\x3e\x64\x00\xc0\x05'
+                         b'\x0a\xc0\x06\x00\xff\x2f\x00')
+        for running_status in (True, False):
+            smf = MidiFile(encode_smf(table, 96,
+                                      running_status=running_status))
+            self.assertEqual(_events(smf.events)[:-1], _events(table))
+
+    def test_meta_cancels_running_status(self):
+        payload = b'name'
+        rows = [(0, 0, 0x90, 0x3c, 0x64, 0, 0),
+                (5, 0, 0xff, 0x03, 0, 0, len(payload)),
+                (5, 0, 0x90, 0x3e, 0x64, 0, 0)]
+        body = bytes(encode_track(_table(rows, payload)))
+        self.assertEqual(body, b'\x00\x90\x3c\x64\x05\xff\x03\x04name'
+                               b'\x00\x90\x3e\x64\x00\xff\x2f\x00')
+
+    def test_end_of_track_tick_is_kept(self):
+        # a track whose end comes well after its last note
+        rows = [(0, 0, 0x90, 0x3c, 0x64, 0, 0),
+                (96, 0, 0x80, 0x3c, 0, 0, 0), (960, 0, 0xff, 0x2f, 0, 0, 0)]
+        smf = MidiFile(encode_smf(_table(rows), 96))
+        self.assertEqual(_events(smf.events), _events(_table(rows)))
+        # and an end of track before the last event moves to it
+        rows[2] = (50, 0, 0xff, 0x2f, 0, 0, 0)
+        smf = MidiFile(encode_smf(_table(rows), 96))
+        self.assertEqual(list(smf.events.tick), [0, 96, 96])
+
+    def test_format_0_needs_one_track(self):
+        rows = [(0, 0, 0x90, 0x3c, 0x64, 0, 0),
+                (0, 1, 0x90, 0x3c, 0x64, 0, 0)]
+        self.assertRaises(SMFError, encode_smf, _table(rows), 96, 0)
+
+
+class RenderTest(unittest.TestCase):
+
+    def test_no_stages_gives_the_file_back(self):
+        smf = MidiFile(smf_file(3, 200))
+        again = MidiFile(encode_smf(render(smf, []), smf.division,
+                                    smf.format))
+        self.assertEqual(_events(again.events), _events(smf.events))
+
+    def test_batch_and_per_message_agree(self):
+        smf = MidiFile(smf_file(2, 500, max_delta=3))
+        stages = [drop_off, harmonize]
+        whole = render(smf, stages)
+        single = render(smf, stages, per_message=True)
+        self.assertEqual(_events(whole), _events(single))
+        # harmonize keeps only note-ons of channel 0, so track 1 (the
+        # second note track, on channel 1) is left with its meta events
+        ours = [e for e in _events(whole) if e[2] < 0xF0]
+        self.assertTrue(ours)
+        self.assertTrue(all(e[2] == 0x90 and e[4] for e in ours))
+        self.assertEqual(sorted(ours, key=lambda e: e[0]), ours)
+
+    def test_render_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            src = os.path.join(directory, 'in.mid')
+            dst = os.path.join(directory, 'out.mid')
+            with open(src, 'wb') as f:
+                f.write(smf_file(2, 100))
+            out = render_file(src, dst, [drop_off])
+            with open(dst, 'rb') as f:
+                written = MidiFile(f.read())
+            # out is in track order, the parsed file in time order
+            self.assertEqual(_events(written.events),
+                             sorted(_events(out), key=lambda e: e[0]))
+            self.assertEqual(written.division, 480)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import struct
+import threading
+import unittest
+
+from midiproc.ring import RingBuffer, DROP_OLDEST, BLOCK, decoupled
+
+
+class _Collect(object):
+    def __init__(self):
+        self.items = []
+
+    def send(self, data):
+        self.items.append(data)
+
+
+class RingBufferTest(unittest.TestCase):
+
+    def test_wraparound(self):
+        ring = RingBuffer(slots=5, slot_size=2)
+        messages = [bytes(bytearray([i % 256] * (1 + i % 5)))
+                    for i in range(200)]
+        for i, m in enumerate(messages):
+            # 1 to 3 slots each, starting at every position in the ring
+            self.assertTrue(ring.put(m, float(i)))
+            self.assertEqual(ring.get(0), (m, float(i)))
+        self.assertEqual(len(ring), 0)
+        self.assertEqual(ring.dropped, 0)
+        self.assertEqual(ring.high_water, 3)
+
+    def test_read_across_the_end(self):
+        ring = RingBuffer(slots=4, slot_size=2)
+        ring.put(b'\x01\x02\x03', 1.0)
+        ring.get()
+        ring.put(b'\x04\x05\x06', 2.0)
+        ring.put(b'\x07', 3.0)
+        self.assertEqual(ring.read(0), (b'\x04\x05\x06\x07', 2.0))
+        self.assertEqual(ring.read(0), None)
+
+    def test_drop_newest(self):
+        ring = RingBuffer(slots=2, slot_size=1)
+        self.assertTrue(ring.put(b'\x01'))
+        self.assertTrue(ring.put(b'\x02'))
+        self.assertFalse(ring.put(b'\x03'))
+        self.assertFalse(ring.put(b'\x04\x05\x06'))  # longer than the ring
+        self.assertEqual((ring.overflows, ring.dropped), (2, 2))
+        self.assertEqual(ring.get(0)[0], b'\x01')
+
+    def test_drop_oldest(self):
+        ring = RingBuffer(slots=4, slot_size=1, policy=DROP_OLDEST)
+        for i in range(6):
+            self.assertTrue(ring.put(bytes(bytearray([i])), float(i)))
+        self.assertEqual(ring.overflows, 2)
+        got = [ring.get(0) for _ in range(4)]
+        self.assertEqual(got, [(bytes(bytearray([i])), float(i))
+                               for i in range(2, 6)])
+        self.assertEqual(ring.dropped, 2)
+        self.assertEqual(ring.get(0), None)
+
+    def test_drop_oldest_skips_the_rest_of_a_lost_message(self):
+        ring = RingBuffer(slots=4, slot_size=2, policy=DROP_OLDEST)
+        ring.put(b'\x01\x02\x03\x04\x05\x06', 1.0)  # three slots
+        ring.put(b'\x07\x08', 2.0)
+        ring.put(b'\x09', 3.0)  # overwrites the first slot of the first
+        self.assertEqual(ring.get(0), (b'\x07\x08', 2.0))
+        self.assertEqual(ring.get(0), (b'\x09', 3.0))
+        # counted by the slot overwritten, not the ones skipped after it
+        self.assertEqual(ring.dropped, 1)
+
+    def test_block_times_out(self):
+        ring = RingBuffer(slots=1, slot_size=1, policy=BLOCK)
+        self.assertTrue(ring.put(b'\x01'))
+        self.assertFalse(ring.put(b'\x02', timeout=0.01))
+        self.assertEqual(ring.dropped, 1)
+
+    def test_get_times_out_and_ends_when_closed(self):
+        ring = RingBuffer(slots=2)
+        self.assertEqual(ring.get(0.01), None)
+        ring.put(b'\xf8', 1.0)
+        ring.close()
+        self.assertEqual(ring.get(), (b'\xf8', 1.0))
+        self.assertEqual(ring.get(), None)
+
+    def producer_consumer(self, policy, count=20000):
+        """
+        one thread putting numbered messages of one to three slots while
+        this one gets them: the SPSC use the ring is made for
+        """
+        ring = RingBuffer(slots=16, slot_size=4, policy=policy)
+        pack = struct.Struct('!I').pack
+
+        def produce():
+            for i in range(count):
+                ring.put(pack(i) * (1 + i % 3), float(i))
+            ring.close()
+        thread = threading.Thread(target=produce)
+        thread.start()
+        got = []
+        while True:
+            item = ring.get(5.0)
+            if item is None:
+                break
+            got.append(item)
+        thread.join()
+        for data, t in got:
+            # never torn: one whole message, stamped with its own time
+            i = struct.unpack('!I', data[:4])[0]
+            self.assertEqual(data, pack(i) * (1 + i % 3))
+            self.assertEqual(t, float(i))
+        return ring, [int(t) for _, t in got]
+
+    def test_spsc_block_loses_nothing(self):
+        ring, got = self.producer_consumer(BLOCK)
+        self.assertEqual(got, list(range(20000)))
+        self.assertEqual(ring.dropped, 0)
+
+    def test_spsc_drop_oldest_keeps_order(self):
+        ring, got = self.producer_consumer(DROP_OLDEST)
+        self.assertEqual(got, sorted(set(got)))
+        self.assertEqual(got[-1], 19999)
+
+    def test_decoupled(self):
+        out = _Collect()
+
+        def source(sink):
+            for i in range(100):
+                sink.send(b'\x90\x3c\x64')
+        ring = decoupled(source, out, coalesce=False)
+        self.assertEqual(out.items, [b'\x90\x3c\x64'] * 100)
+        self.assertTrue(ring.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
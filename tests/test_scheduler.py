@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from midiproc.batch import MessageBatch
+from midiproc.bench import smf_file
+from midiproc.scheduler import PlaybackStats, Scheduler, clock, play_smf, \
+    smf_source
+from midiproc.smf import MidiFile
+
+
+class _Timed(object):
+    "records (clock(), data) for everything sent"
+
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+
+    def send(self, rx):
+        self.sent.append((clock(), rx))
+
+    def close(self):
+        self.closed = True
+
+
+def _batch(times):
+    batch = MessageBatch()
+    for i, t in enumerate(times):
+        batch.append(0x90, 0x30 + i, 0x64, t)
+    return batch
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_groups_go_out_together_and_never_early(self):
+        times = [0.0, 0.0, 0.005, 0.010, 0.010, 0.010, 0.020]
+        out = _Timed()
+        start = clock()
+        stats = Scheduler(out).play(_batch(times), lead=0.005)
+        self.assertEqual([len(b) for _, b in out.sent], [2, 1, 3, 1])
+        self.assertEqual([list(b.timestamp)[0] for _, b in out.sent],
+                         [0.0, 0.005, 0.010, 0.020])
+        for (sent, b) in out.sent:
+            self.assertGreaterEqual(sent, start + 0.005 + b.timestamp[0])
+        self.assertEqual((stats.groups, stats.events), (4, 7))
+        self.assertGreaterEqual(stats.max_lateness, 0.0)
+
+    def test_speed(self):
+        out = _Timed()
+        start = clock()
+        Scheduler(out, speed=4.0).play(_batch([0.0, 0.08]), lead=0.0)
+        gap = out.sent[1][0] - out.sent[0][0]
+        self.assertGreaterEqual(gap, 0.02)
+        self.assertLess(out.sent[1][0] - start, 0.08)
+
+    def test_bytes_for_targets_without_batches(self):
+        out = _Timed()
+        Scheduler(out, batch=False).play(_batch([0.0, 0.0, 0.001]),
+                                         lead=0.0)
+        self.assertEqual([m for _, m in out.sent],
+                         [b'\x90\x30\x64', b'\x90\x31\x64', b'\x90\x32\x64'])
+
+    def test_empty(self):
+        stats = Scheduler(_Timed()).play(MessageBatch(), lead=0.0)
+        self.assertEqual((stats.groups, stats.jitter), (0, 0.0))
+
+
+class PlaybackStatsTest(unittest.TestCase):
+
+    def test_summary(self):
+        stats = PlaybackStats(late_threshold=0.001)
+        for lateness, events in ((0.0, 1), (0.002, 3), (0.001, 2)):
+            stats.record(lateness, events)
+        self.assertEqual((stats.groups, stats.events, stats.late), (3, 6, 1))
+        self.assertAlmostEqual(stats.mean_lateness, 0.001)
+        self.assertAlmostEqual(stats.max_lateness, 0.002)
+        self.assertAlmostEqual(stats.jitter, (2.0 / 3) ** 0.5 * 0.001)
+        self.assertIn('6 events in 3 groups', str(stats))
+
+
+class PlaySMFTest(unittest.TestCase):
+
+    def test_play_smf_tracks(self):
+        # every event at tick 0, so playback takes no time
+        smf = MidiFile(smf_file(3, 20, max_delta=0))
+        out = _Timed()
+        stats = play_smf(smf, out, tracks=[2])
+        self.assertEqual(stats.events, 20)
+        self.assertEqual(set(b.status[0] & 0x0F for _, b in out.sent), {1})
+
+    def test_smf_source_closes_its_target(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'song.mid')
+            with open(path, 'wb') as f:
+                f.write(smf_file(2, 10, max_delta=0))
+            out = _Timed()
+            stats = smf_source(path, out)
+            self.assertEqual(stats.events, 20)
+            self.assertTrue(out.closed)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+import json
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from midiproc.bench import smf_file
+from midiproc.cache import SMFCache
+from midiproc.smf import MidiFile, SMFReader, SMFError, TempoMap
+
+
+def _smf(fmt, tracks, division=96):
+    # a file from track bodies given as bytes, end of track added
+    tracks = [t + b'\x00\xff\x2f\x00' for t in tracks]
+    return b'MThd' + struct.pack('>IHHH', 6, fmt, len(tracks), division) + \
+        b''.join(b'MTrk' + struct.pack('>I', len(t)) + t for t in tracks)
+
+
+def _tempo(delta, tempo):
+    return bytes(bytearray((delta, 0xff, 0x51, 3))) + \
+        struct.pack('>I', tempo)[1:]
+
+
+# a note on a beat (96 ticks) in, then another a beat later
+_NOTES = b'\x60\x90\x3c\x64\x60\x3e\x64'
+
+
+def _events(table):
+    # every event of an EventTable, with its payload
+    return [(table.tick[i], table.track[i], table.status[i], table.data1[i],
+             table.data2[i], bytes(table.payload(i)))
+            for i in range(len(table))]
+
+
+class SMFReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'take.mid')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+
+    def grow(self, data, cuts, checkpoint_at=None):
+        """
+        the events polled as data is written out a piece at a time,
+        ending at each cut; with checkpoint_at, the reader is replaced
+        by one resumed from a checkpoint after that many polls
+        """
+        self.write(data[:cuts[0]])
+        reader = SMFReader(self.path)
+        out = []
+        try:
+            for n, cut in enumerate(cuts):
+                self.write(data[:cut])
+                out.extend(_events(reader.poll()))
+                if n + 1 == checkpoint_at:
+                    state = json.loads(json.dumps(reader.checkpoint()))
+                    reader.close()
+                    reader = SMFReader(self.path, checkpoint=state)
+            self.write(data)
+            out.extend(_events(reader.poll()))
+            self.assertTrue(reader.ended)
+        finally:
+            reader.close()
+        return out
+
+    def test_poll_of_a_whole_file(self):
+        data = smf_file(3, 200)
+        self.write(data)
+        with SMFReader(self.path) as reader:
+            self.assertEqual(_events(reader.poll()),
+                             _events(MidiFile(data).events))
+            self.assertTrue(reader.ended)
+            self.assertEqual(len(reader.poll()), 0)
+
+    def test_appends_that_split_events(self):
+        data = smf_file(3, 200)
+        expected = _events(MidiFile(data).events)
+        # every few bytes, so appends land inside deltas, data bytes,
+        # meta payloads and chunk headers
+        cuts = list(range(20, len(data), 37))
+        self.assertEqual(self.grow(data, cuts), expected)
+
+    def test_polls_stay_in_time_order_together(self):
+        data = smf_file(3, 200)
+        ticks = [e[0] for e in self.grow(data, list(range(20, len(data),
+                                                         101)))]
+        self.assertEqual(ticks, sorted(ticks))
+
+    def test_format_0_is_delivered_as_it_arrives(self):
+        data = smf_file(1, 300, fmt=0)
+        self.write(data[:len(data) // 2])
+        with SMFReader(self.path) as reader:
+            first = reader.poll()
+            self.assertTrue(len(first))
+            self.write(data)
+            rest = reader.poll()
+        self.assertEqual(_events(first) + _events(rest),
+                         _events(MidiFile(data).events))
+
+    def test_resume_from_a_checkpoint(self):
+        data = smf_file(3, 200)
+        expected = _events(MidiFile(data).events)
+        cuts = list(range(20, len(data), 211))
+        for at in (1, len(cuts) // 2, len(cuts) - 1):
+            self.assertEqual(self.grow(data, cuts, checkpoint_at=at),
+                             expected)
+
+    def test_checkpoint_needs_the_file_it_was_taken_of(self):
+        data = smf_file(2, 100)
+        self.write(data)
+        with SMFReader(self.path) as reader:
+            reader.poll()
+            state = reader.checkpoint()
+        self.write(data[:len(data) // 2])
+        self.assertRaises(SMFError, SMFReader, self.path, state)
+        state['version'] = 99
+        self.write(data)
+        self.assertRaises(SMFError, SMFReader, self.path, state)
+
+    def test_track_reads_one_track(self):
+        data = smf_file(3, 100)
+        self.write(data)
+        whole = MidiFile(data).events
+        with SMFReader(self.path) as reader:
+            track = reader.track(2)
+            self.assertEqual(_events(track),
+                             [e for e in _events(whole) if e[1] == 2])
+            self.assertRaises(IndexError, reader.track, 4)
+
+
+class TempoMapTest(unittest.TestCase):
+
+    def test_changes(self):
+        t = TempoMap(96, [(192, 250000), (0, 1000000), (192, 500000)])
+        # sorted, and a later change at the same tick wins
+        self.assertEqual(t.ticks, [0, 192])
+        self.assertEqual(t.tempos, [1000000, 500000])
+        self.assertEqual([t.seconds(x) for x in (0, 96, 192, 288)],
+                         [0.0, 1.0, 2.0, 2.5])
+        self.assertEqual(list(t.seconds_array([0, 96, 192, 288, 96])),
+                         [0.0, 1.0, 2.0, 2.5, 1.0])
+
+    def test_smpte(self):
+        # 25 frames per second, 40 ticks per frame: a millisecond a tick
+        t = TempoMap((256 - 25) << 8 | 40, [(0, 250000)])
+        self.assertAlmostEqual(t.seconds(1000), 1.0)
+
+
+class MidiFileTempoTest(unittest.TestCase):
+
+    def test_format_1_tempo_applies_to_every_track(self):
+        smf = MidiFile(_smf(1, [_tempo(0, 250000), _NOTES]))
+        self.assertEqual(smf.tempo_maps, None)
+        self.assertEqual([t for t, _, _ in smf.iter_timed()], [0.25, 0.5])
+
+    def test_format_2_tracks_keep_their_own_tempo(self):
+        data = _smf(2, [_tempo(0, 1000000) + _NOTES,
+                        _tempo(0, 250000) + _NOTES,
+                        _NOTES + _tempo(0, 250000) + _NOTES])
+        smf = MidiFile(data)
+        self.assertEqual(len(smf.tempo_maps), 3)
+        self.assertEqual(smf.tempo_maps[1].tempos, [250000])
+        self.assertEqual(smf.tempo_maps[2].ticks, [0, 192])
+        expected = [(1.0, 0), (2.0, 0), (0.25, 1), (0.5, 1),
+                    (0.5, 2), (1.0, 2), (1.25, 2), (1.5, 2)]
+        self.assertEqual([(t, track) for t, track, _ in smf.iter_timed()],
+                         expected)
+        self.assertEqual(smf.duration(), 2.0)
+
+    def test_format_2_from_the_cache(self):
+        data = _smf(2, [_tempo(0, 1000000) + _NOTES,
+                        _tempo(0, 250000) + _NOTES])
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'song.mid')
+            with open(path, 'wb') as f:
+                f.write(data)
+            for _ in range(2):
+                with SMFCache(os.path.join(directory, 'cache')) as cache:
+                    smf = cache.load(path)
+                    self.assertEqual(list(smf.seconds),
+                                     list(MidiFile(data).seconds))
+                    self.assertEqual(smf.tempo_maps[1].tempos, [250000])
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import random
+import unittest
+
+from midiproc.batch import MessageBatch
+from midiproc.processors import midi_in_stream
+from midiproc.stream import StreamParser, SysexBuffer, midi_in_chunks
+
+
+class _Collect(object):
+    def __init__(self):
+        self.items = []
+
+    def send(self, data):
+        if isinstance(data, MessageBatch):
+            data = data.to_bytes()
+        self.items.append(bytes(data))
+
+
+def _split(data, cuts):
+    # data cut into chunks at the given offsets
+    bounds = [0] + sorted(cuts) + [len(data)]
+    return [data[a:b] for a, b in zip(bounds, bounds[1:])]
+
+
+class StreamParserTest(unittest.TestCase):
+
+    def parse(self, chunks, **kwargs):
+        msgs, rts, sysex = _Collect(), _Collect(), _Collect()
+        p = StreamParser(msgs, rts, sysex, **kwargs)
+        for chunk in chunks:
+            p.feed(chunk)
+        return msgs.items, rts.items, sysex.items
+
+    def test_running_status_across_chunks(self):
+        data = b'\x90\x3c\x64\x3e\x64\x40\x00\xc0\x05\x06'
+        expected = [b'\x90\x3c\x64', b'\x90\x3e\x64', b'\x90\x40\x00',
+                    b'\xc0\x05', b'\xc0\x06']
+        for cut in range(1, len(data)):
+            self.assertEqual(self.parse(_split(data, [cut]))[0], expected)
+        self.assertEqual(self.parse([data[i:i + 1]
+                                     for i in range(len(data))])[0],
+                         expected)
+
+    def test_sysex_split_across_chunks(self):
+        data = b'\x90\x3c\x64\xf0\x41\x10\x42\x12\xf7\x3e\x64\x80\x3c\x00'
+        for cut in range(1, len(data)):
+            msgs, _, sysex = self.parse(_split(data, [cut]))
+            # sysex clears running status, so 3e 64 is dropped
+            self.assertEqual(msgs, [b'\x90\x3c\x64', b'\x80\x3c\x00'])
+            self.assertEqual(sysex, [b'\x41\x10\x42\x12'])
+
+    def test_realtime_inside_sysex(self):
+        data = b'\xf0\x41\xf8\x10\xfe\x42\xf7\x90\x3c\xf8\x64'
+        for cut in range(1, len(data)):
+            msgs, rts, sysex = self.parse(_split(data, [cut]))
+            self.assertEqual(sysex, [b'\x41\x10\x42'])
+            self.assertEqual(rts, [b'\xf8', b'\xfe', b'\xf8'])
+            self.assertEqual(msgs, [b'\x90\x3c\x64'])
+
+    def test_status_byte_ends_sysex(self):
+        msgs, _, sysex = self.parse([b'\xf0\x01\x02', b'\x90\x3c\x64'])
+        self.assertEqual(sysex, [b'\x01\x02'])
+        self.assertEqual(msgs, [b'\x90\x3c\x64'])
+
+    def test_batch_matches_per_message(self):
+        data = b'\x90\x3c\x64\x3e\x64\xf8\xc0\x05\xb0\x07\x7f\x08\x00'
+        msgs = self.parse([data[:4], data[4:9], data[9:]])[0]
+        batches = self.parse([data[:4], data[4:9], data[9:]], batch=True)[0]
+        # one batch per chunk that completed a message
+        self.assertEqual(len(batches), 3)
+        self.assertEqual(b''.join(batches), b''.join(msgs))
+
+    def test_matches_midi_in_stream(self):
+        rnd = random.Random(1)
+        pool = [0x90, 0x80, 0xc0, 0xd0, 0xb0, 0xf0, 0xf7, 0xf8, 0xfe, 0xf2,
+                0xf6] + list(range(0x00, 0x80, 7))
+        data = bytes(bytearray(rnd.choice(pool) for _ in range(3000)))
+        msgs, rts, sysex = _Collect(), _Collect(), _Collect()
+        reference = midi_in_stream(msgs, rts, sysex)
+        for i in range(len(data)):
+            reference.send(data[i:i + 1])
+        expected = (msgs.items, rts.items, sysex.items)
+        for trial in range(20):
+            cuts = rnd.sample(range(1, len(data)), rnd.randint(1, 200))
+            self.assertEqual(self.parse(_split(data, cuts)), expected)
+
+    def test_resume(self):
+        msgs = _Collect()
+        p = StreamParser(msgs)
+        p.resume(0x90)
+        p.feed(b'\x3c\x64')
+        p.resume(0xc0)
+        p.feed(b'\x05\x06')
+        self.assertEqual(msgs.items,
+                         [b'\x90\x3c\x64', b'\xc0\x05', b'\xc0\x06'])
+
+    def test_midi_in_chunks(self):
+        msgs, rts = _Collect(), _Collect()
+        target = midi_in_chunks(msgs, rts)
+        target.send(b'\x90\x3c')
+        target.send(b'\xf8\x64\x3e')
+        target.send(bytearray(b'\x64'))
+        target.send(memoryview(b'\x80\x3c\x00'))
+        self.assertEqual(msgs.items, [b'\x90\x3c\x64', b'\x90\x3e\x64',
+                                      b'\x80\x3c\x00'])
+        self.assertEqual(rts.items, [b'\xf8'])
+
+
+class SysexBufferTest(unittest.TestCase):
+
+    def test_whole_payload_grows_and_shrinks_back(self):
+        out = _Collect()
+        buf = SysexBuffer(out, max_size=None)
+        capacity = len(buf._buf)
+        buf.start()
+        buf.add(b'\x01' * (capacity + 10))
+        buf.end()
+        self.assertEqual(out.items, [b'\x01' * (capacity + 10)])
+        self.assertEqual(len(buf._buf), capacity)
+
+    def test_max_size_truncates(self):
+        out = _Collect()
+        buf = SysexBuffer(out, max_size=4)
+        for payload in (b'\x01\x02\x03', b'\x04\x05\x06\x07\x08'):
+            buf.start()
+            buf.add(payload[:2])
+            buf.add(payload[2:])
+            buf.end()
+        self.assertEqual(out.items, [b'\x01\x02\x03', b'\x04\x05\x06\x07'])
+        self.assertEqual(buf.overflows, 1)
+
+    def test_chunks_then_end_marker(self):
+        out = _Collect()
+        buf = SysexBuffer(out, chunk_size=3)
+        buf.start()
+        buf.add(b'\x01\x02')
+        buf.add(b'\x03\x04\x05\x06\x07')
+        buf.end()
+        self.assertEqual(out.items, [b'\x01\x02\x03', b'\x04\x05\x06',
+                                     b'\x07', b''])
+
+    def test_chunks_through_the_parser(self):
+        out = _Collect()
+        p = StreamParser(sysex_target=out, sysex_chunk=2)
+        p.feed(b'\xf0\x01\x02\x03')
+        p.feed(b'\xf8\x04\x05\xf7')
+        self.assertEqual(out.items, [b'\x01\x02', b'\x03\x04', b'\x05', b''])
+
+
+if __name__ == '__main__':
+    unittest.main()
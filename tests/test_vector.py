@@ -0,0 +1,114 @@
+import random
+import unittest
+
+from midiproc import processors, vector
+from midiproc.batch import MessageBatch
+
+
+class _Collect(object):
+    def __init__(self):
+        self.rows = []
+
+    def send(self, rx):
+        if isinstance(rx, MessageBatch):
+            self.rows.extend(zip(rx.status, rx.data1, rx.data2))
+        else:
+            msg = bytearray(rx)
+            self.rows.append((msg[0], msg[1], msg[2] if len(msg) > 2 else 0))
+
+
+def _batch(count=2000, seed=0):
+    rnd = random.Random(seed)
+    batch = MessageBatch()
+    for i in range(count):
+        status = rnd.randrange(0x80, 0xF0)
+        d2 = 0 if 0xC0 <= status <= 0xDF else rnd.choice((0, 1, 64, 127))
+        batch.append(status, rnd.randrange(128), d2, i * 0.001)
+    return batch
+
+
+def _stages():
+    "(name, factory) for a stage of each kind, sending to one target"
+    return [
+        ('drop_off', vector.drop_off),
+        ('drop_off all', lambda t: vector.drop_off(t, channels=None)),
+        ('harmonize', vector.harmonize),
+        ('harmonize up', lambda t: vector.harmonize(
+            t, interval=12, below=0x70, channels=(0, 1, 2), high=120)),
+        ('transpose', lambda t: vector.transpose(t, 5, high=100)),
+        ('transpose drop', lambda t: vector.transpose(
+            t, -7, low=20, clamp=False, channels=(3, 4))),
+        ('remap', lambda t: vector.remap_channels(t, {0: 9, 9: 0})),
+        ('velocity', lambda t: vector.scale_velocity(
+            t, factor=0.5, curve=1.5, channels=range(8))),
+    ]
+
+
+class VectorStageTest(unittest.TestCase):
+
+    def run_stages(self):
+        batch = _batch()
+        for name, stage in _stages():
+            whole = _Collect()
+            stage(whole).send(batch)
+            single = _Collect()
+            s = stage(single)
+            for m in batch:
+                s.send(m.to_bytes())
+            self.assertEqual(whole.rows, single.rows, name)
+
+    @unittest.skipIf(vector.numpy is None, 'needs NumPy')
+    def test_numpy_batches_match_messages(self):
+        self.run_stages()
+
+    def test_fallback_batches_match_messages(self):
+        saved = vector.numpy
+        vector.numpy = None
+        try:
+            self.run_stages()
+        finally:
+            vector.numpy = saved
+
+    def test_defaults_match_processors(self):
+        batch = _batch()
+        for ours, theirs in ((vector.drop_off, processors.drop_off),
+                             (vector.harmonize, processors.harmonize)):
+            a, b = _Collect(), _Collect()
+            ours(a).send(batch)
+            theirs(b).send(batch)
+            self.assertEqual(a.rows, b.rows)
+
+    @unittest.skipIf(vector.numpy is None, 'needs NumPy')
+    def test_harmony_follows_its_note(self):
+        batch = MessageBatch()
+        batch.append(0x90, 0x30, 0x64, 1.0)
+        batch.append(0x90, 0x40, 0x64, 2.0)
+        out = vector.batch_harmonize(batch)
+        self.assertEqual(list(zip(out.data1, out.timestamp)),
+                         [(0x30, 1.0), (0x18, 1.0), (0x40, 2.0)])
+
+    def test_key_split(self):
+        batch = MessageBatch()
+        for status, d1 in ((0x90, 40), (0x90, 80), (0xB0, 7), (0x80, 60)):
+            batch.append(status, d1, 64)
+        for numpy in (vector.numpy, None):
+            saved = vector.numpy
+            vector.numpy = numpy
+            try:
+                low, high = _Collect(), _Collect()
+                vector.key_split(low, high, 60).send(batch)
+            finally:
+                vector.numpy = saved
+            self.assertEqual(low.rows, [(0x90, 40, 64), (0xB0, 7, 64)])
+            self.assertEqual(high.rows, [(0x90, 80, 64), (0xB0, 7, 64),
+                                         (0x80, 60, 64)])
+
+    def test_velocity_table(self):
+        table = vector.velocity_table(factor=2.0, minimum=10, maximum=100)
+        self.assertEqual(len(table), 128)
+        self.assertEqual(table[0], 0)
+        self.assertEqual((table[1], table[40], table[127]), (10, 80, 100))
+
+
+if __name__ == '__main__':
+    unittest.main()